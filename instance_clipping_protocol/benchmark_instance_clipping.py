@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+""" Benchmark of the instance clipping stages on synthetic images.
+
+usage: python %s [--num_images N ...] [--image_sizes <rows>,<cols> ...] [--configurations <subinstance_size>,<clickable_size>,<num_subinstances_to_combine> ...]
+Each of load_images, collect_subinstances, combine_subinstances and save_parameters is run on every point of the grid,
+and one json record per stage is written to stdout (or --output), containing the wall time, the throughput and the peak memory.
+"""
+
+# metadata variables
+__author__ = "Hiroshi KAJINO <hiroshi.kajino.1989@gmail.com>"
+__date__ = "2014/04/14"
+__version__ = "1.0"
+__copyright__ = "Copyright (c) 2014 Hiroshi Kajino all rights reserved."
+__docformat__ = "restructuredtext en"
+
+import numpy as np
+import cv2
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import contextlib
+# instrumentation is shared with the post-processing scripts.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "post_process_for_instance_clipping_protocol"))
+from instance_clipping_and_mixing import load_images, collect_subinstances, combine_subinstances, save_parameters, \
+    describe_images, list_image_files
+from instance_clipping_sweep import parse_configuration
+from instrumentation import StageMeter
+
+
+def generate_images(save_dir, num_images, row_size, col_size, seed=0):
+    """ generate smooth random jpeg images, which are compressed like natural images.
+
+    :Variables:
+        save_dir : str
+        num_images : int
+        row_size : int
+        col_size : int
+        seed : int
+    """
+    rng = np.random.RandomState(seed)
+    for i in range(num_images):
+        coarse = rng.randint(0, 256, size=(max(1, row_size // 16), max(1, col_size // 16), 3)).astype(np.uint8)
+        img = cv2.resize(coarse, (col_size, row_size), interpolation=cv2.INTER_LINEAR)
+        img = np.clip(img.astype(int) + rng.randint(-8, 9, size=img.shape), 0, 255).astype(np.uint8)
+        cv2.imwrite(os.path.join(save_dir, "%06d.jpg" % i), img)
+
+
+def benchmark(img_dir, work_dir, configuration, num_workers, memory_budget):
+    """ run the stages of the instance clipping protocol with one configuration.
+
+    :Variables:
+        img_dir : str
+        work_dir : str
+            a directory to save mosaics and parameters.
+        configuration : tuple of ints
+            (subinstance_size, clickable_size, num_subinstances_to_combine)
+        num_workers : int
+        memory_budget : int
+    :RType: list
+    :Returns:
+        a list of (stage, meter, num_items, unit).
+    """
+    subinstance_size, clickable_size, num_subinstances_to_combine = configuration
+    expand = subinstance_size // clickable_size
+    result_list = []
+    with StageMeter(interval=0.005, trace_memory=True) as meter:
+        img_list = load_images(img_dir, normalize=True, subinstance_size=subinstance_size, num_workers=num_workers)
+    result_list.append(("load_images", meter, len(img_list), "images"))
+    with StageMeter(interval=0.005, trace_memory=True) as meter:
+        subinstance_list, subinstance_org_loc_list = collect_subinstances(img_list, subinstance_size, clickable_size)
+    num_subinstances = len(subinstance_list) // (expand * expand)
+    result_list.append(("collect_subinstances", meter, num_subinstances, "subinstances"))
+    with StageMeter(interval=0.005, trace_memory=True) as meter:
+        mosaic_loc_list = combine_subinstances(work_dir, subinstance_list, subinstance_size, clickable_size, num_subinstances_to_combine,
+                                               memory_budget=memory_budget, num_workers=num_workers)
+    num_mosaics = int(np.ceil(float(num_subinstances) / float(num_subinstances_to_combine * num_subinstances_to_combine)))
+    result_list.append(("combine_subinstances", meter, num_mosaics, "mosaics"))
+    args_ic = argparse.Namespace(input_img_dir=img_dir, output_dir=work_dir, subinstance_size=subinstance_size,
+                                 clickable_size=clickable_size, num_subinstances_to_combine=num_subinstances_to_combine)
+    with StageMeter(interval=0.005, trace_memory=True) as meter:
+        save_parameters(work_dir, args_ic,
+                        describe_images(list_image_files(img_dir), [img.shape for img in img_list], num_workers),
+                        subinstance_org_loc_list, mosaic_loc_list,
+                        [{"seed": 42, "first_image": 0, "first_mosaic": 0}])
+    result_list.append(("save_parameters", meter, num_subinstances, "subinstances"))
+    return result_list
+
+
+def parse_image_size(image_size_str):
+    """ parse "<rows>,<cols>".
+    """
+    image_size = tuple(int(each_size) for each_size in image_size_str.split(","))
+    if len(image_size) != 2:
+        raise argparse.ArgumentTypeError("an image size must be <rows>,<cols>.")
+    return image_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the instance clipping stages on synthetic images.")
+    parser.add_argument("--num_images", type=int, nargs="+", default=[20], help="The numbers of synthetic images.")
+    parser.add_argument("--image_sizes", type=parse_image_size, nargs="+", default=[(480, 640)], help="<rows>,<cols> of synthetic images.")
+    parser.add_argument("--configurations", type=parse_configuration, nargs="+", default=[(100, 50, 5)],
+                        help="<subinstance_size>,<clickable_size>,<num_subinstances_to_combine> to benchmark.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="The number of threads to decode images and encode mosaics.")
+    parser.add_argument("--memory_budget", type=int, default=256, help="Memory [MB] to buffer mosaics.")
+    parser.add_argument("--output", type=str, default=None, help="A json-lines file to append results. stdout if not given.")
+    args = parser.parse_args()
+
+    out = sys.stdout if args.output is None else open(args.output, "a")
+    tmp_dir = tempfile.mkdtemp(prefix="benchmark_instance_clipping_")
+    try:
+        for num_images in args.num_images:
+            for (row_size, col_size) in args.image_sizes:
+                img_dir = os.path.join(tmp_dir, "images_%d_%d_%d" % (num_images, row_size, col_size))
+                os.mkdir(img_dir)
+                generate_images(img_dir, num_images, row_size, col_size)
+                for configuration in args.configurations:
+                    work_dir = tempfile.mkdtemp(dir=tmp_dir)
+                    # progress messages of the stages go to stderr so that stdout only contains records.
+                    with contextlib.redirect_stdout(sys.stderr):
+                        result_list = benchmark(img_dir, work_dir, configuration, args.num_workers, args.memory_budget)
+                    for (stage, meter, num_items, unit) in result_list:
+                        record = {"stage": stage,
+                                  "num_images": num_images,
+                                  "image_rows": row_size,
+                                  "image_cols": col_size,
+                                  "subinstance_size": configuration[0],
+                                  "clickable_size": configuration[1],
+                                  "num_subinstances_to_combine": configuration[2],
+                                  "num_workers": args.num_workers,
+                                  "wall_time": meter.wall_time,
+                                  "num_items": num_items,
+                                  "unit": unit,
+                                  "throughput": num_items / meter.wall_time if meter.wall_time > 0 else None,
+                                  "peak_rss_mb": meter.peak_rss / 1024.0 / 1024.0 if meter.peak_rss is not None else None,
+                                  "peak_traced_mb": meter.peak_traced / 1024.0 / 1024.0}
+                        out.write(json.dumps(record) + "\n")
+                        out.flush()
+                    shutil.rmtree(work_dir)
+                shutil.rmtree(img_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,13 @@ usage: python %s <load_img_folder/> <save_folder_name> <subinstance_size> <num_s
 REMARK:
     subinstance_size must be even.
 SAVE_FILES:
-    relation_between_org_and_shuffle.pkl : pickle file containing 
-    org.pkl : pickle version of list 'patch_org_loc_list'
-        the i-th element equals to (NAME_OF_ORIGINAL_FILE, (left-top-row, left-top-col, height, width))
-    shuffled.pkl : pickle version of list 'patch_shuffled_loc_list'
-        the i-th element equals to (NAME_OF_SHUFFLED_FILE, (row, column)) (NOTE: row and column are 0-origin)
-    the i-th elements of both lists indicate the same object.
+    mosaics/ : mosaic images to crowdsource.
+    parameters/ : parameters of the instance clipping protocol (see save_parameters).
+        header.json : the format version, the command line arguments, the (incremental) runs, and the paths, sha1 hashes and normalized shapes of the original images.
+        subinstance_org_loc.npy : int32 array whose i-th row equals to (IMAGE_INDEX, left-top-row, left-top-col, height, width)
+        mosaic_loc.npy : int32 array whose i-th row equals to (MOSAIC_INDEX, left-top-row, left-top-col, height, width)
+    the i-th rows of both arrays indicate the same object.
+    cache/ : normalized images keyed by their sha1 hashes (only with --incremental).
 """
 
 # metadata variables
@@ -22,6 +23,11 @@ __docformat__ = "restructuredtext en"
 
 MARGIN = 0
 GAP_SIZE = 0
+SPOOL_FILE_NAME = "images.spool"
+PARAMETERS_DIR_NAME = "parameters"
+CACHE_DIR_NAME = "cache"
+IMAGE_FILE_PATTERNS = ('*.jpg',)
+TILED_IMAGE_FILE_PATTERNS = ('*.jpg', '*.npy')
 #SIZE = 10 # finally each shuffled picture contains SIZE \times SIZE patches
 
 import numpy as np
@@ -30,8 +36,15 @@ import datetime
 import sys
 import os
 import glob
-import pickle
+import json
+import hashlib
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib.stride_tricks import as_strided
+# instrumentation and the parameters format are shared with the post-processing scripts.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "post_process_for_instance_clipping_protocol"))
+from instrumentation import MetricsLogger, metrics_logger
+from utils import PARAMETERS_FORMAT_VERSION
 
 
 def create_output_dir(output_dir, dir_name):
@@ -46,22 +59,99 @@ def create_output_dir(output_dir, dir_name):
     except OSError:
         print(os.path.join(output_dir, dir_name) + " exits... :(")
 
-def write_log(output_dir, texts, new_file=False):
-    """ write texts into a log file in output_dir.
+def write_log(output_dir, texts_list, new_file=False):
+    """ write texts into a log file in output_dir, opening the file only once.
 
     :Variables:
         output_dir : str
-        new : bool
-            if new = True, then create a new file and delete the old file.
+        texts_list : list
+            each element is written in one line.
+        new_file : bool
+            if new_file = True, then create a new file and delete the old file.
     """
-    if new_file:
-        f = open(os.path.join(output_dir, "std.log"), "w")
-    else:
-        f = open(os.path.join(output_dir, "std.log"), "a")
-    f.write(str(texts) + "\n")
-    f.close()
+    with open(os.path.join(output_dir, "std.log"), "w" if new_file else "a") as f:
+        for texts in texts_list:
+            f.write(str(texts) + "\n")
+
+def normalized_shape(img_shape, subinstance_size):
+    """ compute the (row_size, col_size) of an image after normalization.
+
+    :Variables:
+        img_shape : tuple
+            the shape of an original image.
+        subinstance_size : int
+            the size of a subinstance.
+    :RType: tuple of ints
+    :Returns:
+        (row_size, col_size)
+    """
+    step_size = subinstance_size // 2
+    row_size = img_shape[0]
+    col_size = img_shape[1]
+    if row_size <= subinstance_size:
+        row_size = subinstance_size
+    if col_size <= subinstance_size:
+        col_size = subinstance_size
+    if row_size > subinstance_size and row_size % step_size != 0:
+        row_size = row_size + (step_size - row_size % step_size)
+    if col_size > subinstance_size and col_size % step_size != 0:
+        col_size = col_size + (step_size - col_size % step_size)
+    return row_size, col_size
+
+def normalize_image(img, subinstance_size):
+    """ enlarge an image with zero padding so that the size is propotional to a half of `subinstance_size`.
+
+    :Variables:
+        img : numpy.array
+            an image in a numpy.array format.
+        subinstance_size : int
+            the size of a subinstance.
+    :RType: numpy.array
+    :Returns:
+        normalized_img : numpy.array
+            the padded image, which keeps the dtype of img (uint8 for decoded jpeg files).
+    """
+    row_size, col_size = normalized_shape(img.shape, subinstance_size)
+    normalized_img = np.zeros((row_size, col_size) + img.shape[2:], dtype=img.dtype)
+    normalized_img[0 : img.shape[0], 0 : img.shape[1]] = img
+    return normalized_img
+
+def list_image_files(load_path, patterns=IMAGE_FILE_PATTERNS):
+    """ list image files in a folder in a sorted order, so that image indices are reproducible across machines.
+
+    :Variables:
+        load_path : str
+            load path that contains images. slash at the last.
+        patterns : tuple of str
+            glob patterns of image files.
+    :RType: list
+    :Returns:
+        file_list : list
+            sorted paths to the image files.
+    """
+    file_list = []
+    for each_pattern in patterns:
+        file_list.extend(glob.glob(os.path.join(load_path, each_pattern)))
+    return sorted(file_list)
+
+def load_image(file_path, normalize=True, subinstance_size=50):
+    """ load an image, and enlarge it so that the size is propotional to `subinstance_size` if normalize is True.
 
-def load_images(load_path, normalize=True, subinstance_size=50):
+    :Variables:
+        file_path : str
+            a path to a jpeg file.
+        normalize : bool
+        subinstance_size : int
+    :RType: numpy.array
+    :Returns:
+        an image in a numpy.array format.
+    """
+    img = np.asarray(cv2.imread(file_path))
+    if normalize:
+        return normalize_image(img, subinstance_size)
+    return img
+
+def load_images(load_path, normalize=True, subinstance_size=50, num_workers=1):
     """ load images and enlarge images so that the size is propotional to `subinstance_size`. if normalize is True.
 
     :Variables:
@@ -71,40 +161,163 @@ def load_images(load_path, normalize=True, subinstance_size=50):
             normalize images or not. If normalization is true, the size of each image is set to be proportional to subinstance_size.
         subinstance_size : int
             the size of a subinstance.
+        num_workers : int
+            the number of threads to decode images. cv2 releases the GIL while decoding.
     :RType: list
     :Returns:
         img_list : list
-            img_list[i] contains an image in a numpy.array format.
+            img_list[i] contains an image in a numpy.array format, in the order of list_image_files.
     """
-    file_list = glob.glob(os.path.join(load_path, '*.jpg'))
-    num_files = len(file_list)
-    print("#(files) =", num_files)
-    step_size = subinstance_size // 2
-    img_list = [None] * num_files
-    i = 0
-    if normalize:
-        for each_file in file_list:
-            tmp_file = np.asarray(cv2.imread(each_file))
-            row_size = tmp_file.shape[0]
-            col_size = tmp_file.shape[1]
-            if row_size <= subinstance_size:
-                row_size = subinstance_size
-            if col_size <= subinstance_size:
-                col_size = subinstance_size
-            if row_size > subinstance_size and row_size % step_size != 0:
-                row_size = row_size + (step_size - row_size % step_size)
-            if col_size > subinstance_size and col_size % step_size != 0:
-                col_size = col_size + (step_size - col_size % step_size)
-            tmp_file_1 = np.zeros((row_size, col_size, 3))
-            tmp_file_1[0 : tmp_file.shape[0], 0 : tmp_file.shape[1]] = tmp_file
-            img_list[i] = tmp_file_1
-            i += 1
-    else:
-        for each_file in file_list:
-            img_list[i] = np.asarray(cv2.imread(each_file))
-            i += 1
+    file_list = list_image_files(load_path)
+    print("#(files) =", len(file_list))
+    return load_image_files(file_list, normalize, subinstance_size, num_workers)
+
+def load_image_files(file_list, normalize=True, subinstance_size=50, num_workers=1):
+    """ load the given image files in parallel, keeping their order.
+
+    :Variables:
+        file_list : list
+        normalize : bool
+        subinstance_size : int
+        num_workers : int
+    :RType: list
+    :Returns:
+        img_list : list
+            img_list[i] contains the image of file_list[i] in a numpy.array format.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        img_list = list(executor.map(lambda each_file: load_image(each_file, normalize, subinstance_size), file_list))
     return img_list
 
+class ImageReader:
+    """ Reader of horizontal strips of an image file.
+    A .npy file (height x width x 3 uint8 array) is memory-mapped, so that only the requested rows are read from the disk.
+    Other files are decoded as a whole, since cv2 cannot decode a part of a jpeg file.
+
+    :IVariables:
+        shape : tuple
+            the shape of the image.
+        dtype : numpy.dtype
+    """
+    def __init__(self, file_path):
+        if file_path.endswith(".npy"):
+            self._img = np.load(file_path, mmap_mode="r")
+            if self._img.dtype != np.uint8:
+                raise ValueError("ERROR: " + file_path + " must contain an uint8 array.")
+        else:
+            self._img = np.asarray(cv2.imread(file_path))
+        self.shape = self._img.shape[:2] + (3,)
+        self.dtype = self._img.dtype
+
+    def read_rows(self, first_row, last_row):
+        """ Read rows from first_row to last_row - 1 into memory.
+
+        :RType: numpy.array
+        """
+        rows = np.asarray(self._img[first_row : last_row])
+        if rows.ndim == 2:
+            rows = np.repeat(rows[:, :, np.newaxis], 3, axis=2)
+        return rows
+
+def iter_normalized_strips(reader, subinstance_size):
+    """ iterate over the strips of step_size (= subinstance_size / 2) rows of a NORMALIZED image,
+    reading only the rows of each strip, so that the memory usage is bounded by a strip instead of the whole image.
+    A row of clipping windows consists of two consecutive strips.
+
+    :Variables:
+        reader : ImageReader
+        subinstance_size : int
+    :RType: generator
+    :Returns:
+        strips of the normalized image from top to bottom. A strip is overwritten by the next one.
+    """
+    step_size = subinstance_size // 2
+    row_size, col_size = normalized_shape(reader.shape, subinstance_size)
+    strip = np.zeros((step_size, col_size) + reader.shape[2:], dtype=reader.dtype)
+    for top in range(0, row_size, step_size):
+        rows = reader.read_rows(top, min(top + step_size, reader.shape[0]))
+        strip[...] = 0
+        strip[0 : rows.shape[0], 0 : rows.shape[1]] = rows
+        yield strip
+
+def count_subinstances(img_shape, subinstance_size):
+    """ count the clipping windows on each side of an image.
+
+    :Variables:
+        img_shape : tuple
+            the shape of an image.
+        subinstance_size : int
+            the size of a subinstance (step_size will be a half of it).
+    :RType: tuple of ints
+    :Returns:
+        (num_rows, num_cols) : the numbers of clipping windows along rows and columns.
+    """
+    num_rows = int(np.ceil((2.0 * img_shape[0] / float(subinstance_size)) - 1.0))
+    num_cols = int(np.ceil((2.0 * img_shape[1] / float(subinstance_size)) - 1.0))
+    return max(num_rows, 0), max(num_cols, 0)
+
+def clickable_area_locations(img_shape, img_index, subinstance_size, clickable_size):
+    """ compute the original locations of all the clickable areas of an image.
+
+    :Variables:
+        img_shape : tuple
+            the shape of a NORMALIZED image.
+        img_index : int
+            the index of the image in img_list.
+        subinstance_size : int
+            the size of subinstance (step_size will be a half of it).
+        clickable_size : int
+            the size of a clickable area (that can divide subinstance_size well).
+    :RType: numpy.array
+    :Returns:
+        loc_array : numpy.array
+            #(clickable areas) x 5 integer array, whose rows are (img_index, top, left, height, width),
+            ordered in the same way as clip_clickable_areas.
+    """
+    step_size = subinstance_size // 2
+    expand = subinstance_size // clickable_size
+    num_rows, num_cols = count_subinstances(img_shape, subinstance_size)
+    j, k, l, m = np.indices((num_rows, num_cols, expand, expand)).reshape(4, -1)
+    loc_array = np.empty((len(j), 5), dtype=int)
+    loc_array[:, 0] = img_index
+    loc_array[:, 1] = step_size * j + l * clickable_size
+    loc_array[:, 2] = step_size * k + m * clickable_size
+    loc_array[:, 3] = clickable_size
+    loc_array[:, 4] = clickable_size
+    return loc_array
+
+def clip_clickable_areas(img, subinstance_size, clickable_size):
+    """ clip all the clickable areas of a NORMALIZED image at once, without copying pixels.
+
+    :Variables:
+        img : numpy.array
+            an image in a numpy.array format.
+        subinstance_size : int
+            the size of subinstance (step_size will be a half of it).
+        clickable_size : int
+            the size of a clickable area (that can divide subinstance_size well).
+    :RType: numpy.array
+    :Returns:
+        area_view : numpy.array
+            a read-only strided view of shape (num_rows, num_cols, expand, expand, clickable_size, clickable_size, #channels),
+            where area_view[j, k, l, m] is the (l, m)-th clickable area of the (j, k)-th subinstance.
+    """
+    step_size = subinstance_size // 2
+    expand = subinstance_size // clickable_size
+    num_rows, num_cols = count_subinstances(img.shape, subinstance_size)
+    if num_rows > 0 and num_cols > 0 \
+       and (step_size * (num_rows - 1) + subinstance_size > img.shape[0]
+            or step_size * (num_cols - 1) + subinstance_size > img.shape[1]):
+        sys.stdout.write("ERROR: images are not normalized.\n")
+        exit(0)
+    row_stride, col_stride = img.strides[:2]
+    return as_strided(img,
+                      shape=(num_rows, num_cols, expand, expand, clickable_size, clickable_size) + img.shape[2:],
+                      strides=(step_size * row_stride, step_size * col_stride,
+                               clickable_size * row_stride, clickable_size * col_stride,
+                               row_stride, col_stride) + img.strides[2:],
+                      writeable=False)
+
 def collect_subinstances(img_list, subinstance_size, clickable_size):
     """ create a list of subinstances from a list of NORMALIZED images.
 
@@ -115,72 +328,119 @@ def collect_subinstances(img_list, subinstance_size, clickable_size):
             the size of subinstance (step_size will be a half of it).
         clickable_size : int
             the size of a clickable area (that can divide subinstance_size well).
-    :RType: tuple of lists
+    :RType: tuple of numpy.arrays
     :Returns:
-        _subinstance_list : list
-            a list of subinstances divided into clickable areas (which we call sub-subinstance).
-        _subinstance_org_loc_list : list
-            _subinstance_org_loc_list[i] = the original location of the i-th sub-subinstance of _subinstance_list.
+        _subinstance_list : numpy.array
+            #(sub-subinstances) x clickable_size x clickable_size x #(channels) array of subinstances
+            divided into clickable areas (which we call sub-subinstance).
+        _subinstance_org_loc_list : numpy.array
+            #(sub-subinstances) x 5 integer array.
+            _subinstance_org_loc_list[i] = (img_index, top, left, height, width) of the i-th sub-subinstance of _subinstance_list.
     """
     num_files = len(img_list)
-    step_size = subinstance_size // 2
+    expand = (subinstance_size // clickable_size)
     num_subinstances = 0
     for i in range(num_files):
-        num_rows = int(np.ceil((2.0 * img_list[i].shape[0] / float(subinstance_size)) - 1.0))
-        num_cols = int(np.ceil((2.0 * img_list[i].shape[1] / float(subinstance_size)) - 1.0))
+        num_rows, num_cols = count_subinstances(img_list[i].shape, subinstance_size)
         num_subinstances += num_rows * num_cols
         #print(str(i) + "-th image: " + "num_rows = " + str(num_rows) + ", num_cols = " + str(num_cols) + ", #(sub_files) = ", str(num_subinstances))
     
     print("#(subinstances) =", num_subinstances)
-    
-    expand = (subinstance_size // clickable_size)
-    
-    subinstance_list = [None] * expand * expand * num_subinstances
-    subinstance_org_loc_list = [None] * expand * expand * num_subinstances
-    
-    patch_i = 0
+
+    if num_files == 0:
+        return (np.zeros((0, clickable_size, clickable_size, 3), dtype=np.uint8),
+                np.zeros((0, 5), dtype=int))
+    subinstance_list = np.empty((expand * expand * num_subinstances, clickable_size, clickable_size) + img_list[0].shape[2:],
+                                dtype=img_list[0].dtype)
+    subinstance_org_loc_list = np.empty((expand * expand * num_subinstances, 5), dtype=int)
+
+    area_i = 0
     for i in range(num_files):
-        num_rows = int(np.ceil((2.0 * img_list[i].shape[0] / float(subinstance_size)) - 1.0))
-        num_cols = int(np.ceil((2.0 * img_list[i].shape[1] / float(subinstance_size)) - 1.0))
-        for j in range(num_rows):
-            for k in range(num_cols):
-                for l in range(expand):
-                    for m in range(expand):
-                        try:
-                            subinstance_list[patch_i * expand * expand + l * expand + m ] \
-                                = img_list[i][step_size * j + l * clickable_size : step_size * j + (l + 1) * clickable_size,
-                                              step_size * k + m * clickable_size : step_size * k + (m + 1) * clickable_size]
-                        except IndexError:
-                            sys.stdout.write("ERROR: images are not normalized.\n")
-                            exit(0)
-                        subinstance_org_loc_list[patch_i * expand * expand + l * expand + m ] \
-                            = (i, (step_size * j + l * clickable_size,
-                                   step_size * k + m * clickable_size,
-                                   clickable_size,
-                                   clickable_size))
-                patch_i += 1
-
-    if patch_i != num_subinstances:
+        area_view = clip_clickable_areas(img_list[i], subinstance_size, clickable_size)
+        num_areas = int(np.prod(area_view.shape[:4]))
+        # copy through a view of the output buffer so that pixels are copied only once.
+        subinstance_list[area_i : area_i + num_areas].reshape(area_view.shape)[...] = area_view
+        subinstance_org_loc_list[area_i : area_i + num_areas] \
+            = clickable_area_locations(img_list[i].shape, i, subinstance_size, clickable_size)
+        area_i += num_areas
+
+    if area_i != expand * expand * num_subinstances:
         sys.stdout.write("ERROR: the number of subinstances is not consistent.\n")
         exit(-1)
     return subinstance_list, subinstance_org_loc_list
 
 
-def combine_subinstances(output_dir, subinstance_list, subinstance_size, clickable_size, num_subinstances_to_combine, seed=42):
+def mosaic_area_locations(perm, subinstance_size, clickable_size, num_subinstances_to_combine):
+    """ compute the locations of all the clickable areas in mosaics.
+
+    :Variables:
+        perm : numpy.array
+            perm[patch_i] is the index of the subinstance placed on the patch_i-th slot of the mosaics.
+        subinstance_size : int
+        clickable_size : int
+        num_subinstances_to_combine : int
+    :RType: numpy.array
+    :Returns:
+        mosaic_loc_list : numpy.array
+            #(sub-subinstances) x 5 integer array.
+            mosaic_loc_list[i] = (file_i, top, left, height, width) of the i-th sub-subinstance in the mosaics.
+    """
+    expand = (subinstance_size // clickable_size)
+    num_subinstances = len(perm)
+    slot = np.empty(num_subinstances, dtype=int)
+    slot[perm] = np.arange(num_subinstances)
+    file_i, cell_i = np.divmod(slot, num_subinstances_to_combine * num_subinstances_to_combine)
+    i, j = np.divmod(cell_i, num_subinstances_to_combine)
+    l, m = np.indices((expand, expand)).reshape(2, -1)
+    mosaic_loc_list = np.empty((num_subinstances, expand * expand, 5), dtype=int)
+    mosaic_loc_list[:, :, 0] = file_i[:, np.newaxis]
+    mosaic_loc_list[:, :, 1] = (subinstance_size * i)[:, np.newaxis] + l * clickable_size
+    mosaic_loc_list[:, :, 2] = (subinstance_size * j)[:, np.newaxis] + m * clickable_size
+    mosaic_loc_list[:, :, 3] = clickable_size
+    mosaic_loc_list[:, :, 4] = clickable_size
+    return mosaic_loc_list.reshape(-1, 5)
+
+def mosaic_batch_size(mosaic_shape, dtype, num_result_files, memory_budget):
+    """ the number of mosaics that can be buffered within memory_budget [MB] (at least one).
+    """
+    mosaic_bytes = int(np.prod(mosaic_shape)) * np.dtype(dtype).itemsize
+    return max(1, min(num_result_files, memory_budget * 1024 * 1024 // mosaic_bytes))
+
+def write_mosaics(output_dir, mosaic_imgs, first_file_i, executor):
+    """ encode and write mosaics concurrently. Return after all the mosaics are written.
+
+    :Variables:
+        output_dir : str
+        mosaic_imgs : numpy.array
+            mosaic_imgs[b] is written into mosaics/(first_file_i + b).jpg.
+        first_file_i : int
+        executor : concurrent.futures.Executor
+    """
+    list(executor.map(lambda b: cv2.imwrite(os.path.join(output_dir, "mosaics", str(first_file_i + b)+".jpg"), mosaic_imgs[b]),
+                      range(len(mosaic_imgs))))
+
+def combine_subinstances(output_dir, subinstance_list, subinstance_size, clickable_size, num_subinstances_to_combine, seed=42,
+                         memory_budget=256, num_workers=1, first_mosaic_id=0):
     """ combine subinstances to create a mosaic to crowdsource.
+    Mosaics are assembled in batches by one gather driven by the seeded permutation,
+    and encoded by num_workers threads.
 
     :Variables:
-        subinstance_list : list
-        subinstance_org_loc_list : list
+        subinstance_list : numpy.array
         subinstance_size : int
         clickable_size : int
         num_subinstances_to_combine : int
-    :RType: tuple of lists
+        seed : int
+        memory_budget : int
+            the amount of memory [MB] used to buffer mosaics before writing them.
+        num_workers : int
+            the number of threads to encode mosaics.
+        first_mosaic_id : int
+            the mosaics are numbered from first_mosaic_id, so that mosaics of previous runs are kept.
+    :RType: numpy.array
     :Returns:
-        mosaic_img_list : list
-            list of mosaics where each element corresponds to a mosaic in a numpy.array format.
-        mosaic_loc_list : list
-            mosaic_loc_list[i] = the location of the i-th sub-subinstance of subinstance_list in mosaic_img_list.
+        mosaic_loc_list : numpy.array
+            mosaic_loc_list[i] = the location (file_i, top, left, height, width) of the i-th sub-subinstance of subinstance_list in the mosaics.
             In other words, mosaic_loc_list and subinstance_org_loc_list share the index set.
     """
     try:
@@ -190,50 +450,396 @@ def combine_subinstances(output_dir, subinstance_list, subinstance_size, clickab
 
     expand = (subinstance_size // clickable_size)
     num_subinstances = len(subinstance_list) // (expand * expand)
-    np.random.seed(seed)
-    perm = np.random.permutation(num_subinstances)
+    # a local generator, since configurations may be combined concurrently. It draws the same permutation as np.random.seed(seed).
+    perm = np.random.RandomState(seed).permutation(num_subinstances)
     
     num_result_files = int(np.ceil(float(num_subinstances) / float(num_subinstances_to_combine * num_subinstances_to_combine)))
     print("#(mosaics) =", num_result_files)
+    mosaic_loc_list = mosaic_area_locations(perm, subinstance_size, clickable_size, num_subinstances_to_combine)
+    mosaic_loc_list[:, 0] += first_mosaic_id
 
-    mosaic_img_list = [None] * num_result_files
-    mosaic_loc_list = [None] * num_subinstances * expand * expand
-    patch_i = 0
-    for file_i in range(num_result_files):
-        mosaic_img = np.zeros((subinstance_size * num_subinstances_to_combine, subinstance_size * num_subinstances_to_combine, 3))
-        for i in range(num_subinstances_to_combine):
-            for j in range(num_subinstances_to_combine):
-                if patch_i < num_subinstances:
-                    for l in range(expand):
-                        for m in range(expand):
-                            mosaic_img[i * subinstance_size + l * clickable_size : i * subinstance_size + (l + 1) * clickable_size,
-                                       j * subinstance_size + m * clickable_size : j * subinstance_size + (m + 1) * clickable_size, :] \
-                                       = subinstance_list[perm[patch_i] * expand * expand + l * expand + m]
-                            mosaic_loc_list[perm[patch_i] * expand * expand + l * expand + m] \
-                                = (file_i, (subinstance_size * i + l * clickable_size, 
-                                            subinstance_size * j + m * clickable_size, 
-                                            clickable_size, 
-                                            clickable_size))
-                    patch_i += 1
-        cv2.imwrite(os.path.join(output_dir, "mosaics", str(file_i)+".jpg"), mosaic_img)
+    channel_shape = subinstance_list.shape[3:]
+    subinstances = subinstance_list.reshape((num_subinstances, expand, expand, clickable_size, clickable_size) + channel_shape)
+    mosaic_size = subinstance_size * num_subinstances_to_combine
+    num_buffered = mosaic_batch_size((mosaic_size, mosaic_size) + channel_shape, subinstance_list.dtype, num_result_files, memory_budget)
+    mosaic_buffer = np.zeros((num_buffered, mosaic_size, mosaic_size) + channel_shape, dtype=subinstance_list.dtype)
+    # slot_view[b, i, j, l, m] is the (l, m)-th clickable area of the (i, j)-th slot of the b-th buffered mosaic.
+    slot_view = mosaic_buffer.reshape((num_buffered,
+                                       num_subinstances_to_combine, expand, clickable_size,
+                                       num_subinstances_to_combine, expand, clickable_size) + channel_shape)\
+                             .transpose((0, 1, 4, 2, 5, 3, 6) + tuple(range(7, 7 + len(channel_shape))))
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        for first_file_i in range(0, num_result_files, num_buffered):
+            last_file_i = min(first_file_i + num_buffered, num_result_files)
+            first_patch_i = first_file_i * num_subinstances_to_combine * num_subinstances_to_combine
+            last_patch_i = min(last_file_i * num_subinstances_to_combine * num_subinstances_to_combine, num_subinstances)
+            if last_patch_i - first_patch_i < (last_file_i - first_file_i) * num_subinstances_to_combine * num_subinstances_to_combine:
+                mosaic_buffer[...] = 0
+            b, cell_i = np.divmod(np.arange(last_patch_i - first_patch_i), num_subinstances_to_combine * num_subinstances_to_combine)
+            i, j = np.divmod(cell_i, num_subinstances_to_combine)
+            slot_view[b, i, j] = subinstances[perm[first_patch_i : last_patch_i]]
+            write_mosaics(output_dir, mosaic_buffer[: last_file_i - first_file_i], first_mosaic_id + first_file_i, executor)
 
     return mosaic_loc_list
 
-def save_parameters(output_dir, args, img_list, 
-                    subinstance_org_loc_list, mosaic_loc_list):
-    """ save parameters
+def stream_subinstances(load_path, output_dir, subinstance_size, clickable_size, num_subinstances_to_combine,
+                        memory_budget=256, seed=42, num_workers=1, tiled=False, metrics=None):
+    """ streaming version of load_images, collect_subinstances and combine_subinstances.
+    Images are decoded and normalized one by one into an uint8 spool file `SPOOL_FILE_NAME` in output_dir,
+    and mosaics are assembled from memory-mapped clipping windows of the spool,
+    so that the memory usage does not grow with the number of images.
+    The mosaics and the location lists are the same as those of the batch path for the same seed.
+    If tiled is True, images (including .npy files) are read and spooled strip by strip (see iter_normalized_strips),
+    so that the memory usage does not grow with the size of an .npy image either.
+    Other images are still decoded as a whole, and a warning is printed if one is larger than memory_budget.
+
+    :Variables:
+        load_path : str
+            load path that contains images. slash at the last.
+        output_dir : str
+        subinstance_size : int
+        clickable_size : int
+        num_subinstances_to_combine : int
+        memory_budget : int
+            the amount of memory [MB] used to buffer mosaics before writing them.
+        seed : int
+        num_workers : int
+            the number of threads to decode images. At most 2 * num_workers decoded images are kept in memory.
+        tiled : bool
+        metrics : instrumentation.MetricsLogger
+            records the spooling and the assembling passes.
+    :RType: tuple
+    :Returns:
+        img_list : list
+            img_list[i] contains the i-th normalized image as a view of the spool file.
+        subinstance_org_loc_list : numpy.array
+            same as that of collect_subinstances.
+        mosaic_loc_list : numpy.array
+            same as that of combine_subinstances.
+    """
+    metrics = MetricsLogger() if metrics is None else metrics
+    try:
+        os.mkdir(os.path.join(output_dir, "mosaics"))
+    except OSError:
+        print(os.path.join(output_dir, "mosaics") + " exits... :(")
+
+    file_list = list_image_files(load_path, TILED_IMAGE_FILE_PATTERNS if tiled else IMAGE_FILE_PATTERNS)
+    num_files = len(file_list)
+    print("#(files) =", num_files)
+
+    # 1st pass: decode and normalize images one by one into the spool file.
+    spool_path = os.path.join(output_dir, SPOOL_FILE_NAME)
+    shape_list = [None] * num_files
+    offset_list = [0] * (num_files + 1)
+    num_workers = max(1, num_workers)
+    with metrics.stage("spool_images", num_items=num_files, unit="images", tiled=tiled), open(spool_path, "wb") as f:
+        if tiled:
+            for i in range(num_files):
+                reader = ImageReader(file_list[i])
+                if not file_list[i].endswith(".npy") and np.prod(reader.shape) * reader.dtype.itemsize > memory_budget * 1024 * 1024:
+                    sys.stderr.write("WARNING: " + file_list[i] + " is decoded as a whole beyond the memory budget. Convert it to .npy to read it strip by strip.\n")
+                    sys.stderr.flush()
+                for strip in iter_normalized_strips(reader, subinstance_size):
+                    f.write(strip.tobytes())
+                shape_list[i] = normalized_shape(reader.shape, subinstance_size) + reader.shape[2:]
+                offset_list[i + 1] = offset_list[i] + int(np.prod(shape_list[i]))
+                del reader
+        else:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                for first_i in range(0, num_files, 2 * num_workers):
+                    chunk = file_list[first_i : first_i + 2 * num_workers]
+                    for i, normalized_img in enumerate(executor.map(lambda each_file: load_image(each_file, True, subinstance_size), chunk),
+                                                       first_i):
+                        f.write(normalized_img.tobytes())
+                        shape_list[i] = normalized_img.shape
+                        offset_list[i + 1] = offset_list[i] + normalized_img.size
+    if offset_list[-1] == 0:
+        spool = np.zeros(0, dtype=np.uint8)
+    else:
+        spool = np.memmap(spool_path, dtype=np.uint8, mode="r")
+    img_list = [np.asarray(spool[offset_list[i] : offset_list[i + 1]]).reshape(shape_list[i]) for i in range(num_files)]
+
+    step_size = subinstance_size // 2
+    grid_list = [count_subinstances(shape_list[i], subinstance_size) for i in range(num_files)]
+    first_subinstance = np.cumsum([0] + [num_rows * num_cols for (num_rows, num_cols) in grid_list])
+    num_subinstances = int(first_subinstance[-1])
+    print("#(subinstances) =", num_subinstances)
+    subinstance_org_loc_list = np.concatenate(
+        [np.zeros((0, 5), dtype=int)]
+        + [clickable_area_locations(shape_list[i], i, subinstance_size, clickable_size) for i in range(num_files)])
+
+    # 2nd pass: assemble mosaics from clipping windows, buffering as many mosaics as memory_budget allows.
+    # the same permutation as combine_subinstances.
+    perm = np.random.RandomState(seed).permutation(num_subinstances)
+    num_result_files = int(np.ceil(float(num_subinstances) / float(num_subinstances_to_combine * num_subinstances_to_combine)))
+    print("#(mosaics) =", num_result_files)
+    mosaic_loc_list = mosaic_area_locations(perm, subinstance_size, clickable_size, num_subinstances_to_combine)
+
+    # the image and the window position of the subinstance on each slot.
+    slot_img_i = np.searchsorted(first_subinstance, perm, side="right") - 1
+    num_cols = np.array([0] + [num_cols for (_, num_cols) in grid_list])[slot_img_i + 1]
+    slot_row_i, slot_col_i = np.divmod(perm - first_subinstance[slot_img_i], np.maximum(num_cols, 1))
+
+    mosaic_size = subinstance_size * num_subinstances_to_combine
+    num_buffered = mosaic_batch_size((mosaic_size, mosaic_size, 3), np.uint8, num_result_files, memory_budget)
+    mosaic_buffer = np.zeros((num_buffered, mosaic_size, mosaic_size, 3), dtype=np.uint8)
+    with metrics.stage("assemble_mosaics", num_items=num_result_files, unit="mosaics", num_subinstances=num_subinstances), \
+         ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for first_file_i in range(0, num_result_files, num_buffered):
+            mosaic_buffer[...] = 0
+            last_file_i = min(first_file_i + num_buffered, num_result_files)
+            first_patch_i = first_file_i * num_subinstances_to_combine * num_subinstances_to_combine
+            last_patch_i = min(last_file_i * num_subinstances_to_combine * num_subinstances_to_combine, num_subinstances)
+            for patch_i in range(first_patch_i, last_patch_i):
+                b, cell_i = divmod(patch_i - first_patch_i, num_subinstances_to_combine * num_subinstances_to_combine)
+                i, j = divmod(cell_i, num_subinstances_to_combine)
+                row_i, col_i = slot_row_i[patch_i], slot_col_i[patch_i]
+                # the clickable areas of a subinstance tile its clipping window.
+                mosaic_buffer[b,
+                              i * subinstance_size : (i + 1) * subinstance_size,
+                              j * subinstance_size : (j + 1) * subinstance_size] \
+                    = img_list[slot_img_i[patch_i]][step_size * row_i : step_size * row_i + subinstance_size,
+                                                    step_size * col_i : step_size * col_i + subinstance_size]
+            write_mosaics(output_dir, mosaic_buffer[: last_file_i - first_file_i], first_file_i, executor)
+
+    return img_list, subinstance_org_loc_list, mosaic_loc_list
+
+def file_sha1(file_path):
+    """ compute the sha1 hash of a file.
+
+    :Variables:
+        file_path : str
+    :RType: str
+    :Returns:
+        the hex digest of the file contents.
+    """
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def describe_images(file_list, img_shape_list, num_workers=1, sha1_list=None):
+    """ describe images by their paths, sha1 hashes and normalized shapes, which are saved in the header of parameters.
+
+    :Variables:
+        file_list : list
+            file_list[i] is the path to the i-th image.
+        img_shape_list : list
+            img_shape_list[i] is the shape of the i-th NORMALIZED image.
+        num_workers : int
+            the number of threads to hash files.
+        sha1_list : list
+            sha1 hashes of the files if they have already been computed.
+    :RType: list
+    :Returns:
+        image_entry_list : list
+            image_entry_list[i] = {"path": absolute path, "sha1": sha1 hash, "shape": normalized shape} of the i-th image.
+    """
+    if sha1_list is None:
+        with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+            sha1_list = list(executor.map(file_sha1, file_list))
+    return [{"path": os.path.abspath(file_list[i]),
+             "sha1": sha1_list[i],
+             "shape": [int(size) for size in img_shape_list[i]]}
+            for i in range(len(file_list))]
+
+def save_parameters(output_dir, args, image_entry_list,
+                    subinstance_org_loc_list, mosaic_loc_list, run_list):
+    """ save parameters into the directory `PARAMETERS_DIR_NAME` in output_dir.
+    Images are not saved but referenced by their paths and sha1 hashes,
+    and the location lists are saved as int32 .npy files so that they can be memory-mapped.
+
+    :Variables:
+        output_dir : str
+        args : Namespace
+        image_entry_list : list
+            see describe_images.
+        subinstance_org_loc_list : numpy.array
+        mosaic_loc_list : numpy.array
+        run_list : list
+            run_list[r] = {"seed": seed, "first_image": index of the first image, "first_mosaic": index of the first mosaic}
+            of the r-th run. Runs other than the first one are incremental runs.
+    """
+    parameters_dir = os.path.join(output_dir, PARAMETERS_DIR_NAME)
+    try:
+        os.mkdir(parameters_dir)
+    except OSError:
+        print(parameters_dir + " exits... :(")
+    header = {"format_version": PARAMETERS_FORMAT_VERSION,
+              "args": vars(args),
+              "runs": run_list,
+              "images": image_entry_list}
+    np.save(os.path.join(parameters_dir, "subinstance_org_loc.npy"), np.asarray(subinstance_org_loc_list, dtype=np.int32))
+    np.save(os.path.join(parameters_dir, "mosaic_loc.npy"), np.asarray(mosaic_loc_list, dtype=np.int32))
+    # the header is written at last so that a complete header implies complete tables.
+    with open(os.path.join(parameters_dir, "header.json"), "w") as f:
+        json.dump(header, f, indent=1)
+
+def load_saved_parameters(output_dir):
+    """ load parameters saved by save_parameters in output_dir.
+
+    :Variables:
+        output_dir : str
+    :RType: tuple
+    :Returns:
+        (header, subinstance_org_loc_list, mosaic_loc_list), or (None, None, None) if there are no parameters.
+    """
+    parameters_dir = os.path.join(output_dir, PARAMETERS_DIR_NAME)
+    if not os.path.exists(os.path.join(parameters_dir, "header.json")):
+        return None, None, None
+    with open(os.path.join(parameters_dir, "header.json"), "r") as f:
+        header = json.load(f)
+    if header["format_version"] != PARAMETERS_FORMAT_VERSION:
+        raise ValueError("ERROR: unsupported format version " + str(header["format_version"]) + ".")
+    return (header,
+            np.load(os.path.join(parameters_dir, "subinstance_org_loc.npy")).astype(int),
+            np.load(os.path.join(parameters_dir, "mosaic_loc.npy")).astype(int))
+
+def cache_images(output_dir, image_entry_list, img_list):
+    """ save normalized images into `CACHE_DIR_NAME` in output_dir, keyed by their sha1 hashes.
+    The cache path is recorded in image_entry_list, so that the images can be drawn even after the files are changed.
+
+    :Variables:
+        output_dir : str
+        image_entry_list : list
+        img_list : list
+            img_list[i] is the normalized image described by image_entry_list[i].
+    """
+    try:
+        os.mkdir(os.path.join(output_dir, CACHE_DIR_NAME))
+    except OSError:
+        pass
+    for i in range(len(image_entry_list)):
+        image_entry_list[i]["cache"] = os.path.join(CACHE_DIR_NAME, image_entry_list[i]["sha1"] + ".npy")
+        np.save(os.path.join(output_dir, image_entry_list[i]["cache"]), img_list[i])
+
+def run_incremental(args, output_dir, metrics=None):
+    """ clip only images that are new or changed since the previous runs recorded in the parameters in output_dir.
+    Images are identified by their sha1 hashes. New subinstances are combined into new mosaics numbered after the existing ones,
+    and their locations are appended to the location lists, so that existing mosaics and locations stay valid.
+
+    :Variables:
+        args : Namespace
+        output_dir : str
+        metrics : instrumentation.MetricsLogger
+    """
+    metrics = MetricsLogger() if metrics is None else metrics
+    header, subinstance_org_loc_list, mosaic_loc_list = load_saved_parameters(output_dir)
+    if header is None:
+        image_entry_list = []
+        run_list = []
+        subinstance_org_loc_list = np.zeros((0, 5), dtype=int)
+        mosaic_loc_list = np.zeros((0, 5), dtype=int)
+    else:
+        image_entry_list = header["images"]
+        run_list = header.get("runs", [])
+
+    file_list = list_image_files(args.input_img_dir)
+    with metrics.stage("hash_images", num_items=len(file_list), unit="images"), \
+         ThreadPoolExecutor(max_workers=max(1, args.num_workers)) as executor:
+        sha1_list = list(executor.map(file_sha1, file_list))
+    known_sha1_set = set([each_entry["sha1"] for each_entry in image_entry_list])
+    new_file_list = []
+    for i in range(len(file_list)):
+        if sha1_list[i] not in known_sha1_set:
+            known_sha1_set.add(sha1_list[i])
+            new_file_list.append(file_list[i])
+    print("#(files) =", len(file_list))
+    print("#(new files) =", len(new_file_list))
+    if len(new_file_list) == 0:
+        return
+
+    with metrics.stage("load_images", num_items=len(new_file_list), unit="images"):
+        img_list = load_image_files(new_file_list, True, args.subinstance_size, args.num_workers)
+    with metrics.stage("cache_images", num_items=len(img_list), unit="images"):
+        new_image_entry_list = describe_images(new_file_list, [img.shape for img in img_list], args.num_workers)
+        cache_images(output_dir, new_image_entry_list, img_list)
+    with metrics.stage("collect_subinstances", unit="clickable_areas") as record:
+        subinstance_list, new_subinstance_org_loc_list = collect_subinstances(img_list,
+                                                                              args.subinstance_size,
+                                                                              args.clickable_size)
+        record["num_items"] = len(new_subinstance_org_loc_list)
+    new_subinstance_org_loc_list[:, 0] += len(image_entry_list)
+    first_mosaic_id = int(mosaic_loc_list[:, 0].max()) + 1 if len(mosaic_loc_list) > 0 else 0
+    seed = args.seed + len(run_list)
+    with metrics.stage("combine_subinstances", unit="clickable_areas") as record:
+        new_mosaic_loc_list = combine_subinstances(output_dir,
+                                                   subinstance_list,
+                                                   args.subinstance_size,
+                                                   args.clickable_size,
+                                                   args.num_subinstances_to_combine,
+                                                   seed=seed,
+                                                   memory_budget=args.memory_budget,
+                                                   num_workers=args.num_workers,
+                                                   first_mosaic_id=first_mosaic_id)
+        record["num_items"] = len(new_mosaic_loc_list)
+    run_list.append({"seed": seed, "first_image": len(image_entry_list), "first_mosaic": first_mosaic_id})
+    with metrics.stage("save_parameters", num_items=len(subinstance_org_loc_list) + len(new_subinstance_org_loc_list),
+                       unit="clickable_areas"):
+        save_parameters(output_dir, args, image_entry_list + new_image_entry_list,
+                        np.concatenate([subinstance_org_loc_list, new_subinstance_org_loc_list]),
+                        np.concatenate([mosaic_loc_list, new_mosaic_loc_list]),
+                        run_list)
+
+
+def clip_and_mix(args, output_dir, file_list, img_list, sha1_list=None, metrics=None):
+    """ apply the instance clipping protocol to NORMALIZED images, and save mosaics and parameters into output_dir.
 
     :Variables:
         args : Namespace
+            subinstance_size, clickable_size, num_subinstances_to_combine, seed, memory_budget and num_workers are used.
         output_dir : str
+        file_list : list
+            file_list[i] is the path to the i-th image.
         img_list : list
-        mosaic_img_list : list
-        subinstance_org_loc_list : list
-        mosaic_loc_list : list
+            img_list[i] is the i-th NORMALIZED image.
+        sha1_list : list
+            sha1 hashes of the files if they have already been computed.
+        metrics : instrumentation.MetricsLogger
+    """
+    metrics = MetricsLogger() if metrics is None else metrics
+    with metrics.stage("collect_subinstances", unit="clickable_areas") as record:
+        subinstance_list, subinstance_org_loc_list = collect_subinstances(img_list,
+                                                                          args.subinstance_size,
+                                                                          args.clickable_size)
+        record["num_items"] = len(subinstance_org_loc_list)
+    with metrics.stage("combine_subinstances", unit="clickable_areas") as record:
+        mosaic_loc_list = combine_subinstances(output_dir,
+                                               subinstance_list,
+                                               args.subinstance_size,
+                                               args.clickable_size,
+                                               args.num_subinstances_to_combine,
+                                               seed=args.seed,
+                                               memory_budget=args.memory_budget,
+                                               num_workers=args.num_workers)
+        record["num_items"] = len(mosaic_loc_list)
+    with metrics.stage("save_parameters", num_items=len(subinstance_org_loc_list), unit="clickable_areas"):
+        save_parameters(output_dir, args,
+                        describe_images(file_list, [img.shape for img in img_list], args.num_workers, sha1_list),
+                        subinstance_org_loc_list, mosaic_loc_list,
+                        [{"seed": args.seed, "first_image": 0, "first_mosaic": 0}])
+
+def check_sizes(subinstance_size, clickable_size):
+    """ check the sizes of the instance clipping protocol.
+
+    :Variables:
+        subinstance_size : int
+        clickable_size : int
+    :RType: str
+    :Returns:
+        an error message, or None if the sizes are valid.
     """
-    f = open(os.path.join(output_dir, 'parameters.pkl'), 'wb')
-    pickle.dump((args, img_list, subinstance_org_loc_list, mosaic_loc_list), f)
-    f.close()
+    if subinstance_size % 2 != 0:
+        return "Error: please make subinstance_size even."
+    if subinstance_size % clickable_size != 0:
+        return "Error: please make subinstance_size % clickable_size == 0."
+    return None
+
+def output_dir_name(subinstance_size, clickable_size, num_subinstances_to_combine):
+    """ the name of the directory to save results of one configuration.
+    """
+    return str(subinstance_size) + "_" + str(clickable_size) + "_" + str(num_subinstances_to_combine)
 
 
 def main():
@@ -243,36 +849,71 @@ def main():
     parser.add_argument("subinstance_size", type=int, help="The size of a clipping window [pixel].")
     parser.add_argument("clickable_size", type=int, help="The size of a clickable area [pixel].")
     parser.add_argument("num_subinstances_to_combine", type=int, help="The number of subinstances on one side of a combined image.")
+    parser.add_argument("--seed", type=int, default=42, help="A random seed to shuffle subinstances.")
+    parser.add_argument("--stream", action="store_true", help="Process images one by one in bounded memory.")
+    parser.add_argument("--tiled", action="store_true", help="Read images (.jpg and .npy) in the streaming mode. "
+                        ".npy images are read strip by strip, but a .jpg image is still decoded as a whole.")
+    parser.add_argument("--memory_budget", type=int, default=256, help="Memory [MB] to buffer mosaics. "
+                        "It does not bound decoding a .jpg image. With --tiled, a warning is printed if a decoded image exceeds it.")
+    parser.add_argument("--incremental", action="store_true", help="Clip only images that are new or changed since the previous runs.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="The number of threads to decode images and encode mosaics.")
+    parser.add_argument("--metrics_file", type=str, default=None,
+                        help="A json-lines file to append per-stage metrics. metrics.jsonl in the output directory by default, and \"\" to disable.")
     args = parser.parse_args()
-    if args.subinstance_size % 2 != 0:
-        print("Error: please make subinstance_size even.")
+    error_message = check_sizes(args.subinstance_size, args.clickable_size)
+    if error_message is not None:
+        print(error_message)
+        exit(1)
+    if args.tiled and not args.stream:
+        print("Error: --tiled must be used with --stream.")
         exit(1)
-    if args.subinstance_size % args.clickable_size != 0:
-        print("Error: please make subinstance_size % clickable_size == 0.")
+    if args.incremental and args.stream:
+        print("Error: --incremental cannot be used with --stream.")
         exit(1)
     
     command_date = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
     create_output_dir(args.output_dir,
-                      str(args.subinstance_size) + "_" + str(args.clickable_size) + "_" + str(args.num_subinstances_to_combine))
+                      output_dir_name(args.subinstance_size, args.clickable_size, args.num_subinstances_to_combine))
     output_path = os.path.join(args.output_dir,
-                             str(args.subinstance_size) + "_" + str(args.clickable_size) + "_" + str(args.num_subinstances_to_combine))
+                               output_dir_name(args.subinstance_size, args.clickable_size, args.num_subinstances_to_combine))
     print(args)
     print("Command was executed on " + command_date)
-    write_log(output_path, args, True)
-    write_log(output_path, "Command was executed on " + command_date, False)
-
-    img_list = load_images(args.input_img_dir,
-                           normalize=True,
-                           subinstance_size=args.subinstance_size)
-    subinstance_list, subinstance_org_loc_list = collect_subinstances(img_list,
-                                                                      args.subinstance_size,
-                                                                      args.clickable_size)
-    mosaic_loc_list = combine_subinstances(output_path,
-                                           subinstance_list,
-                                           args.subinstance_size,
-                                           args.clickable_size,
-                                           args.num_subinstances_to_combine)
-    save_parameters(output_path, args, img_list, subinstance_org_loc_list, mosaic_loc_list)
+    write_log(output_path, [args, "Command was executed on " + command_date], not args.incremental)
+
+    with metrics_logger(args.metrics_file, output_path, "instance_clipping_and_mixing") as metrics:
+        metrics.log("command", args=vars(args))
+        if args.incremental:
+            run_incremental(args, output_path, metrics)
+            return
+
+        if args.stream:
+            img_list, subinstance_org_loc_list, mosaic_loc_list = stream_subinstances(args.input_img_dir,
+                                                                                     output_path,
+                                                                                     args.subinstance_size,
+                                                                                     args.clickable_size,
+                                                                                     args.num_subinstances_to_combine,
+                                                                                     memory_budget=args.memory_budget,
+                                                                                     seed=args.seed,
+                                                                                     num_workers=args.num_workers,
+                                                                                     tiled=args.tiled,
+                                                                                     metrics=metrics)
+            file_list = list_image_files(args.input_img_dir, TILED_IMAGE_FILE_PATTERNS if args.tiled else IMAGE_FILE_PATTERNS)
+            with metrics.stage("save_parameters", num_items=len(subinstance_org_loc_list), unit="clickable_areas"):
+                save_parameters(output_path, args,
+                                describe_images(file_list, [img.shape for img in img_list], args.num_workers),
+                                subinstance_org_loc_list, mosaic_loc_list,
+                                [{"seed": args.seed, "first_image": 0, "first_mosaic": 0}])
+            del img_list
+            os.remove(os.path.join(output_path, SPOOL_FILE_NAME))
+            return
+
+        with metrics.stage("load_images", unit="images") as record:
+            img_list = load_images(args.input_img_dir,
+                                   normalize=True,
+                                   subinstance_size=args.subinstance_size,
+                                   num_workers=args.num_workers)
+            record["num_items"] = len(img_list)
+        clip_and_mix(args, output_path, list_image_files(args.input_img_dir), img_list, metrics=metrics)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+""" Instance clipping over multiple configurations.
+
+usage: python %s <load_img_folder/> <save_folder_name> <subinstance_size>,<clickable_size>,<num_subinstances_to_combine> ...
+Images are decoded only once and shared by all the configurations, which run concurrently.
+Results of each configuration are saved in the same way as instance_clipping_and_mixing.py.
+"""
+
+# metadata variables
+__author__ = "Hiroshi KAJINO <hiroshi.kajino.1989@gmail.com>"
+__date__ = "2014/04/14"
+__version__ = "1.0"
+__copyright__ = "Copyright (c) 2014 Hiroshi Kajino all rights reserved."
+__docformat__ = "restructuredtext en"
+
+import datetime
+import sys
+import os
+import copy
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+# instrumentation is shared with the post-processing scripts.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "post_process_for_instance_clipping_protocol"))
+from instance_clipping_and_mixing import create_output_dir, write_log, list_image_files, load_image_files, normalize_image, \
+    file_sha1, clip_and_mix, check_sizes, output_dir_name
+from instrumentation import metrics_logger
+
+
+def parse_configuration(configuration_str):
+    """ parse a configuration string.
+
+    :Variables:
+        configuration_str : str
+            "<subinstance_size>,<clickable_size>,<num_subinstances_to_combine>"
+    :RType: tuple of ints
+    :Returns:
+        (subinstance_size, clickable_size, num_subinstances_to_combine)
+    """
+    configuration = tuple(int(each_size) for each_size in configuration_str.split(","))
+    if len(configuration) != 3:
+        raise argparse.ArgumentTypeError("a configuration must be <subinstance_size>,<clickable_size>,<num_subinstances_to_combine>.")
+    error_message = check_sizes(configuration[0], configuration[1])
+    if error_message is not None:
+        raise argparse.ArgumentTypeError(error_message)
+    return configuration
+
+def run_configuration(args, configuration, file_list, raw_img_list, sha1_list, command_date):
+    """ apply the instance clipping protocol with one configuration to decoded images.
+    Metrics are written into metrics.jsonl in the directory of the configuration unless --metrics_file is "".
+
+    :Variables:
+        args : Namespace
+        configuration : tuple of ints
+            (subinstance_size, clickable_size, num_subinstances_to_combine)
+        file_list : list
+        raw_img_list : list
+            decoded images, which are shared by all the configurations and are not modified.
+        sha1_list : list
+        command_date : str
+    """
+    args_ic = copy.copy(args)
+    del args_ic.configurations
+    args_ic.subinstance_size, args_ic.clickable_size, args_ic.num_subinstances_to_combine = configuration
+    dir_name = output_dir_name(*configuration)
+    create_output_dir(args.output_dir, dir_name)
+    output_path = os.path.join(args.output_dir, dir_name)
+    write_log(output_path, [args_ic, "Command was executed on " + command_date], True)
+    with metrics_logger(None if args.metrics_file != "" else "", output_path, "instance_clipping_sweep") as metrics:
+        metrics.log("command", args=vars(args_ic))
+        with metrics.stage("normalize_images", num_items=len(raw_img_list), unit="images"):
+            img_list = [normalize_image(raw_img, args_ic.subinstance_size) for raw_img in raw_img_list]
+        clip_and_mix(args_ic, output_path, file_list, img_list, sha1_list, metrics)
+
+def main():
+    parser = argparse.ArgumentParser(description="instance clipping over multiple configurations sharing a single decode pass.")
+    parser.add_argument("input_img_dir", type=str, help="A directry of original images.")
+    parser.add_argument("output_dir", type=str, help="A directory to save clipped results and miscs.")
+    parser.add_argument("configurations", type=parse_configuration, nargs="+",
+                        help="<subinstance_size>,<clickable_size>,<num_subinstances_to_combine> of each configuration.")
+    parser.add_argument("--seed", type=int, default=42, help="A random seed to shuffle subinstances.")
+    parser.add_argument("--memory_budget", type=int, default=256, help="Memory [MB] to buffer mosaics of each configuration.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="The number of threads to decode images and encode mosaics.")
+    parser.add_argument("--num_concurrent_configurations", type=int, default=2, help="The number of configurations processed at the same time.")
+    parser.add_argument("--metrics_file", type=str, default=None,
+                        help="A json-lines file to append metrics of the shared stages. metrics.jsonl in the output directory by default, "
+                        "and \"\" to disable all metrics. Metrics of each configuration are written in its directory.")
+    args = parser.parse_args()
+
+    command_date = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
+    print(args)
+    print("Command was executed on " + command_date)
+
+    file_list = list_image_files(args.input_img_dir)
+    print("#(files) =", len(file_list))
+    with metrics_logger(args.metrics_file, args.output_dir, "instance_clipping_sweep") as metrics:
+        metrics.log("command", args=vars(args))
+        with metrics.stage("load_images", num_items=len(file_list), unit="images"):
+            raw_img_list = load_image_files(file_list, normalize=False, num_workers=args.num_workers)
+        with metrics.stage("hash_images", num_items=len(file_list), unit="images"), \
+             ThreadPoolExecutor(max_workers=max(1, args.num_workers)) as executor:
+            sha1_list = list(executor.map(file_sha1, file_list))
+    with ThreadPoolExecutor(max_workers=max(1, args.num_concurrent_configurations)) as executor:
+        futures = [executor.submit(run_configuration, args, configuration, file_list, raw_img_list, sha1_list, command_date)
+                   for configuration in args.configurations]
+        for future in futures:
+            future.result()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+""" Aggregation of binary crowd labels into positive instances.
+
+Each quality control method returns the indices of positive instances together with the posterior probabilities of positive labels,
+so that several methods can be compared on the same BinaryData, whose label counts are computed only once.
+"""
+
+# metadata variables
+__author__ = "Hiroshi KAJINO <hiroshi.kajino.1989@gmail.com>"
+__date__ = "2014/04/25"
+__version__ = "1.0"
+__copyright__ = "Copyright (c) 2014 Hiroshi Kajino all rights reserved."
+__docformat__ = "restructuredtext en"
+
+import numpy as np
+from lcmodel import LatentClassModel, fit_latent_class_model
+
+QC_METHODS = ("no", "mv", "lc")
+
+
+def aggregate_no(crowd_data):
+    """ No quality control. An instance is positive if at least one worker labels it positive.
+
+    :Variables:
+        crowd_data : crowd_data.BinaryData
+    :RType: tuple
+    :Returns:
+        (pos_ind_array, posterior), where posterior is 1.0 for positive instances and 0.0 otherwise.
+    """
+    is_pos = (crowd_data.instance_pos_count > 0)
+    return np.nonzero(is_pos)[0], is_pos.astype(float)
+
+def aggregate_mv(crowd_data, seed=None):
+    """ Majority votes. A tie, including an instance without labels, is broken by a fair coin.
+
+    :Variables:
+        crowd_data : crowd_data.BinaryData
+        seed : int
+            a random seed of the coins, or None to draw a seed from the OS.
+    :RType: tuple
+    :Returns:
+        (pos_ind_array, posterior), where posterior is the fraction of positive labels (1/2 for instances without labels).
+    """
+    pos_minus_neg = crowd_data.instance_pos_count - crowd_data.instance_neg_count
+    is_tie = (pos_minus_neg == 0)
+    is_pos = (pos_minus_neg > 0)
+    is_pos[is_tie] = (np.random.RandomState(seed).binomial(1, 0.5, size=np.count_nonzero(is_tie)) == 0)
+    posterior = crowd_data.majority_vote("prob")
+    posterior[np.isnan(posterior)] = 0.5
+    return np.nonzero(is_pos)[0], posterior
+
+def aggregate_lc(crowd_data, seed=None, lc_model=None, num_restarts=1, num_workers=1, eps=10 ** (-10), metrics=None, worker_ids=None,
+                 **run_em_kwargs):
+    """ The latent class model (Dawid and Skene, 1979). An instance is positive if its posterior probability is larger than 1/2.
+
+    :Variables:
+        crowd_data : crowd_data.BinaryData
+        seed : int
+            a random seed of the randomized initializations of restarts.
+        lc_model : lcmodel.LatentClassModel or lcmodel.FittedLatentClassModel
+            a previously fitted model to warm-start EM, or None. It cannot be combined with restarts.
+        num_restarts : int
+            the number of EM restarts, which run in `num_workers` processes.
+        num_workers : int
+        eps : float
+            tolerable relative errors on the Q-function.
+        metrics : instrumentation.MetricsLogger
+        worker_ids : list
+            ids of the workers of crowd_data. If given and lc_model has worker ids, workers are matched by their ids in the warm start.
+        run_em_kwargs : dict
+            keyword arguments of LatentClassModel.run_em, e.g., max_iter, time_budget or accelerate.
+    :RType: tuple
+    :Returns:
+        (pos_ind_array, posterior, lc), where lc is the fitted LatentClassModel.
+    """
+    if num_restarts > 1:
+        if lc_model is not None:
+            raise ValueError("ERROR: a warm start cannot be combined with restarts.")
+        lc, _ = fit_latent_class_model(crowd_data, num_restarts, num_workers, 0 if seed is None else seed, eps=eps, metrics=metrics,
+                                       **run_em_kwargs)
+    else:
+        lc = LatentClassModel(crowd_data)
+        if lc_model is not None:
+            if worker_ids is not None and getattr(lc_model, "worker_ids", None) is not None:
+                lc.warm_start(lc_model, lc_model.worker_index(worker_ids))
+            else:
+                lc.warm_start(lc_model)
+        lc.run_em(eps, metrics=metrics, **run_em_kwargs)
+    return np.nonzero(lc.estimated_labels(0.5) == 1)[0], np.exp(lc.log_mu[0, :]), lc
+
+def aggregate(crowd_data, qc_method, seed=None, **lc_kwargs):
+    """ Aggregate labels by a quality control method.
+
+    :Variables:
+        crowd_data : crowd_data.BinaryData
+        qc_method : str
+            either {no, mv, lc}.
+        seed : int
+            a random seed of mv and lc.
+        lc_kwargs : dict
+            keyword arguments of aggregate_lc.
+    :RType: tuple
+    :Returns:
+        (pos_ind_array, posterior, lc), where lc is the fitted LatentClassModel for lc, and None otherwise.
+    """
+    if qc_method == "no":
+        return aggregate_no(crowd_data) + (None,)
+    elif qc_method == "mv":
+        return aggregate_mv(crowd_data, seed) + (None,)
+    elif qc_method == "lc":
+        return aggregate_lc(crowd_data, seed, **lc_kwargs)
+    else:
+        raise ValueError("ERROR: qc_method must be either {no, mv, lc}.")
+
+def aggregate_all(crowd_data, qc_methods=QC_METHODS, seed=None, **lc_kwargs):
+    """ Aggregate labels by several quality control methods on the same data.
+
+    :Variables:
+        crowd_data : crowd_data.BinaryData
+        qc_methods : list
+        seed : int
+        lc_kwargs : dict
+    :RType: dict
+    :Returns: a dict from each method to (pos_ind_array, posterior, lc) returned by aggregate.
+    """
+    return dict((qc_method, aggregate(crowd_data, qc_method, seed, **lc_kwargs)) for qc_method in qc_methods)
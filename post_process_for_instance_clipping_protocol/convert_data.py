@@ -39,16 +39,26 @@ import pickle
 import sys
 import os
 import glob
-import re
 import os.path
 import argparse
 import datetime
-from utils import load_pickle_files
+import scipy.sparse
+from utils import load_pickle_files, load_converted_result, load_parameters, as_loc_array
+from mosaic_index import MosaicIndex
+from crowd_data import as_sparse_result_array, SparseResultArray, ParsedResultArray
+from instrumentation import metrics_logger
+from import_crowd_results import read_crowd_results
+
+CONVERT_CHUNK_SIZE = 65536
 
 
 def convert_to_crowd_data(subinstance_size, clickable_size, num_instances_to_combine,
-                          subinstance_org_loc_list, mosaic_loc_list,  result_array, instance_ids):
+                          subinstance_org_loc_list, mosaic_loc_list,  result_array, instance_ids, dense=False,
+                          num_responses_per_chunk=CONVERT_CHUNK_SIZE):
     """ Convert a raw result_array into crowd_data where an instance is indexed by a clickable area in the original images.
+    In a response on a mosaic, clicked cells are positive and the other cells are negative.
+    A label on the clickable area of the same original location overwrites earlier ones, in the row-major order of the result array,
+    and negatives overwrite positives within a response. Labels on cells without patches (e.g., padding cells of the last mosaic) are skipped.
 
     :Variables:
         subinstance_size : int
@@ -57,118 +67,224 @@ def convert_to_crowd_data(subinstance_size, clickable_size, num_instances_to_com
             the size of a clickable area
         num_instances_to_combine : int
             the number of subinstances on one side of a combined image.
-        subinstance_org_loc_list : list
+        subinstance_org_loc_list : list or numpy.array
             a list containing the place in the original image the i-th subsubinstance was.
-        mosaic_loc_list : list
+        mosaic_loc_list : list or numpy.array
             a list containing the place in the mosaic image the i-th subsubinstance was.
-        result_array : numpy.array
-            result_array obtained from import-lancers-integrate-output.py
+        result_array : crowd_data.ParsedResultArray, crowd_data.SparseResultArray or numpy.array
+            parsed results or result_array obtained from import_crowd_results.py. The latter is parsed here.
         instance_ids : list
             the i-th row of result_array corresponds to instance_ids[i]
+        dense : bool
+            if True, converted_result_array is a dense float array. Otherwise, it is an int8 csr_matrix.
+        num_responses_per_chunk : int
+            the number of responses converted at once, which bounds the memory usage.
     :RType: crowd_data
     :Returns:
         (org_loc_list_without_repetition, converted_result_array)
-        org_loc_list_without_repetition : list
-            A list deleting repetitions in subinstance_org_loc_list.
+        org_loc_list_without_repetition : numpy.array
+            #(distinct locations) x 5 integer array of the sorted distinct rows of subinstance_org_loc_list.
+        converted_result_array : scipy.sparse.csr_matrix or numpy.array
+            #(org_loc_list_without_repetition) x #(workers) array whose elements are 1 (positive), -1 (negative) or 0 (no label).
     """
-    org_loc_list_without_repetition = list(set(subinstance_org_loc_list))
-    converted_result_array = np.zeros((len(org_loc_list_without_repetition), result_array.shape[1]))
-    
-    # create a pos_labels & neg_labels that contain the ids of positive & negative instances
-    pat_space = re.compile(' ')
-    pat_unsco = re.compile('_')
-    pat_per = re.compile('\.')
-    all_labels = set([]) # this is necessary in order to obtain NEGATIVE labels.
+    mosaic_index = MosaicIndex.from_loc_lists(subinstance_org_loc_list, mosaic_loc_list,
+                                              subinstance_size, clickable_size, num_instances_to_combine)
+    org_loc_list_without_repetition, area_to_instance = np.unique(np.asarray(as_loc_array(subinstance_org_loc_list)).reshape(-1, 5),
+                                                                  axis=0, return_inverse=True)
+    area_to_instance = area_to_instance.ravel()
+    if not isinstance(result_array, ParsedResultArray):
+        result_array = ParsedResultArray.from_result_array(list(range(result_array.shape[1])), instance_ids, result_array)
+    num_workers = result_array.shape[1]
+
+    # cell_to_instance[mosaic_id, row * num_cells + col] is the instance on the cell, or -1 if no patch is placed on it.
+    num_cells = int(num_instances_to_combine * (subinstance_size // clickable_size))
+    cell_row, cell_col = np.divmod(np.arange(num_cells * num_cells), num_cells)
+    cell_to_area = mosaic_index.mosaic_to_area(np.arange(mosaic_index.num_mosaics)[:, np.newaxis], cell_row, cell_col)
+    cell_to_instance = np.where(cell_to_area >= 0, area_to_instance[np.maximum(cell_to_area, 0)], -1).reshape(-1, num_cells * num_cells)
+
+    # responses in the row-major order of the dense result array.
+    order = np.lexsort((np.asarray(result_array.worker_index), np.asarray(result_array.instance_index)))
     num_pos = 0
     num_neg = 0
-    num_all = 0
-    for k in range(int(num_instances_to_combine * (subinstance_size / clickable_size))):
-        for l in range(int(num_instances_to_combine * (subinstance_size / clickable_size))):
-            all_labels.add((k, l))
-    
-    for i in range(result_array.shape[0]):
-        tmp = os.path.basename(instance_ids[i])
-        # instance_ids[i] = 'https://dl.dropboxusercontent.com/u/17481238/20130930/performance_50/htmls/99.25.html'
-        mosaic_id = int(pat_per.split(tmp)[0])
-        for j in range(result_array.shape[1]):
-            if result_array[i][j] is not None:
-                tmp = pat_space.split(result_array[i][j])[1:] # [0] = elapsed time, ["01_00", "02_03"]
-                pos_tmp = set([]) # necessary to calculate neg_labels.
-                for k in tmp:
-                    fine_row = int(pat_unsco.split(k)[0])
-                    fine_col = int(pat_unsco.split(k)[1])
-                    pos_tmp.add((fine_row, fine_col))
-                num_pos += len(pos_tmp)
-                neg_tmp = list(all_labels.difference(pos_tmp))
-                num_neg += len(neg_tmp)
-                num_all += len(all_labels)
-
-                for pos in pos_tmp:
-                    try:
-                        ind = mosaic_loc_list.index(
-                            (mosaic_id,
-                             (clickable_size * pos[0],
-                              clickable_size * pos[1],
-                              clickable_size,
-                              clickable_size)))
-                    except ValueError:
-                        print((mosaic_id,
-                               (clickable_size * pos[0],
-                                clickable_size * pos[1],
-                                clickable_size,
-                                clickable_size)))
-                    org_loc = subinstance_org_loc_list[ind]
-                    ind_wo_repetition = org_loc_list_without_repetition.index(org_loc)
-                    converted_result_array[ind_wo_repetition, j] = 1
-
-                for neg in neg_tmp:
-                    try:
-                        ind = mosaic_loc_list.index(
-                            (mosaic_id,
-                             (clickable_size * neg[0],
-                              clickable_size * neg[1],
-                              clickable_size,
-                              clickable_size)))
-                    except ValueError:
-                        print((mosaic_id,
-                               (clickable_size * neg[0],
-                                clickable_size * neg[1],
-                                clickable_size,
-                                clickable_size)))
-                    org_loc = subinstance_org_loc_list[ind]
-                    ind_wo_repetition = org_loc_list_without_repetition.index(org_loc)
-                    converted_result_array[ind_wo_repetition, j] = -1
+    num_skipped = 0
+    element_list = []
+    sequence_list = []
+    label_list = []
+    for first_k in range(0, len(order), num_responses_per_chunk):
+        response_k = order[first_k : first_k + num_responses_per_chunk]
+        mosaic_id = np.asarray(result_array.mosaic_index)[response_k]
+        if (mosaic_id < 0).any():
+            raise ValueError("ERROR: " + str(result_array.instance_ids[result_array.instance_index[response_k[mosaic_id < 0][0]]])
+                             + " is not a mosaic.")
+
+        # clicked[r, cell] is True if the cell is clicked in the r-th response of the chunk.
+        click_first = np.asarray(result_array.click_indptr)[response_k]
+        num_clicks = np.asarray(result_array.click_indptr)[response_k + 1] - click_first
+        click_owner = np.repeat(np.arange(len(response_k)), num_clicks)
+        click_k = np.arange(num_clicks.sum()) - np.repeat(np.cumsum(num_clicks) - num_clicks - click_first, num_clicks)
+        cells = np.asarray(result_array.click_cells)[click_k].reshape(-1, 2)
+        in_grid = (cells >= 0).all(axis=1) & (cells < num_cells).all(axis=1)
+        clicked = np.zeros((len(response_k), num_cells * num_cells), dtype=bool)
+        clicked[click_owner[in_grid], cells[in_grid, 0] * num_cells + cells[in_grid, 1]] = True
+        num_pos += int(clicked.sum())
+        num_neg += int(clicked.size - clicked.sum())
+
+        instance_i = np.where((mosaic_id < mosaic_index.num_mosaics)[:, np.newaxis],
+                              cell_to_instance[np.minimum(mosaic_id, mosaic_index.num_mosaics - 1)] if mosaic_index.num_mosaics > 0 else -1,
+                              -1)
+        instance_i = np.broadcast_to(instance_i, clicked.shape)
+        valid = instance_i >= 0
+        num_skipped += int(valid.size - valid.sum())
+        # a later response, and a negative in the same response, has a larger sequence number.
+        sequence = 2 * (first_k + np.arange(len(response_k)))[:, np.newaxis] + (~clicked)
+        worker_j = np.asarray(result_array.worker_index)[response_k][:, np.newaxis]
+        element_list.append((instance_i * num_workers + worker_j)[valid])
+        sequence_list.append(sequence[valid])
+        label_list.append(np.where(clicked, 1, -1)[valid].astype(np.int8))
+
+    element = np.concatenate([np.zeros(0, dtype=int)] + element_list)
+    sequence = np.concatenate([np.zeros(0, dtype=int)] + sequence_list)
+    label = np.concatenate([np.zeros(0, dtype=np.int8)] + label_list)
+    # last-write-wins: keep the label with the largest sequence number of each element.
+    last = np.lexsort((sequence, element))
+    last = last[np.append(element[last][1:] != element[last][:-1], True)] if len(last) > 0 else last
+    converted_result_array = scipy.sparse.csr_matrix((label[last], np.divmod(element[last], num_workers)),
+                                                     shape=(len(org_loc_list_without_repetition), num_workers))
+    if dense:
+        converted_result_array = converted_result_array.toarray().astype(float)
 
     print("num_pos =", num_pos)
     print("num_neg =", num_neg)
-    print("num_all =", num_all)
+    print("num_all =", num_pos + num_neg)
+    print("#(labels on cells without patches) =", num_skipped)
     return (org_loc_list_without_repetition, converted_result_array)
 
+def append_converted_result(org_loc_list_without_repetition, converted_result_array, worker_ids,
+                            new_org_loc_list_without_repetition, new_converted_result_array, new_worker_ids, dense=False):
+    """ append a converted result of new responses to an existing one.
+    The worker axis grows by new workers, and the instance axis grows by new locations (e.g., of images clipped incrementally).
+    A new label overwrites an existing label of the same worker on the same location.
+
+    :Variables:
+        org_loc_list_without_repetition : list or numpy.array
+        converted_result_array : scipy.sparse matrix or numpy.array
+        worker_ids : list
+        new_org_loc_list_without_repetition : list or numpy.array
+        new_converted_result_array : scipy.sparse matrix or numpy.array
+        new_worker_ids : list
+        dense : bool
+    :RType: tuple
+    :Returns:
+        (org_loc_list_without_repetition, converted_result_array, worker_ids) of the appended result,
+        in the same format as convert_to_crowd_data.
+    """
+    worker_ids = list(worker_ids)
+    worker_dict = dict(zip(worker_ids, range(len(worker_ids))))
+    for each_id in new_worker_ids:
+        if each_id not in worker_dict:
+            worker_dict[each_id] = len(worker_ids)
+            worker_ids.append(each_id)
+    new_worker_j = np.array([worker_dict[each_id] for each_id in new_worker_ids], dtype=int)
+
+    old_loc_array = np.asarray(as_loc_array(org_loc_list_without_repetition)).reshape(-1, 5)
+    new_loc_array = np.asarray(as_loc_array(new_org_loc_list_without_repetition)).reshape(-1, 5)
+    merged_loc_array, merged_i = np.unique(np.concatenate([old_loc_array, new_loc_array]), axis=0, return_inverse=True)
+    merged_i = merged_i.ravel()
+
+    old_coo = scipy.sparse.coo_matrix(converted_result_array)
+    new_coo = scipy.sparse.coo_matrix(new_converted_result_array)
+    # existing labels first, so that new labels win.
+    row = np.concatenate([merged_i[old_coo.row], merged_i[len(old_loc_array) + new_coo.row]])
+    col = np.concatenate([old_coo.col, new_worker_j[new_coo.col]])
+    label = np.concatenate([old_coo.data, new_coo.data]).astype(np.int8)
+    element = row * len(worker_ids) + col
+    last = np.lexsort((np.arange(len(element)), element))
+    last = last[np.append(element[last][1:] != element[last][:-1], True)] if len(last) > 0 else last
+    appended_result_array = scipy.sparse.csr_matrix((label[last], (row[last], col[last])),
+                                                    shape=(len(merged_loc_array), len(worker_ids)))
+    appended_result_array.eliminate_zeros()
+    if dense:
+        appended_result_array = appended_result_array.toarray().astype(float)
+    return (merged_loc_array, appended_result_array, worker_ids)
+
+def load_results(lancers_result):
+    """ load crowdsourced results to convert.
+
+    :Variables:
+        lancers_result : str
+            a parsed_results directory or workers_result.pickle created by import_crowd_results.py,
+            or a csv file obtained from the platform, whose instances have one input and one answer.
+    :RType: tuple
+    :Returns:
+        (worker_ids, instance_ids, result_array)
+    """
+    if os.path.isdir(lancers_result):
+        result_array = ParsedResultArray.load(lancers_result)
+        return (result_array.worker_ids, result_array.instance_ids, result_array)
+    if lancers_result.endswith(".csv"):
+        worker_ids, instance_ids, response_list = read_crowd_results(lancers_result, 1, 1)
+        result_array = ParsedResultArray.from_result_array(worker_ids, instance_ids,
+                                                           SparseResultArray((len(instance_ids), len(worker_ids)),
+                                                                             [instance_i for (instance_i, _, _) in response_list],
+                                                                             [worker_i for (_, worker_i, _) in response_list],
+                                                                             [answer for (_, _, answer) in response_list]))
+        return (worker_ids, instance_ids, result_array)
+    worker_ids, instance_ids, result_array = load_pickle_files(lancers_result)
+    return (worker_ids, instance_ids, as_sparse_result_array(result_array))
+
 def main():
     parser = argparse.ArgumentParser(description="Convert lancers_result.pkl to more friendly data, using parameters.pkl.")
-    parser.add_argument("parameters_file", type=str, help="parameters.pkl created by instance_clipping_and_mixing.py")
-    parser.add_argument("lancers_result", type=str, help="lancers_result.pkl created by import_crowd_results.py")
+    parser.add_argument("parameters_file", type=str, help="parameters directory (or legacy parameters.pkl) created by instance_clipping_and_mixing.py")
+    parser.add_argument("lancers_result", type=str,
+                        help="parsed_results directory (or workers_result.pickle) created by import_crowd_results.py, or a csv file.")
     parser.add_argument("save_dir", type=str, help="A directory to save clipped results and miscs.")
+    parser.add_argument("--dense", action="store_true", help="Save a dense converted_result_array, which is only suitable for small jobs.")
+    parser.add_argument("--append", type=str, default=None,
+                        help="An existing converted_result.pkl. Only lancers_result is converted and appended to it.")
+    parser.add_argument("--metrics_file", type=str, default=None,
+                        help="A json-lines file to append per-stage metrics. metrics.jsonl in save_dir by default, and \"\" to disable.")
     args = parser.parse_args()
     
     command_date = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
     print(args)
     print("Command was executed on " + command_date)
     
-    args_ic, _, subinstance_org_loc_list, mosaic_loc_list \
-        = load_pickle_files(args.parameters_file)
-    worker_ids, instance_ids, result_array \
-        = load_pickle_files(args.lancers_result)
-    org_loc_list_without_repetition, converted_result_array \
-        = convert_to_crowd_data(args_ic.subinstance_size,
-                                args_ic.clickable_size,
-                                args_ic.num_subinstances_to_combine,
-                                subinstance_org_loc_list,
-                                mosaic_loc_list,
-                                result_array,
-                                instance_ids)
-    with open(os.path.join(args.save_dir, "converted_result.pkl"), "wb") as f:
-        pickle.dump((org_loc_list_without_repetition, converted_result_array), f)
+    with metrics_logger(args.metrics_file, args.save_dir, "convert_data") as metrics:
+        metrics.log("command", args=vars(args))
+        with metrics.stage("load_parameters", unit="clickable_areas") as record:
+            args_ic, _, subinstance_org_loc_list, mosaic_loc_list \
+                = load_parameters(args.parameters_file)
+            record["num_items"] = len(subinstance_org_loc_list)
+        with metrics.stage("load_results", unit="instances") as record:
+            worker_ids, instance_ids, result_array = load_results(args.lancers_result)
+            record["num_items"] = len(instance_ids)
+            record["num_workers"] = len(worker_ids)
+        with metrics.stage("convert_to_crowd_data", unit="responses") as record:
+            org_loc_list_without_repetition, converted_result_array \
+                = convert_to_crowd_data(args_ic.subinstance_size,
+                                        args_ic.clickable_size,
+                                        args_ic.num_subinstances_to_combine,
+                                        subinstance_org_loc_list,
+                                        mosaic_loc_list,
+                                        result_array,
+                                        instance_ids,
+                                        args.dense)
+            record["num_items"] = result_array.nnz
+            record["num_instances"] = len(org_loc_list_without_repetition)
+        if args.append is not None:
+            with metrics.stage("append_converted_result", unit="instances") as record:
+                existing_org_loc_list, existing_result_array, existing_worker_ids = load_converted_result(args.append)
+                if existing_worker_ids is None:
+                    raise ValueError("ERROR: " + args.append + " does not contain worker IDs. Please convert all the results again.")
+                org_loc_list_without_repetition, converted_result_array, worker_ids \
+                    = append_converted_result(existing_org_loc_list, existing_result_array, existing_worker_ids,
+                                              org_loc_list_without_repetition, converted_result_array, worker_ids,
+                                              args.dense)
+                record["num_items"] = len(org_loc_list_without_repetition)
+                record["num_workers"] = len(worker_ids)
+        with metrics.stage("save_converted_result", num_items=len(org_loc_list_without_repetition), unit="instances"), \
+             open(os.path.join(args.save_dir, "converted_result.pkl"), "wb") as f:
+            pickle.dump((org_loc_list_without_repetition, converted_result_array, [str(each_id) for each_id in worker_ids]), f)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-""" Binary data class for crowdsourced training data.
+""" Binary and categorical data classes for crowdsourced training data, and sparse arrays of raw and parsed results.
 """
 
 # metadata variables
@@ -9,63 +9,399 @@ __version__ = "1.0"
 __copyright__ = "Copyright (c) 2013 Hiroshi Kajino all rights reserved."
 __docformat__ = "restructuredtext en"
 
+import os
 import sys
 import numpy as np
+import scipy.sparse
+from utils import save_array_dir, load_array_dir
 
 DEBUG=1
+PARSED_RESULT_FORMAT_VERSION = 1
+
+
+class SparseResultArray:
+    """ Sparse #(instances) x #(workers) array of raw results, which replaces a dense object array that is almost all None.
+    Results are kept as COO triplets in the order they are added.
+
+    :IVariables:
+        shape : tuple
+            (num_instances, num_workers)
+        instance_index : numpy.array
+            instance_index[k] is the instance (row) of the k-th result.
+        worker_index : numpy.array
+            worker_index[k] is the worker (column) of the k-th result.
+        answer_list : list
+            answer_list[k] is the k-th result, e.g., "21.987 04_04 04_06".
+    """
+    def __init__(self, shape, instance_index, worker_index, answer_list):
+        if not (len(instance_index) == len(worker_index) == len(answer_list)):
+            raise ValueError("ERROR: the lengths of the triplets are different.")
+        self.shape = tuple(shape)
+        self.instance_index = np.asarray(instance_index, dtype=int)
+        self.worker_index = np.asarray(worker_index, dtype=int)
+        self.answer_list = list(answer_list)
+
+    @classmethod
+    def from_dense(cls, result_array):
+        """ create a sparse array from a dense object array, where None means no result.
+        """
+        instance_index, worker_index = np.nonzero(result_array != None) # elementwise on an object array.
+        return cls(result_array.shape, instance_index, worker_index,
+                   [result_array[i, j] for (i, j) in zip(instance_index, worker_index)])
+
+    @property
+    def nnz(self):
+        """ the number of results.
+        """
+        return len(self.answer_list)
+
+    def iter_results(self):
+        """ iterate (instance, worker, answer) in the row-major order, the order of the dense array.
+        Results on the same cell are iterated in the order they are added.
+        """
+        order = np.lexsort((self.worker_index, self.instance_index))
+        for k in order:
+            yield (int(self.instance_index[k]), int(self.worker_index[k]), self.answer_list[k])
+
+    def to_dense(self):
+        """ return a dense object array, where None means no result. A later result on the same cell overwrites earlier ones.
+        """
+        result_array = np.empty(self.shape, dtype=object)
+        for k in range(self.nnz):
+            result_array[self.instance_index[k], self.worker_index[k]] = self.answer_list[k]
+        return result_array
+
+
+def as_sparse_result_array(result_array):
+    """ return result_array as a SparseResultArray, converting it if it is a dense object array.
+    """
+    if isinstance(result_array, SparseResultArray):
+        return result_array
+    return SparseResultArray.from_dense(result_array)
+
+
+class ParsedResultArray:
+    """ Click answers parsed once into columns, so that they are not re-tokenized by every consumer.
+    An answer "21.987 04_04 04_06" of a worker on a mosaic is parsed into the elapsed time 21.987 [sec]
+    and the clicked cells (4, 4) and (4, 6) in the unit of clickable areas.
+
+    :IVariables:
+        worker_ids : list
+        instance_ids : list
+        shape : tuple
+            (num_instances, num_workers)
+        instance_index : numpy.array
+            instance_index[k] is the instance (row of the result array) of the k-th response.
+        worker_index : numpy.array
+            worker_index[k] is the worker of the k-th response.
+        mosaic_index : numpy.array
+            mosaic_index[k] is the mosaic shown in the k-th response, or -1 if the instance id is not a mosaic.
+        elapsed_time : numpy.array
+            elapsed_time[k] is the elapsed time of the k-th response, or nan if it is not given.
+        click_indptr : numpy.array
+            the cells clicked in the k-th response are click_cells[click_indptr[k] : click_indptr[k + 1]].
+        click_cells : numpy.array
+            #(clicks) x 2 array, whose rows are (row, col) of clicked cells.
+    """
+    def __init__(self, worker_ids, instance_ids, instance_index, worker_index, mosaic_index, elapsed_time, click_indptr, click_cells):
+        self.worker_ids = list(worker_ids)
+        self.instance_ids = list(instance_ids)
+        self.shape = (len(self.instance_ids), len(self.worker_ids))
+        self.instance_index = instance_index
+        self.worker_index = worker_index
+        self.mosaic_index = mosaic_index
+        self.elapsed_time = elapsed_time
+        self.click_indptr = click_indptr
+        self.click_cells = click_cells
+
+    @property
+    def nnz(self):
+        """ the number of responses.
+        """
+        return len(self.instance_index)
+
+    @classmethod
+    def from_result_array(cls, worker_ids, instance_ids, result_array):
+        """ parse a result array obtained from import_crowd_results.py.
+
+        :Variables:
+            worker_ids : list
+            instance_ids : list
+                instance_ids[i] = 'https://.../htmls/99.25.html' means the 99th mosaic.
+            result_array : SparseResultArray or numpy.array
+        :RType: ParsedResultArray
+        """
+        result_array = as_sparse_result_array(result_array)
+        mosaic_id_list = [_mosaic_id(each_id) for each_id in instance_ids]
+        elapsed_time = np.zeros(result_array.nnz, dtype=np.float32)
+        click_indptr = np.zeros(result_array.nnz + 1, dtype=np.int64)
+        click_list = []
+        for k in range(result_array.nnz):
+            answer = result_array.answer_list[k]
+            if not isinstance(answer, str):
+                raise ValueError("ERROR: only single answers can be parsed into clicks.")
+            token_list = answer.split() # [0] = elapsed time, ["01_00", "02_03"]
+            elapsed_time[k] = float(token_list[0]) if len(token_list) > 0 else np.nan
+            for each_token in token_list[1:]:
+                fine_row, fine_col = each_token.split("_")
+                click_list.append((int(fine_row), int(fine_col)))
+            click_indptr[k + 1] = len(click_list)
+        return cls(worker_ids, instance_ids,
+                   result_array.instance_index.astype(np.int32),
+                   result_array.worker_index.astype(np.int32),
+                   np.array(mosaic_id_list, dtype=np.int32)[result_array.instance_index],
+                   elapsed_time,
+                   click_indptr,
+                   np.array(click_list, dtype=np.int32).reshape(-1, 2))
+
+    def clicks(self, k):
+        """ the clicked cells of the k-th response, as a #(clicks) x 2 array.
+        """
+        return self.click_cells[self.click_indptr[k] : self.click_indptr[k + 1]]
+
+    def save(self, save_dir):
+        """ save into a directory as .npy files with header.json, which can be memory-mapped by load.
+        """
+        save_array_dir(save_dir,
+                       {"format_version": PARSED_RESULT_FORMAT_VERSION,
+                        "worker_ids": [str(each_id) for each_id in self.worker_ids],
+                        "instance_ids": self.instance_ids},
+                       {"instance_index": self.instance_index,
+                        "worker_index": self.worker_index,
+                        "mosaic_index": self.mosaic_index,
+                        "elapsed_time": self.elapsed_time,
+                        "click_indptr": self.click_indptr,
+                        "click_cells": self.click_cells})
+
+    @classmethod
+    def load(cls, load_dir, mmap_mode="r"):
+        """ load a ParsedResultArray saved by save.
+
+        :Variables:
+            load_dir : str
+            mmap_mode : str
+                mmap_mode passed to numpy.load. None to read the arrays into memory.
+        :RType: ParsedResultArray
+        """
+        header, array_dict = load_array_dir(load_dir, mmap_mode)
+        if header["format_version"] != PARSED_RESULT_FORMAT_VERSION:
+            raise ValueError("ERROR: unsupported format version " + str(header["format_version"]) + ".")
+        return cls(header["worker_ids"], header["instance_ids"],
+                   array_dict["instance_index"], array_dict["worker_index"], array_dict["mosaic_index"],
+                   array_dict["elapsed_time"], array_dict["click_indptr"], array_dict["click_cells"])
+
+
+def _mosaic_id(instance_id):
+    """ the mosaic id in an instance id 'https://.../htmls/99.25.html', or -1 if it is not a mosaic.
+    """
+    if not isinstance(instance_id, str):
+        return -1
+    try:
+        return int(os.path.basename(instance_id).split(".")[0])
+    except ValueError:
+        return -1
 
 
 class BinaryData:
     """ Binary crowd data class without feature vectors.
+    The numbers of positive and negative labels of each instance and each worker are counted once at construction,
+    so that majority votes and worker statistics take O(num_instances) or O(num_workers) time.
+    The response array must not be modified after construction.
 
     :IVariables:
         num_instances : int
             the number of instances.
         num_workers : int
             the number of workers.
-        y : numpy.array
-            num_instances * num_workers numpy.array. Each column corresponds to each worker's label.
-            y[i,j] == 0 if worker j doesn't label data i.
-            y[i,j] == 1, or -1 if worker j labels data i.
+        response_array : numpy.array or scipy.sparse.csr_matrix
+            num_instances * num_workers int8 array. Each column corresponds to each worker's label.
+            response_array[i,j] == 0 if worker j doesn't label data i.
+            response_array[i,j] == 1, or -1 if worker j labels data i.
+            A sparse array is stored as an int8 csr_matrix.
+        instance_pos_count : numpy.array
+        instance_neg_count : numpy.array
+            numpy.arrays of length `num_instances`, the numbers of positive and negative labels given to each instance.
+        worker_pos_count : numpy.array
+        worker_neg_count : numpy.array
+            numpy.arrays of length `num_workers`, the numbers of positive and negative labels given by each worker.
     """
     def __init__(self, response_array):
         """ Initialization
         """
+        if scipy.sparse.issparse(response_array):
+            response_array = scipy.sparse.csr_matrix(response_array, dtype=np.int8)
+        else:
+            response_array = np.asarray(response_array)
+            if response_array.dtype != np.int8:
+                response_array = response_array.astype(np.int8)
         self.response_array = response_array
         self.num_instances = response_array.shape[0]
         self.num_workers = response_array.shape[1]
-        
+
+        instance_index, worker_index, label = self.observed_entries()
+        if not np.all((label == 1) | (label == -1)):
+            raise ValueError("ERROR: response_array must consist of 1 (positive), -1 (negative) and 0 (no label).")
+        is_pos = (label == 1)
+        self.instance_pos_count = np.bincount(instance_index[is_pos], minlength=self.num_instances)
+        self.instance_neg_count = np.bincount(instance_index[~is_pos], minlength=self.num_instances)
+        self.worker_pos_count = np.bincount(worker_index[is_pos], minlength=self.num_workers)
+        self.worker_neg_count = np.bincount(worker_index[~is_pos], minlength=self.num_workers)
+        if DEBUG == 1:
+            if self.instance_pos_count.sum() + self.instance_neg_count.sum() != len(label) \
+               or self.worker_pos_count.sum() + self.worker_neg_count.sum() != len(label):
+                sys.stderr.write("ERROR: wrong counts")
+                exit(0)
+
+    def observed_entries(self):
+        """ Return the observed labels as (instance, worker, label) triplets.
+
+        :RType: tuple of numpy.arrays
+        :Returns:
+            (instance_index, worker_index, label), each of which is an int array of length #(observed labels),
+            where label[k] = response_array[instance_index[k], worker_index[k]] is 1 or -1.
+        """
+        if scipy.sparse.issparse(self.response_array):
+            instance_index, worker_index, label = scipy.sparse.find(self.response_array)
+        else:
+            instance_index, worker_index = np.nonzero(self.response_array)
+            label = self.response_array[instance_index, worker_index]
+        return instance_index.astype(np.intp), worker_index.astype(np.intp), np.asarray(label).astype(np.int8)
+
     def majority_vote(self, prob):
         """ Return the (soft/hard) majority votes
         
         :Variables:
             prob : str
-                if prob = "prob", then return probabilities of positive labels.
-                if prob = "log_prob", then return log probabilities of positive labels.
-                if prob = "no", then return the majority voted labels.
+                if prob = "prob", then return probabilities of positive labels (nan for instances without labels).
+                if prob = "log_prob", then return log probabilities of positive and negative labels.
+                if prob = "no", then return the majority voted labels (0 for ties and instances without labels).
         :RType: numpy.array
-        :Returns: 1-d numpy.array of length `num_instances`, each element contains (soft/hard) majority votes.
+        :Returns:
+            1-d numpy.array of length `num_instances`, each element contains (soft/hard) majority votes,
+            or 2 * `num_instances` numpy.array for "log_prob", whose 1st row contains log probabilities of positive labels, and the 2nd negative.
         """
-        pos_minus_neg = self.response_array.sum(axis=1)
-        pos_plus_neg = (self.response_array * self.response_array).sum(axis=1)
-        pos_array = (pos_plus_neg + pos_minus_neg) / 2.0
-        neg_array = (pos_plus_neg - pos_minus_neg) / 2.0
-        if DEBUG == 1:
-            if pos_minus_neg.shape != (self.num_instances,) or pos_minus_neg.shape != (self.num_instances,):
-                sys.stderr.write("ERROR: wrong shape")
-                exit(0)
-            if (not np.array_equal(pos_array + neg_array, pos_plus_neg)) or (not np.array_equal(pos_array - neg_array, pos_minus_neg)):
-                sys.stderr.write("ERROR: wrong results")
-                exit(0)
-        
+        pos_plus_neg = self.instance_pos_count + self.instance_neg_count
+        if prob == "prob":
+            with np.errstate(invalid="ignore"):
+                return self.instance_pos_count / pos_plus_neg.astype('float')
+        elif prob == "log_prob":
+            with np.errstate(divide="ignore", invalid="ignore"):
+                return np.array([np.log(self.instance_pos_count) - np.log(pos_plus_neg), np.log(self.instance_neg_count) - np.log(pos_plus_neg)])
+        elif prob == "no":
+            return np.sign(self.instance_pos_count - self.instance_neg_count)
+        else:
+            raise ValueError("ERROR: prob must be either \"prob\", \"log_prob\" or \"no\".")
+
+    def worker_statistics(self):
+        """ Return statistics of each worker.
+
+        :RType: dict
+        :Returns:
+            a dict of numpy.arrays of length `num_workers`, whose keys are
+            "num_labels", "num_positives", "num_negatives" and "positive_rate" (nan for workers without labels).
+        """
+        num_labels = self.worker_pos_count + self.worker_neg_count
+        with np.errstate(invalid="ignore"):
+            positive_rate = self.worker_pos_count / num_labels.astype('float')
+        return {"num_labels": num_labels,
+                "num_positives": self.worker_pos_count,
+                "num_negatives": self.worker_neg_count,
+                "positive_rate": positive_rate}
+
+
+class CategoricalData:
+    """ Categorical crowd data class without feature vectors, e.g., of ten-choice questions.
+
+    :IVariables:
+        num_instances : int
+            the number of instances.
+        num_workers : int
+            the number of workers.
+        labels : numpy.array
+            sorted possible labels, which must not contain 0. The k-th label is called class k.
+        num_classes : int
+            the number of possible labels.
+        response_array : numpy.array or scipy.sparse.csr_matrix
+            num_instances * num_workers array. Each column corresponds to each worker's label.
+            response_array[i,j] == 0 if worker j doesn't label data i.
+            response_array[i,j] is one of labels if worker j labels data i.
+            A sparse array is stored as a csr_matrix.
+    """
+    def __init__(self, response_array, labels=None):
+        """ Initialization
+
+        :Variables:
+            response_array : numpy.array or scipy.sparse matrix
+            labels : list
+                possible labels. If None, 1, 2, ..., the maximum label in response_array.
+        """
+        if scipy.sparse.issparse(response_array):
+            response_array = scipy.sparse.csr_matrix(response_array)
+            label_values = response_array.data[response_array.data != 0]
+        else:
+            response_array = np.asarray(response_array)
+            label_values = response_array[response_array != 0]
+        if labels is None:
+            labels = np.arange(1, int(label_values.max()) + 1 if len(label_values) > 0 else 2)
+        self.labels = np.unique(np.asarray(labels))
+        if np.any(self.labels == 0):
+            raise ValueError("ERROR: 0 cannot be a label, since it means no label.")
+        if not np.all(np.isin(label_values, self.labels)):
+            raise ValueError("ERROR: response_array contains labels other than " + str(self.labels.tolist()) + ".")
+        self.num_classes = len(self.labels)
+        self.response_array = response_array
+        self.num_instances = response_array.shape[0]
+        self.num_workers = response_array.shape[1]
+
+    def observed_entries(self):
+        """ Return the observed labels as (instance, worker, class) triplets.
+
+        :RType: tuple of numpy.arrays
+        :Returns:
+            (instance_index, worker_index, class_index), each of which is an int array of length #(observed labels),
+            where labels[class_index[k]] = response_array[instance_index[k], worker_index[k]].
+        """
+        if scipy.sparse.issparse(self.response_array):
+            instance_index, worker_index, label = scipy.sparse.find(self.response_array)
+        else:
+            instance_index, worker_index = np.nonzero(self.response_array)
+            label = self.response_array[instance_index, worker_index]
+        return instance_index.astype(np.intp), worker_index.astype(np.intp), np.searchsorted(self.labels, label).astype(np.intp)
+
+    def vote_counts(self):
+        """ Return the number of votes for each class.
+
+        :RType: numpy.array
+        :Returns: num_instances * num_classes numpy.array, whose (i,k) element is the number of workers who give class k to instance i.
+        """
+        instance_index, _, class_index = self.observed_entries()
+        return np.bincount(instance_index * self.num_classes + class_index,
+                           minlength=self.num_instances * self.num_classes).reshape(self.num_instances, self.num_classes).astype(float)
+
+    def majority_vote(self, prob):
+        """ Return the (soft/hard) majority votes
+
+        :Variables:
+            prob : str
+                if prob = "prob", then return the fractions of votes for each class (nan for instances without labels).
+                if prob = "log_prob", then return the log fractions of votes.
+                if prob = "no", then return the majority voted labels (ties go to the smaller label, and 0 for instances without labels).
+        :RType: numpy.array
+        :Returns: num_instances * num_classes numpy.array of (log) fractions, or 1-d numpy.array of length `num_instances` of labels.
+        """
+        count_array = self.vote_counts()
+        num_votes = count_array.sum(axis=1)
         if prob == "prob":
-            return pos_array.astype('float') / pos_plus_neg.astype('float')
+            with np.errstate(invalid="ignore"):
+                return count_array / num_votes[:, np.newaxis]
         elif prob == "log_prob":
-            return np.array([np.ma.log(pos_array) - np.ma.log(pos_plus_neg), np.ma.log(neg_array) - np.ma.log(pos_plus_neg)])
+            with np.errstate(divide="ignore", invalid="ignore"):
+                return np.log(count_array) - np.log(num_votes)[:, np.newaxis]
         elif prob == "no":
-            sys.stderr.write("ERROR: sorry, not implemented.")
-            exit(0)
-            #return pos_array.astype('float') / pos_plus_neg.astype('float')
+            return np.where(num_votes > 0, self.labels[np.argmax(count_array, axis=1)], 0)
+        else:
+            raise ValueError("ERROR: prob must be either \"prob\", \"log_prob\" or \"no\".")
+
 
 if __name__ == "__main__":
     # for test
@@ -74,4 +410,7 @@ if __name__ == "__main__":
 
     print(c_data.majority_vote("log_prob"))
     print(np.log(np.array([3.0/5.0, 6.0/7.0, 3.0/6.0])))
+    print(BinaryData(scipy.sparse.csr_matrix(mat)).majority_vote("log_prob"))
+    print(c_data.majority_vote("no"))
+    print(c_data.worker_statistics())
     
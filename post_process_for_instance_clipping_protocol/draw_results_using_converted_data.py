@@ -9,7 +9,6 @@ __version__ = "1.0"
 __copyright__ = "Copyright (c) 2014 Hiroshi Kajino all rights reserved."
 __docformat__ = "restructuredtext en"
 
-import numpy as np
 import cv2
 import pickle
 import sys
@@ -17,7 +16,10 @@ import os
 import argparse
 import datetime
 from crowd_data import BinaryData
-from lcmodel import LatentClassModel
+from aggregation import aggregate, QC_METHODS
+from lcmodel import load_latent_class_model
+from utils import load_parameters, load_converted_result, as_loc_array
+from instrumentation import metrics_logger
 
 def load_pickle_files(_file_str):
     """ load parameters created by instance_clipping_and_mixing.py
@@ -41,52 +43,61 @@ def save_parameters(parameters, save_dir, save_file_name):
         pickle.dump(parameters, f)
 
 
-def aggregate_crowd_labels(crowd_res, qc_method, save_dir=None):
+def aggregate_crowd_labels(crowd_res, qc_method, save_dir=None, metrics=None, lc_model=None, max_iter=None, time_budget=None,
+                           accelerate=False, num_restarts=1, num_workers=1, seed=None, worker_ids=None):
     """ Aggregate multiple labels on one instance to return a list of positive instances.
+    See aggregation.py for the quality control methods.
     
     :Variables:
         crowd_res : crowd_data.binaryData
         qc_method : str
         save_dir : str
-    :RType: list
+        metrics : instrumentation.MetricsLogger
+            records EM iterations of the latent class model.
+        lc_model : lcmodel.FittedLatentClassModel or lcmodel.LatentClassModel
+            a previously fitted model to warm-start the latent class model, or None.
+        max_iter : int
+            the maximum number of EM iterations, or None.
+        time_budget : float
+            the time budget [sec] of EM, or None.
+        accelerate : bool
+            accelerate EM by SQUAREM.
+        num_restarts : int
+            the number of EM restarts from randomized initializations, which run in `num_workers` processes.
+            The fit with the highest log-likelihood is used.
+        num_workers : int
+        seed : int
+            a random seed to break ties of mv and to initialize restarts of lc.
+        worker_ids : list
+            ids of the workers, which are saved with the latent class model and used to match workers in a warm start.
+    :RType: numpy.array
     :Returns:
-        a list of positive subsubinstances
+        an array of positive subsubinstances
     """
     if qc_method == "no":
         sys.stdout.write("--- No Quality Control ---\n")
-        pos_ind_list = list(set((crowd_res.response_array > 0).nonzero()[0]))
     elif qc_method == "mv":
         sys.stdout.write("--- MV Method ---\n")
-        sum_y = crowd_res.response_array.sum(axis=1) #sum_y[i] = #(pos) - #(neg)
-        pos_ind_list = []
-        for i in range(len(sum_y)):
-            if sum_y[i] > 0 or (sum_y[i] == 0 and np.random.binomial(1,0.5) == 0):
-                pos_ind_list.append(i)
-    elif qc_method == "lc":
-        lc = LatentClassModel(crowd_res)
-        lc.run_em(10**(-10))
-        save_parameters(lc, save_dir, "lc_model.pickle")
-        est_labels = lc.estimated_labels(0.5)
-        pos_ind_list = np.nonzero(est_labels == 1)[0]
-    else:
-        sys.stdout.write("qc_method must be either {no, mv, lc}.\n")
-        exit(-1)
+    pos_ind_list, _, lc = aggregate(crowd_res, qc_method, seed, lc_model=lc_model, num_restarts=num_restarts, num_workers=num_workers,
+                                    metrics=metrics, worker_ids=worker_ids, max_iter=max_iter, time_budget=time_budget, accelerate=accelerate)
 
     if save_dir is not None:
+        if lc is not None:
+            lc.save(os.path.join(save_dir, "lc_model"), worker_ids)
         save_parameters(pos_ind_list, save_dir, "pos_ind_list.pickle")
     return pos_ind_list
 
 def create_masked_image(pos_ind_list, img_list, org_loc_list_without_repetition, save_dir):
+    org_loc_array = as_loc_array(org_loc_list_without_repetition)
     for i in pos_ind_list:
-        patch_info = org_loc_list_without_repetition[i]
-        # (i, (step_size * j + l * _clickable_size, step_size * k + m * _clickable_size, _clickable_size, _clickable_size))
-        file_id = patch_info[0]
+        # (i, step_size * j + l * _clickable_size, step_size * k + m * _clickable_size, _clickable_size, _clickable_size)
+        file_id, top, left, height, width = [int(each_value) for each_value in org_loc_array[i]]
         try:
-            img_list[file_id][patch_info[1][0] : min(patch_info[1][0] + patch_info[1][2], img_list[file_id].shape[0]),
-                              patch_info[1][1] : min(patch_info[1][1] + patch_info[1][3], img_list[file_id].shape[1]),
+            img_list[file_id][top : min(top + height, img_list[file_id].shape[0]),
+                              left : min(left + width, img_list[file_id].shape[1]),
                               :] = (255, 0, 255)
         except ValueError:
-            sys.stderr.write(str(patch_info))
+            sys.stderr.write(str(org_loc_array[i]))
     try:
         os.mkdir(os.path.join(save_dir, "masked_images"))
     except OSError:
@@ -97,21 +108,45 @@ def create_masked_image(pos_ind_list, img_list, org_loc_list_without_repetition,
 
 def main():
     parser = argparse.ArgumentParser(description="Draw results using converted_results.pickle and parameters.pickle.")
-    parser.add_argument("parameters_file", type=str, help="parameters.pickle created by instance_clipping_and_mixing.py")
+    parser.add_argument("parameters_file", type=str, help="parameters directory (or legacy parameters.pkl) created by instance_clipping_and_mixing.py")
     parser.add_argument("converted_result", type=str, help="converted_result.pickle created by convert_data.py")
-    parser.add_argument("quality_control", type=str, help="specify a quality control method from {no, mv, lc}.")
+    parser.add_argument("quality_control", type=str, choices=QC_METHODS, help="specify a quality control method from {no, mv, lc}.")
     parser.add_argument("save_dir", type=str, help="A directory to save clipped results and miscs.")
+    parser.add_argument("--metrics_file", type=str, default=None,
+                        help="A json-lines file to append per-stage metrics. metrics.jsonl in save_dir by default, and \"\" to disable.")
+    parser.add_argument("--warm_start", type=str, default=None,
+                        help="lc_model directory (or legacy lc_model.pickle) saved by a previous run, from which the latent class model starts.")
+    parser.add_argument("--max_iter", type=int, default=None, help="The maximum number of EM iterations of the latent class model.")
+    parser.add_argument("--time_budget", type=float, default=None, help="The time budget [sec] of EM of the latent class model.")
+    parser.add_argument("--accelerate", action="store_true", help="Accelerate EM of the latent class model by SQUAREM.")
+    parser.add_argument("--num_restarts", type=int, default=1,
+                        help="The number of EM restarts of the latent class model, from the majority votes and randomized initializations.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="The number of processes to run EM restarts.")
+    parser.add_argument("--seed", type=int, default=42, help="A random seed to break ties of mv and to initialize restarts of lc.")
     args = parser.parse_args()
 
     command_date = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
     print(args)
     print("Command was executed on " + command_date)
 
-    org_loc_list_without_repetition, converted_result_array = load_pickle_files(args.converted_result)
-    args_ic, img_list, subinstance_org_loc_list, mosaic_loc_list = load_pickle_files(args.parameters_file)
-    crowd_res = BinaryData(converted_result_array)
-    pos_ind_list = aggregate_crowd_labels(crowd_res, args.quality_control, args.save_dir)
-    create_masked_image(pos_ind_list, img_list, org_loc_list_without_repetition, args.save_dir)
+    with metrics_logger(args.metrics_file, args.save_dir, "draw_results_using_converted_data") as metrics:
+        metrics.log("command", args=vars(args))
+        with metrics.stage("load_converted_result", unit="instances") as record:
+            org_loc_list_without_repetition, converted_result_array, worker_ids = load_converted_result(args.converted_result)
+            record["num_items"] = len(org_loc_list_without_repetition)
+        with metrics.stage("load_images", unit="images") as record:
+            args_ic, img_list, _, _ = load_parameters(args.parameters_file, load_images=True)
+            record["num_items"] = len(img_list)
+        with metrics.stage("aggregate_crowd_labels", num_items=len(org_loc_list_without_repetition), unit="instances",
+                           quality_control=args.quality_control) as record:
+            crowd_res = BinaryData(converted_result_array)
+            lc_model = None if args.warm_start is None else load_latent_class_model(args.warm_start)
+            pos_ind_list = aggregate_crowd_labels(crowd_res, args.quality_control, args.save_dir, metrics, lc_model,
+                                                  args.max_iter, args.time_budget, args.accelerate, args.num_restarts, args.num_workers,
+                                                  args.seed, worker_ids)
+            record["num_positives"] = len(pos_ind_list)
+        with metrics.stage("create_masked_image", num_items=len(img_list), unit="images"):
+            create_masked_image(pos_ind_list, img_list, org_loc_list_without_repetition, args.save_dir)
 
 if __name__ == "__main__":
     main()
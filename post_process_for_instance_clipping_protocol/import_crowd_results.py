@@ -16,10 +16,18 @@ The input csv file is assumed to be in the following format.
 
 Output pickle file is composed of three objects.
 The first one is a list of worker IDs, the second one is a list of instance IDs, and the third one is an array of results.
-The result array is a #(instance) x #(workers) array, where each column contains results for each instance.
+Workers and instances are indexed in the order of their first appearance in the csv file, which is read row by row.
+The result array is a #(instance) x #(workers) crowd_data.SparseResultArray, which keeps only the results given by workers.
+With --dense, it is a #(instance) x #(workers) object array instead, where each column contains results for each instance.
 If the worker does not work on an instance, then the corresponding element is None.
 
-usage: python %s <result.csv> <output_folder/>
+Several csv files (e.g., exports of several batches or platforms) are parsed in parallel processes and merged
+as if they were concatenated in the given order; a row whose result id has already appeared is skipped with a warning.
+
+If num_answer == 1, the answers are also parsed into clicks and saved into parsed_results/ (see crowd_data.ParsedResultArray),
+which convert_data.py reads without re-tokenizing the answers.
+
+usage: python %s <result.csv or folder/> <output_folder/> <num_input> <num_answer> [--additional_csv_files <result.csv> ...]
 REMARK:
 """
 
@@ -30,78 +38,211 @@ __version__ = "1.0"
 __copyright__ = "Copyright (c) 2013 Hiroshi Kajino all rights reserved."
 __docformat__ = "restructuredtext en"
 
-import numpy as np
+import csv
 import pickle
 import sys
 import os
+import glob
 import argparse
 import datetime
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import metrics_logger
+from crowd_data import SparseResultArray, ParsedResultArray
 
-def main():
-    parser = argparse.ArgumentParser(description="import a csv file obtained from a crowdsourcing platform into a pickle file.")
-    parser.add_argument("csv_file", type=str, help="A csv file obtained from the platform.")
-    parser.add_argument("save_dir", type=str, help="A directory to save a pickle file.")
-    parser.add_argument("num_input", type=int, help="The number of inputs per one instance.")
-    parser.add_argument("num_answer", type=int, help="The number of answers per one instance.")
-    args = parser.parse_args()
+def read_crowd_results(csv_file, num_input, num_answer, result_id_list=None):
+    """ read a csv file row by row, giving IDs to workers and instances in the order of their first appearance.
 
-    command_date = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
-    print(args)
-    print("Command was executed on " + command_date)
+    :Variables:
+        csv_file : str
+        num_input : int
+            the number of inputs per one instance.
+        num_answer : int
+            the number of answers per one instance.
+        result_id_list : list
+            if given, (result id, line number) of each response is appended to it.
+    :RType: tuple
+    :Returns:
+        (worker_ids, instance_ids, response_list)
+        worker_ids : list
+        instance_ids : list
+            instance_ids[i] is a str if num_input == 1, otherwise a list of num_input strs.
+        response_list : list
+            a list of (instance index, worker index, answer), where answer is a str if num_answer == 1, otherwise a list of strs.
+    """
+    worker_id_dict = {}
+    instance_id_dict = {}
+    worker_ids = []
+    instance_ids = []
+    response_list = []
+    with open(csv_file, "r", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader) # the zero-th row corresponds to a header.
+        if (len(header) - 3) % (num_input + num_answer) != 0:
+            raise ValueError('incompatible parameters')
+        num_instances_in_line = (len(header) - 3) // (num_input + num_answer)
+        print('#(instances/task) =', num_instances_in_line)
+        first_answer_col = 3 + num_instances_in_line * num_input
+        for row in reader:
+            if len(row) == 0:
+                continue
+            if len(row) != len(header):
+                raise ValueError("ERROR: line " + str(reader.line_num) + " has " + str(len(row)) + " columns, but the header has "
+                                 + str(len(header)) + ".")
+            worker_i = worker_id_dict.setdefault(row[2], len(worker_ids))
+            if worker_i == len(worker_ids):
+                worker_ids.append(row[2])
+            for ii in range(num_instances_in_line):
+                instance_key = tuple(row[3 + ii * num_input : 3 + (ii + 1) * num_input])
+                instance_i = instance_id_dict.setdefault(instance_key, len(instance_ids))
+                if instance_i == len(instance_ids):
+                    instance_ids.append(instance_key[0] if num_input == 1 else list(instance_key))
+                if num_answer == 1:
+                    answer = row[first_answer_col + ii]
+                else:
+                    answer = row[first_answer_col + ii * num_answer : first_answer_col + (ii + 1) * num_answer]
+                response_list.append((instance_i, worker_i, answer))
+                if result_id_list is not None:
+                    result_id_list.append((row[1], reader.line_num))
+    return worker_ids, instance_ids, response_list
 
-    task_array = np.loadtxt(args.csv_file, delimiter=',', dtype=str)
+def _read_crowd_results_with_result_ids(csv_file, num_input, num_answer):
+    """ read_crowd_results returning result ids, which is run in a worker process.
+    """
+    result_id_list = []
+    worker_ids, instance_ids, response_list = read_crowd_results(csv_file, num_input, num_answer, result_id_list)
+    return worker_ids, instance_ids, response_list, result_id_list
 
-    # give IDs for workers
-    worker_ids = list(set(task_array[1:, 2])) # the zero-th row corresponds to a header.
-    print("#(workers) =", len(worker_ids))
+def list_csv_files(csv_path_list):
+    """ expand directories into the csv files in them, in the sorted order of their names.
 
-    # give IDs for instances
-    if (task_array.shape[1] - 3) % (args.num_input + args.num_answer) != 0:
-        raise ValueError('incompatible parameters')
-    num_instances_in_line = (task_array.shape[1] - 3) // (args.num_input + args.num_answer)
-    print('#(instances/task) =', num_instances_in_line)
-    instance_ids = []
+    :Variables:
+        csv_path_list : list
+            csv files or directories.
+    :RType: list
+    """
+    csv_file_list = []
+    for csv_path in csv_path_list:
+        if os.path.isdir(csv_path):
+            csv_file_list.extend(sorted(glob.glob(os.path.join(csv_path, "*.csv"))))
+        else:
+            csv_file_list.append(csv_path)
+    return csv_file_list
 
-    if args.num_input != 1:
-        for i in range(task_array.shape[0] - 1):
-            for ii in range(num_instances_in_line):
-                if not [task_array[i + 1,  3 + ii * args.num_input + iii] for iii in range(args.num_input)] in instance_ids:
-                    instance_ids.append([task_array[i + 1,  3 + ii * args.num_input + iii] for iii in range(args.num_input)])
+def read_crowd_result_files(csv_file_list, num_input, num_answer, num_workers=1):
+    """ read csv files in parallel processes, and merge them as if they were concatenated in the given order.
+    Workers and instances are indexed in the order of their first appearance in the concatenation.
+    A row whose result id has already appeared is skipped with a warning.
+
+    :Variables:
+        csv_file_list : list
+        num_input : int
+        num_answer : int
+        num_workers : int
+            the number of processes to parse files.
+    :RType: tuple
+    :Returns:
+        (worker_ids, instance_ids, response_list, num_duplicates)
+        num_duplicates is the number of skipped rows.
+    """
+    if num_workers > 1 and len(csv_file_list) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            file_result_list = executor.map(_read_crowd_results_with_result_ids, csv_file_list,
+                                            [num_input] * len(csv_file_list), [num_answer] * len(csv_file_list))
+            file_result_list = list(file_result_list)
     else:
-        for i in range(task_array.shape[0] - 1):
-            for ii in range(num_instances_in_line):
-                if not task_array[i + 1,  3 + ii * args.num_input] in instance_ids:
-                    instance_ids.append(task_array[i + 1,  3 + ii * args.num_input])
+        file_result_list = [_read_crowd_results_with_result_ids(csv_file, num_input, num_answer) for csv_file in csv_file_list]
+
+    worker_id_dict = {}
+    instance_id_dict = {}
+    worker_ids = []
+    instance_ids = []
+    response_list = []
+    result_id_dict = {} # result id -> (file index, line number) of the row that is kept.
+    duplicate_row_set = set([])
+    for file_i in range(len(csv_file_list)):
+        file_worker_ids, file_instance_ids, file_response_list, file_result_id_list = file_result_list[file_i]
+        file_result_list[file_i] = None
+        for ((instance_i, worker_i, answer), (result_id, line_num)) in zip(file_response_list, file_result_id_list):
+            if result_id_dict.setdefault(result_id, (file_i, line_num)) != (file_i, line_num):
+                if (file_i, line_num) not in duplicate_row_set:
+                    duplicate_row_set.add((file_i, line_num))
+                    sys.stderr.write("WARNING: result id " + result_id + " in line " + str(line_num) + " of " + csv_file_list[file_i]
+                                     + " has already appeared, and is skipped.\n")
+                continue
+            worker_id = file_worker_ids[worker_i]
+            global_worker_i = worker_id_dict.setdefault(worker_id, len(worker_ids))
+            if global_worker_i == len(worker_ids):
+                worker_ids.append(worker_id)
+            instance_id = file_instance_ids[instance_i]
+            instance_key = instance_id if num_input == 1 else tuple(instance_id)
+            global_instance_i = instance_id_dict.setdefault(instance_key, len(instance_ids))
+            if global_instance_i == len(instance_ids):
+                instance_ids.append(instance_id)
+            response_list.append((global_instance_i, global_worker_i, answer))
+    return worker_ids, instance_ids, response_list, len(duplicate_row_set)
 
+def import_crowd_results(args, metrics):
+    """ import the csv file given by the command line arguments, and save the result into workers_result.pickle.
+
+    :Variables:
+        args : Namespace
+        metrics : instrumentation.MetricsLogger
+    """
+    csv_file_list = list_csv_files([args.csv_file] + args.additional_csv_files)
+    print("#(csv files) =", len(csv_file_list))
+    with metrics.stage("read_csv", num_files=len(csv_file_list), unit="responses") as record:
+        worker_ids, instance_ids, response_list, num_duplicates \
+            = read_crowd_result_files(csv_file_list, args.num_input, args.num_answer, args.num_workers)
+        record["num_items"] = len(response_list)
+        record["num_duplicates"] = num_duplicates
+        record["num_workers"] = len(worker_ids)
+        record["num_instances"] = len(instance_ids)
+    print("#(workers) =", len(worker_ids))
     print('#(instances) =', len(instance_ids))
+    print("#(duplicate rows) =", num_duplicates)
 
-    # import into numpy.array
-    result_array = np.array([[None] * len(worker_ids)] * len(instance_ids))
+    with metrics.stage("fill_results", num_items=len(response_list), unit="responses", dense=args.dense):
+        result_array = SparseResultArray((len(instance_ids), len(worker_ids)),
+                                         [instance_i for (instance_i, _, _) in response_list],
+                                         [worker_i for (_, worker_i, _) in response_list],
+                                         [answer for (_, _, answer) in response_list])
+        del response_list
 
-    if args.num_answer != 1:
-        for i in range(task_array.shape[0] - 1):
-            worker_id = worker_ids.index(task_array[i + 1, 2])
-            for ii in range(num_instances_in_line):
-                if args.num_input != 1:
-                    instance_id = instance_ids.index([task_array[i + 1,  3 + ii * args.num_input + iii] for iii in range(args.num_input)])
-                else:
-                    instance_id = instance_ids.index(task_array[i + 1,  3 + ii * args.num_input])
-                result_array[instance_id][worker_id] = [task_array[i + 1,
-                                                                   3 + num_instances_in_line * args.num_input + ii * args.num_answer + iii]\
-                                                        for iii in range(args.num_answer)]
-    else:
-        for i in range(task_array.shape[0] - 1):
-            worker_id = worker_ids.index(task_array[i + 1, 2])
-            for ii in range(num_instances_in_line):
-                if args.num_input != 1:
-                    instance_id = instance_ids.index([task_array[i + 1,  3 + ii * args.num_input + iii] for iii in range(args.num_input)])
-                else:
-                    instance_id = instance_ids.index(task_array[i + 1,  3 + ii * args.num_input])
-                result_array[instance_id][worker_id] = task_array[i + 1,
-                                                                  3 + num_instances_in_line * args.num_input + ii * args.num_answer]
-    f = open(os.path.join(args.save_dir, 'workers_result.pickle'), 'wb')
-    pickle.dump((worker_ids, instance_ids, result_array), f)
-    f.close()
+    if args.num_answer == 1:
+        with metrics.stage("parse_results", num_items=result_array.nnz, unit="responses"):
+            try:
+                parsed_result_array = ParsedResultArray.from_result_array(worker_ids, instance_ids, result_array)
+                parsed_result_array.save(os.path.join(args.save_dir, "parsed_results"))
+            except ValueError:
+                print("answers are not clicks, and are not parsed.")
+
+    if args.dense:
+        result_array = result_array.to_dense()
+
+    with metrics.stage("save_results", num_items=len(instance_ids), unit="instances"), \
+         open(os.path.join(args.save_dir, 'workers_result.pickle'), 'wb') as f:
+        pickle.dump((worker_ids, instance_ids, result_array), f)
+
+def main():
+    parser = argparse.ArgumentParser(description="import a csv file obtained from a crowdsourcing platform into a pickle file.")
+    parser.add_argument("csv_file", type=str, help="A csv file obtained from the platform, or a directory of csv files.")
+    parser.add_argument("save_dir", type=str, help="A directory to save a pickle file.")
+    parser.add_argument("num_input", type=int, help="The number of inputs per one instance.")
+    parser.add_argument("num_answer", type=int, help="The number of answers per one instance.")
+    parser.add_argument("--additional_csv_files", type=str, nargs="+", default=[],
+                        help="More csv files (or directories), which are merged after csv_file in this order.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="The number of processes to parse csv files.")
+    parser.add_argument("--dense", action="store_true", help="Save results as a dense object array, which is only suitable for small jobs.")
+    parser.add_argument("--metrics_file", type=str, default=None,
+                        help="A json-lines file to append per-stage metrics. metrics.jsonl in save_dir by default, and \"\" to disable.")
+    args = parser.parse_args()
+
+    command_date = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
+    print(args)
+    print("Command was executed on " + command_date)
+    with metrics_logger(args.metrics_file, args.save_dir, "import_crowd_results") as metrics:
+        metrics.log("command", args=vars(args))
+        import_crowd_results(args, metrics)
 
 if __name__ == "__main__":
     main()
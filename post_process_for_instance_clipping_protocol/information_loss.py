@@ -14,7 +14,9 @@ __docformat__ = "restructuredtext en"
 import numpy as np
 import argparse
 import datetime
-from utils import load_pickle_files
+from utils import load_converted_result, as_loc_list
+from crowd_data import CategoricalData
+from instrumentation import metrics_logger
 
 #SMOOTH_VAL = 0.1
 
@@ -24,7 +26,7 @@ def convert_result_array_to_distribution(converted_result_array, smoothing_param
     To be precise, each row of converted_result_array is converted into a distribution.
     
     :Variables:
-        converted_result_array : numpy.array
+        converted_result_array : numpy.array or scipy.sparse matrix
             each row contains labels given to one instance by workers.
         smoothing_parameter : float
             a pseudo-count parameter to smooth empirical distributions.
@@ -41,13 +43,7 @@ def convert_result_array_to_distribution(converted_result_array, smoothing_param
     else:
         raise ValueError("ERROR: possible_labels must be either \"binary\" or \"ten-choice\".")
 
-    count_array = smoothing_parameter * np.ones((converted_result_array.shape[0], len(possible_labels_list)))
-    non_zero_inds = np.nonzero(converted_result_array)
-    for i in range(len(non_zero_inds[0])):
-        count_array[non_zero_inds[0][i],
-                    possible_labels_list.index(converted_result_array[non_zero_inds[0][i],
-                                                                      non_zero_inds[1][i]])] += 1.
-
+    count_array = CategoricalData(converted_result_array, possible_labels_list).vote_counts() + smoothing_parameter
     count_array = count_array / (count_array.sum(axis=1)[:, np.newaxis])
     return count_array
 
@@ -56,9 +52,10 @@ def align_result_array(count_array_gt, org_loc_list_without_repetition, org_loc_
 
     :Variables:
         count_array_gt : numpy.array
-        org_loc_list_without_repetition : list
-        org_loc_list_without_repetition_gt : list
+        org_loc_list_without_repetition : list or numpy.array
+        org_loc_list_without_repetition_gt : list or numpy.array
             (i, (step_size * j + l * _clickable_size, step_size * k + m * _clickable_size, _clickable_size, _clickable_size))
+            or the rows of an integer array (i, step_size * j + ..., step_size * k + ..., _clickable_size, _clickable_size)
     :RType: numpy.array
     :Returns:
         aligned_count_array_gt
@@ -66,9 +63,13 @@ def align_result_array(count_array_gt, org_loc_list_without_repetition, org_loc_
     if len(org_loc_list_without_repetition) != len(org_loc_list_without_repetition_gt):
         raise ValueError("ERROR: the lengthes of lists are different, which invades the assumption made in this program.")
     else:
+        org_loc_list_without_repetition = as_loc_list(org_loc_list_without_repetition)
+        gt_ind_dict = dict(zip(as_loc_list(org_loc_list_without_repetition_gt), range(len(org_loc_list_without_repetition_gt))))
         ind_list = [None] * len(org_loc_list_without_repetition)
         for i in range(len(org_loc_list_without_repetition)):
-            ind_list[i] = org_loc_list_without_repetition_gt.index(org_loc_list_without_repetition[i])
+            if org_loc_list_without_repetition[i] not in gt_ind_dict:
+                raise ValueError("ERROR: " + str(org_loc_list_without_repetition[i]) + " is not in the ground truth.")
+            ind_list[i] = gt_ind_dict[org_loc_list_without_repetition[i]]
 
         return count_array_gt[ind_list, :]
 
@@ -115,8 +116,8 @@ def _distance(array1, array2, dist_type="kl"):
     elif dist_type == supported_dist_types[1]:
         return 0.5 * np.linalg.norm(array1 - array2)
     elif dist_type == supported_dist_types[2]:
-        array1_tmp = np.asarray(array1, dtype=np.float)
-        array2_tmp = np.asarray(array2, dtype=np.float)
+        array1_tmp = np.asarray(array1, dtype=float)
+        array2_tmp = np.asarray(array2, dtype=float)
         return np.sum(np.where(array2_tmp != 0, array2_tmp * np.log2(array2_tmp / array1_tmp), 0))
     else:
         return None
@@ -144,21 +145,32 @@ def main():
     parser.add_argument("converted_result", type=str, help="converted_result.pickle created by convert_data.py")
     parser.add_argument("converted_result_ground_truth", type=str, help="converted_result.pickle created by convert_data.py ** GROUND TRUTH **")
     parser.add_argument("smoothing_parameter", type=float, help="smoothing parameter to estimate empirical distributions.")
-    parser.add_argument("possible_labels", type=float, help="{binary, ten-choice}.")
+    parser.add_argument("possible_labels", type=str, choices=["binary", "ten-choice"], help="{binary, ten-choice}.")
     parser.add_argument("save_dir", type=str, help="A directory to save clipped results and miscs.")
+    parser.add_argument("--metrics_file", type=str, default=None,
+                        help="A json-lines file to append per-stage metrics. metrics.jsonl in save_dir by default, and \"\" to disable.")
     args = parser.parse_args()
     
     command_date = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
     print(args)
     print("Command was executed on " + command_date)
 
-    (org_loc_list_without_repetition, converted_result_array) = load_pickle_files(args.converted_result)
-    (org_loc_list_without_repetition_gt, converted_result_array_gt) = load_pickle_files(args.converted_result_ground_truth)
-    count_array = convert_result_array_to_distribution(converted_result_array, args.smoothing_parameter, args.possible_labels)
-    count_array_gt = convert_result_array_to_distribution(converted_result_array_gt, args.smoothing_parameter, args.possible_labels)
-    aligned_count_array_gt = align_result_array(count_array_gt, org_loc_list_without_repetition, org_loc_list_without_repetition_gt)
-    information_loss = calc_information_loss(count_array, aligned_count_array_gt)
-    print("information_loss =", information_loss)
+    with metrics_logger(args.metrics_file, args.save_dir, "information_loss") as metrics:
+        metrics.log("command", args=vars(args))
+        with metrics.stage("load_converted_results", unit="instances") as record:
+            (org_loc_list_without_repetition, converted_result_array, _) = load_converted_result(args.converted_result)
+            (org_loc_list_without_repetition_gt, converted_result_array_gt, _) = load_converted_result(args.converted_result_ground_truth)
+            record["num_items"] = len(org_loc_list_without_repetition) + len(org_loc_list_without_repetition_gt)
+        with metrics.stage("convert_result_array_to_distribution", unit="instances") as record:
+            count_array = convert_result_array_to_distribution(converted_result_array, args.smoothing_parameter, args.possible_labels)
+            count_array_gt = convert_result_array_to_distribution(converted_result_array_gt, args.smoothing_parameter, args.possible_labels)
+            record["num_items"] = count_array.shape[0] + count_array_gt.shape[0]
+        with metrics.stage("align_result_array", num_items=len(org_loc_list_without_repetition), unit="instances"):
+            aligned_count_array_gt = align_result_array(count_array_gt, org_loc_list_without_repetition, org_loc_list_without_repetition_gt)
+        with metrics.stage("calc_information_loss", num_items=count_array.shape[0], unit="instances") as record:
+            information_loss = calc_information_loss(count_array, aligned_count_array_gt)
+            record["information_loss"] = information_loss
+        print("information_loss =", information_loss)
 
 
 if __name__ == "__main__":
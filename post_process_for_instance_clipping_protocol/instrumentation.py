@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+""" Per-stage timing and memory instrumentation shared by the scripts of the instance clipping protocol.
+
+Each stage is recorded as one json line in a metrics file, e.g.,
+{"script": "convert_data", "stage": "convert_to_crowd_data", "time": "2014/04/25 12:00:00", "duration": 1.2,
+ "num_items": 1000, "unit": "responses", "peak_rss_mb": 210.5, "max_rss_mb": 230.1, "status": "ok"}
+where peak_rss_mb is the peak resident set size sampled during the stage,
+and max_rss_mb is the peak resident set size of the process so far.
+"""
+
+# metadata variables
+__author__ = "Hiroshi KAJINO <hiroshi.kajino.1989@gmail.com>"
+__date__ = "2014/04/25"
+__version__ = "1.0"
+__copyright__ = "Copyright (c) 2014 Hiroshi Kajino all rights reserved."
+__docformat__ = "restructuredtext en"
+
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+import tracemalloc
+import contextlib
+try:
+    import resource
+except ImportError:
+    resource = None
+
+METRICS_FILE_NAME = "metrics.jsonl"
+
+
+def current_rss():
+    """ the current resident set size [byte] of this process, or None if it is not available.
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def max_rss():
+    """ the peak resident set size [byte] of this process so far, or None if it is not available.
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on mac, and in kilobytes on linux.
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class StageMeter:
+    """ Measure the wall time and the peak memory of a stage.
+    The peak RSS is sampled by a background thread. If trace_memory, the peak of memory allocated by python and numpy
+    is also traced by tracemalloc, which slows down the stage and cannot be used by concurrent stages.
+
+    :IVariables:
+        wall_time : float
+        peak_rss : int
+            the peak resident set size [byte] during the stage, or None if it is not available.
+        peak_traced : int
+            the peak size [byte] of memory allocated during the stage, or None if not trace_memory.
+    """
+    def __init__(self, interval=0.01, trace_memory=False):
+        self.interval = interval
+        self.trace_memory = trace_memory
+        self.wall_time = None
+        self.peak_rss = None
+        self.peak_traced = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss or 0, rss)
+
+    def __enter__(self):
+        self.peak_rss = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+        if self.trace_memory:
+            tracemalloc.start()
+        self._thread.start()
+        self._start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_time = time.perf_counter() - self._start_time
+        self._stop.set()
+        self._thread.join()
+        rss = current_rss()
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, rss)
+        if self.trace_memory:
+            self.peak_traced = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return False
+
+
+class MetricsLogger:
+    """ Write per-stage records into a json-lines file.
+    A logger without a path discards records, so that functions can take a logger unconditionally.
+    Records may be written from multiple threads.
+
+    :IVariables:
+        metrics_path : str
+            a json-lines file to append records, or None.
+        script : str
+            the name of the script, which is written in every record.
+    """
+    def __init__(self, metrics_path=None, script=None):
+        self.metrics_path = metrics_path
+        self.script = script
+        self._lock = threading.Lock()
+        self._file = None if metrics_path is None else open(metrics_path, "a")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def log(self, event, **fields):
+        """ write a record without timing, e.g., command line arguments.
+
+        :Variables:
+            event : str
+            fields : dict
+                json-serializable values.
+        """
+        record = {"script": self.script,
+                  "event": event,
+                  "time": datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')}
+        record.update(fields)
+        self._write(record)
+
+    @contextlib.contextmanager
+    def stage(self, stage_name, **fields):
+        """ time a stage, and write its record when it finishes (or fails).
+        The yielded dict is written together, so that the stage can add its counts, e.g.,
+        record["num_items"], record["unit"] or record["em_iterations"].
+
+        :Variables:
+            stage_name : str
+            fields : dict
+                json-serializable values known before the stage.
+        """
+        record = {"script": self.script,
+                  "stage": stage_name,
+                  "time": datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')}
+        record.update(fields)
+        if self._file is None:
+            yield record
+            return
+        meter = StageMeter()
+        status = "error"
+        try:
+            with meter:
+                yield record
+            status = "ok"
+        finally:
+            record["duration"] = meter.wall_time
+            if record.get("num_items") is not None and meter.wall_time:
+                record["throughput"] = record["num_items"] / meter.wall_time
+            record["peak_rss_mb"] = _to_mb(meter.peak_rss)
+            record["max_rss_mb"] = _to_mb(max_rss())
+            record["status"] = status
+            self._write(record)
+
+    def _write(self, record):
+        if self._file is None:
+            return
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+
+def _to_mb(num_bytes):
+    return None if num_bytes is None else num_bytes / 1024.0 / 1024.0
+
+def metrics_logger(metrics_file, save_dir, script):
+    """ create a MetricsLogger for a script.
+
+    :Variables:
+        metrics_file : str
+            the path given by --metrics_file, "" to disable metrics, or None to use `METRICS_FILE_NAME` in save_dir.
+        save_dir : str
+        script : str
+    :RType: MetricsLogger
+    """
+    if metrics_file is None:
+        metrics_file = os.path.join(save_dir, METRICS_FILE_NAME)
+    return MetricsLogger(metrics_file if metrics_file != "" else None, script)
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-""" Binary latent class model.
+""" Latent class models.
 """
 
 # metadata variables
@@ -11,17 +11,187 @@ __docformat__ = "restructuredtext en"
 
 import numpy as np
 import scipy as sp
+import os
 import sys
+import time
+import types
+import pickle
+from concurrent.futures import ProcessPoolExecutor
 from crowd_data import BinaryData
+from instrumentation import MetricsLogger
+from utils import save_array_dir, load_array_dir
 
+# parameters are extrapolated on logits, which are clipped to avoid inf - inf.
+MAX_LOGIT = 50.0
+LC_MODEL_FORMAT_VERSION = 1
 
-class LatentClassModel:
+
+def _update_abilities(mu_pos, mu_neg, one_minus_mu_pos, one_minus_mu_neg, log_alpha, log_beta):
+    """ Update log_alpha and log_beta (the M-step) from the sums of mu (and 1-mu) over the positive and negative labels of each worker.
+
+    :Variables:
+        mu_pos : numpy.array
+        mu_neg : numpy.array
+        one_minus_mu_pos : numpy.array
+        one_minus_mu_neg : numpy.array
+            numpy.arrays of length `num_workers`.
+        log_alpha : numpy.array
+        log_beta : numpy.array
+            2 * `num_workers` numpy.arrays, which are updated in place.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        alpha_log_denomi = np.log(mu_pos + mu_neg)
+        beta_log_denomi = np.log(one_minus_mu_pos + one_minus_mu_neg)
+        log_alpha[0, :] = np.log(mu_pos) - alpha_log_denomi
+        log_alpha[1, :] = np.log(mu_neg) - alpha_log_denomi
+        log_beta[0, :] = np.log(one_minus_mu_neg) - beta_log_denomi
+        log_beta[1, :] = np.log(one_minus_mu_pos) - beta_log_denomi
+    # workers without labels do not affect the estimates. their abilities are set to 1/2 instead of nan.
+    log_alpha[np.isnan(log_alpha)] = np.log(0.5)
+    log_beta[np.isnan(log_beta)] = np.log(0.5)
+
+def _logsumexp_rows(log_array):
+    """ log(sum(exp(log_array), axis=1)) of a 2-d numpy.array, which is lighter than scipy.special.logsumexp.
+    """
+    log_max = log_array.max(axis=1)
+    log_max[~np.isfinite(log_max)] = 0.0
+    with np.errstate(divide="ignore"):
+        return np.log(np.exp(log_array - log_max[:, np.newaxis]).sum(axis=1)) + log_max
+
+def _reserve(array, size):
+    """ Return `array` if its last axis can hold `size` elements, or a copy whose last axis is extended to at least double.
+    """
+    if array.shape[-1] >= size:
+        return array
+    extended_array = np.zeros(array.shape[:-1] + (max(size, 2 * array.shape[-1]),), dtype=array.dtype)
+    extended_array[..., :array.shape[-1]] = array
+    return extended_array
+
+
+class _EMModel:
+    """ EM algorithm shared by the latent class models.
+    A subclass implements _e_step (which also sets log_likelihood, the log-likelihood of the parameters before the E-step),
+    _m_step, _q_function, _get_parameters and _set_parameters (the parameters as a vector, on which EM steps are extrapolated),
+    and _save_state and _restore_state.
+    """
+    def _squarem_step(self):
+        """ Perform one SQUAREM iteration (Varadhan and Roland, 2008), which extrapolates two EM steps.
+        The extrapolated parameters are used only if their log-likelihood is not less than that of the starting parameters,
+        otherwise the result of the two EM steps is used, so that the likelihood never decreases.
+        In the latter case, an E-step is performed on the restored parameters, so that log_likelihood and log_mu are of them.
+
+        :RType: int
+        :Returns: the number of EM steps performed.
+        """
+        logits_0 = self._get_parameters()
+        self._e_step()
+        log_likelihood_0 = self.log_likelihood
+        self._m_step()
+        logits_1 = self._get_parameters()
+        self._e_step()
+        self._m_step()
+        logits_2 = self._get_parameters()
+        r = logits_1 - logits_0
+        v = logits_2 - logits_1 - r
+        norm_v = np.linalg.norm(v)
+        if norm_v == 0:
+            return 2
+        step = min(-np.linalg.norm(r) / norm_v, -1.0)
+        if step == -1.0:
+            return 2
+        state = self._save_state()
+        self._set_parameters(np.clip(logits_0 - 2.0 * step * r + step ** 2 * v, -MAX_LOGIT, MAX_LOGIT))
+        self._e_step()
+        if not self.log_likelihood >= log_likelihood_0:
+            self._restore_state(state)
+            self._e_step()
+            return 3
+        # a stabilizing EM step from the extrapolated parameters.
+        self._m_step()
+        return 3
+
+    def run_em(self, eps, verbose=False, metrics=None, max_iter=None, time_budget=None, accelerate=False):
+        """ Run EM algorithm
+
+        :Variables:
+           eps : float
+              tolerable relative errors on the Q-function.
+           verbose : bool
+              if verbose, print the value of the q-function, else don't print.
+           metrics : instrumentation.MetricsLogger
+              records the number of EM iterations and the final value of the Q-function.
+           max_iter : int
+              the maximum number of iterations, or None for no limit.
+           time_budget : float
+              stop after the first iteration that exceeds this time [sec], or None for no limit.
+           accelerate : bool
+              if accelerate, each iteration is a SQUAREM iteration of 2 or 3 EM steps, else a single EM step.
+        :RType: dict
+        :Returns:
+            a convergence report with keys "converged", "stopped_by" ("eps", "max_iter" or "time_budget"),
+            "em_iterations", "em_steps", "q_function", "relative_error", "log_likelihood" and "elapsed_time".
+        """
+        metrics = MetricsLogger() if metrics is None else metrics
+        q_new = -np.inf
+        q_old = 0
+        convergent = False
+        stopped_by = "eps"
+        start_time = time.perf_counter()
+        with metrics.stage("run_em", num_instances=self.data.num_instances, num_workers=self.data.num_workers, eps=eps,
+                           max_iter=max_iter, time_budget=time_budget, accelerate=accelerate) as record:
+            num_iterations = 0
+            num_em_steps = 0
+            while not convergent:
+                if max_iter is not None and num_iterations >= max_iter:
+                    stopped_by = "max_iter"
+                    break
+                if time_budget is not None and time.perf_counter() - start_time > time_budget:
+                    stopped_by = "time_budget"
+                    break
+                q_old = q_new
+                if accelerate:
+                    num_em_steps += self._squarem_step()
+                else:
+                    self._e_step()
+                    self._m_step()
+                    num_em_steps += 1
+                q_new = self._q_function()
+                num_iterations += 1
+                convergent = (np.abs(q_old - q_new) / np.abs(q_new) < eps)
+                if verbose:
+                    if q_new - q_old < 0:
+                        sys.stderr.write("WARNING: Q-function decreases. Something might be wrong.\n")
+                        sys.stderr.flush()
+                    sys.stdout.write("\r " + "q_func = " + str(q_new) + "\n")
+                    sys.stdout.flush()
+            report = {"converged": bool(convergent),
+                      "stopped_by": stopped_by,
+                      "em_iterations": num_iterations,
+                      "em_steps": num_em_steps,
+                      "q_function": float(q_new),
+                      "relative_error": float(np.abs(q_old - q_new) / np.abs(q_new)) if num_iterations > 0 else None,
+                      "log_likelihood": float(self.log_likelihood),
+                      "elapsed_time": time.perf_counter() - start_time}
+            record.update(report)
+        self.em_report = report
+
+        if convergent:
+            sys.stdout.write("\n"+"Converged. Relative_err = " + str(report["relative_error"]) + "\n")
+        else:
+            sys.stdout.write("\n"+"Stopped by " + stopped_by + " after " + str(num_iterations) + " iterations. Relative_err = "
+                             + str(report["relative_error"]) + "\n")
+        return report
+
+
+class LatentClassModel(_EMModel):
     """ Binary latent class model
+    Only the observed labels are visited, so each EM iteration takes O(#(instances) + #(workers) + #(observed labels)) time
+    and the response array of `data` may be a sparse matrix.
     
     :IVariables:
         data : crowdData.BinaryData
         log_mu : numpy.array
-            numpy.array of length `num_instances`. mu = Pr[true_label = 1 | other variables].
+            2 * `num_instances` numpy.array. mu = Pr[true_label = 1 | other variables]. The 1st row contains log(mu), and the 2nd log(1-mu).
         log_p : numpy.array
             numpy.array of length 2. p = Pr[true_label = 1]. The 1st element contains log(p), and the 2nd log(1-p).
         log_a : numpy.array
@@ -31,107 +201,746 @@ class LatentClassModel:
         log_alpha : numpy.array
             2 * `num_workers` numpy.array. alpha_j = Pr[label_by_worker_j = 1 | true_label = 1]. The 1st row contains log(aloha), and the 2nd log(1-alpha).
         log_beta : numpy.array
-            numpy.array of length `num_workers`. beta_j = Pr[label_by_worker_j = 0 | true_label = 0]. The 1st row contains log(beta), and the 2nd log(1-beta).
+            2 * `num_workers` numpy.array. beta_j = Pr[label_by_worker_j = 0 | true_label = 0]. The 1st row contains log(beta), and the 2nd log(1-beta).
     """
     def __init__(self, crowd_data):
         self.data = crowd_data
-        self.pos_ind = np.where(self.data.y == 1)
-        self.neg_ind = np.where(self.data.y == -1)
-        self.log_mu = self.data.majority_vote("log_prob")
+        num_instances = self.data.num_instances
+        num_workers = self.data.num_workers
+        instance_index, worker_index, label = self.data.observed_entries()
+        is_pos = (label == 1)
+        self._instance_index = instance_index
+        # positions of log(alpha_j) or log(1-alpha_j), and of log(beta_j) or log(1-beta_j) in the flattened 2 * `num_workers` arrays,
+        # which are added to log_a and log_b of the labeled instance, respectively.
+        self._alpha_index = np.where(is_pos, 0, num_workers) + worker_index
+        self._beta_index = np.where(is_pos, num_workers, 0) + worker_index
+        self._pos_instance_index = instance_index[is_pos]
+        self._pos_worker_index = worker_index[is_pos]
+        self._neg_instance_index = instance_index[~is_pos]
+        self._neg_worker_index = worker_index[~is_pos]
+        # buffers reused in every iteration.
+        self._log_weights = np.empty(len(label))
+        self._pos_weights = np.empty(len(self._pos_instance_index))
+        self._neg_weights = np.empty(len(self._neg_instance_index))
+        self._mu = np.empty(num_instances)
+        self._log_pa = np.empty(num_instances)
+
+        # initialized by the majority votes. instances without labels start from 1/2.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mv = self.data.majority_vote("prob")
+            mv[np.isnan(mv)] = 0.5
+            self.log_mu = np.log(np.array([mv, 1.0 - mv]))
         self.log_p = np.zeros(2)
-        self.log_a = np.zeros(self.data.num_instance)
-        self.log_b = np.zeros(self.data.num_instance)
-        self.log_alpha = np.zeros((2, self.data.num_workers))
-        self.log_beta = np.zeros((2, self.data.num_workers))
+        self.log_a = np.zeros(num_instances)
+        self.log_b = np.zeros(num_instances)
+        self.log_alpha = np.zeros((2, num_workers))
+        self.log_beta = np.zeros((2, num_workers))
+        self.log_likelihood = -np.inf
         self._m_step()
 
+    def warm_start(self, model, worker_index=None):
+        """ Start EM from the estimates of a previously fitted model, e.g., the model of the last night before new labels are appended.
+        Workers unknown to the model keep the estimates from the majority votes.
+
+        :Variables:
+            model : LatentClassModel or FittedLatentClassModel
+                a fitted model. Only log_p, log_alpha and log_beta are used.
+            worker_index : numpy.array
+                numpy.array of length `num_workers`. worker_index[j] is the index of worker j in the model, or -1 if unknown.
+                If None, workers are assumed to be in the same order, as convert_data.py --append keeps the order of the existing workers.
+        """
+        if worker_index is None:
+            worker_index = np.arange(self.data.num_workers)
+            worker_index[worker_index >= model.log_alpha.shape[1]] = -1
+        worker_index = np.asarray(worker_index)
+        if worker_index.shape != (self.data.num_workers,):
+            raise ValueError("ERROR: worker_index must have the length of #(workers).")
+        known = (worker_index >= 0)
+        self.log_p = np.array(model.log_p, dtype=float)
+        self.log_alpha[:, known] = model.log_alpha[:, worker_index[known]]
+        self.log_beta[:, known] = model.log_beta[:, worker_index[known]]
+        self._e_step()
+
+    def randomize(self, random_state, noise=0.5):
+        """ Re-initialize the posteriors by mixing them with uniform random numbers, and perform the M-step.
+        This gives EM restarts from different initializations around the majority votes.
+
+        :Variables:
+            random_state : numpy.random.RandomState
+            noise : float
+                the weight of the random numbers. mu = (1 - noise) * mu + noise * uniform(0, 1).
+        """
+        mu = (1.0 - noise) * np.exp(self.log_mu[0, :]) + noise * random_state.uniform(size=self.data.num_instances)
+        with np.errstate(divide="ignore"):
+            self.log_mu = np.log(np.array([mu, 1.0 - mu]))
+        self._m_step()
+
+    def _update_log_a_b(self):
+        """ Update log_a and log_b on the current log_alpha and log_beta.
+        """
+        np.take(self.log_alpha.ravel(), self._alpha_index, out=self._log_weights)
+        self.log_a = np.bincount(self._instance_index, weights=self._log_weights, minlength=self.data.num_instances)
+        np.take(self.log_beta.ravel(), self._beta_index, out=self._log_weights)
+        self.log_b = np.bincount(self._instance_index, weights=self._log_weights, minlength=self.data.num_instances)
+
     def _e_step(self):
         """ Perform the E-step. I.e., update log_a, log_b, and log_mu.
         """
-        self.log_a = np.sum((self.log_alpha[0, :] \
-                             * np.ones((self.data.num_instance,
-                                        self.data.num_workers))) \
-                            * (self.data.y == 1), axis=1)\
-                     + np.sum((self.log_alpha[1, :] \
-                               * np.ones((self.data.num_instance,
-                                          self.data.num_workers))) \
-                              * (self.data.y == -1), axis=1)
-        self.log_b = np.sum((self.log_beta[0, :] \
-                             * np.ones((self.data.num_instance,
-                                        self.data.num_workers))) \
-                            * (self.data.y == -1), axis=1)\
-                     + np.sum((self.log_beta[1, :] \
-                               * np.ones((self.data.num_instance,
-                                          self.data.num_workers))) \
-                              * (self.data.y == 1), axis=1)
-        self.log_mu[0, :] = self.log_p[0] + self.log_a
-        self.log_mu[1, :] = self.log_p[1] + self.log_b
-        self.log_mu = self.log_mu - sp.special.logsumexp(self.log_mu, axis=0)
+        self._update_log_a_b()
+        np.add(self.log_a, self.log_p[0], out=self.log_mu[0, :])
+        np.add(self.log_b, self.log_p[1], out=self.log_mu[1, :])
+        np.logaddexp(self.log_mu[0, :], self.log_mu[1, :], out=self._mu)
+        # the log-likelihood of the parameters before this E-step.
+        self.log_likelihood = self._mu.sum()
+        self.log_mu -= self._mu
+
+    def _worker_sums(self, log_mu):
+        """ Sum up mu (or 1-mu) over the instances labeled by each worker.
+
+        :Variables:
+            log_mu : numpy.array
+                numpy.array of length `num_instances`, log(mu) or log(1-mu).
+        :RType: tuple of numpy.arrays
+        :Returns: (sums over positive labels, sums over negative labels), each of length `num_workers`.
+        """
+        np.exp(log_mu, out=self._mu)
+        np.take(self._mu, self._pos_instance_index, out=self._pos_weights)
+        np.take(self._mu, self._neg_instance_index, out=self._neg_weights)
+        return (np.bincount(self._pos_worker_index, weights=self._pos_weights, minlength=self.data.num_workers),
+                np.bincount(self._neg_worker_index, weights=self._neg_weights, minlength=self.data.num_workers))
 
     def _m_step(self):
         """ Perform the M-step. I.e., update log_p, log_alpha, and log_beta.
         """
-        log_mu_ij = ((self.log_mu[0,:] * np.ones((self.data.num_workers, self.data.num_instance))).transpose())
-        log_one_minus_mu_ij = ((self.log_mu[1,:] * np.ones((self.data.num_workers, self.data.num_instance))).transpose())
-        alpha_log_denomi = sp.special.logsumexp(log_mu_ij, axis=0, b=(self.data.y != 0))
-        alpha_log_nume_pos = sp.special.logsumexp(log_mu_ij, axis=0, b=(self.data.y == 1))
-        alpha_log_nume_neg = sp.special.logsumexp(log_mu_ij, axis=0, b=(self.data.y == -1))
-        beta_log_denomi = sp.special.logsumexp(log_one_minus_mu_ij, axis=0, b=(self.data.y != 0))
-        beta_log_nume_pos = sp.special.logsumexp(log_one_minus_mu_ij, axis=0, b=(self.data.y == 1))
-        beta_log_nume_neg = sp.special.logsumexp(log_one_minus_mu_ij, axis=0, b=(self.data.y == -1))
+        mu_pos, mu_neg = self._worker_sums(self.log_mu[0, :])
+        one_minus_mu_pos, one_minus_mu_neg = self._worker_sums(self.log_mu[1, :])
         self.log_p = sp.special.logsumexp(self.log_mu, axis=1)
         self.log_p = self.log_p - sp.special.logsumexp(self.log_p)
-        self.log_alpha = np.array([alpha_log_nume_pos - alpha_log_denomi, alpha_log_nume_neg - alpha_log_denomi])
-        self.log_beta = np.array([beta_log_nume_neg - beta_log_denomi, beta_log_nume_pos - beta_log_denomi])
+        _update_abilities(mu_pos, mu_neg, one_minus_mu_pos, one_minus_mu_neg, self.log_alpha, self.log_beta)
     
     def _q_function(self):
         """ Calculate the value of the Q-function on current estimates.
         """
-        self.log_a = np.sum((self.log_alpha[0, :] \
-                             * np.ones((self.data.num_instance,
-                                        self.data.num_workers))) \
-                            * (self.data.y == 1), axis=1)\
-                     + np.sum((self.log_alpha[1, :] \
-                               * np.ones((self.data.num_instance,
-                                          self.data.num_workers))) \
-                              * (self.data.y == -1), axis=1)
-        self.log_b = np.sum((self.log_beta[0, :] \
-                             * np.ones((self.data.num_instance,
-                                        self.data.num_workers))) \
-                            * (self.data.y == -1), axis=1)\
-                     + np.sum((self.log_beta[1, :] \
-                               * np.ones((self.data.num_instance,
-                                          self.data.num_workers))) \
-                              * (self.data.y == 1), axis=1)
-        log_pa_pb = np.array([self.log_p[0] + (self.log_a), self.log_p[1] + (self.log_b)])
-        return (np.exp(self.log_mu) * log_pa_pb).sum()
-
-    def run_em(self, eps, verbose=False):
-        """ Run EM algorithm
+        self._update_log_a_b()
+        q_value = 0.0
+        for log_mu, log_p, log_a in ((self.log_mu[0, :], self.log_p[0], self.log_a), (self.log_mu[1, :], self.log_p[1], self.log_b)):
+            np.exp(log_mu, out=self._mu)
+            np.add(log_a, log_p, out=self._log_pa)
+            # 0 * log(0) = 0
+            self._log_pa[self._mu == 0] = 0.0
+            q_value += np.dot(self._mu, self._log_pa)
+        return q_value
+
+    def _get_parameters(self):
+        """ Return log_p, log_alpha and log_beta as a vector of logits, on which EM steps are extrapolated.
+        """
+        return np.clip(np.concatenate([[self.log_p[0] - self.log_p[1]],
+                                       self.log_alpha[0, :] - self.log_alpha[1, :],
+                                       self.log_beta[0, :] - self.log_beta[1, :]]), -MAX_LOGIT, MAX_LOGIT)
+
+    def _set_parameters(self, logits):
+        """ Set log_p, log_alpha and log_beta from a vector of logits.
+        """
+        num_workers = self.data.num_workers
+        self.log_p = np.array([-np.logaddexp(0.0, -logits[0]), -np.logaddexp(0.0, logits[0])])
+        for log_array, each_logits in ((self.log_alpha, logits[1:num_workers + 1]), (self.log_beta, logits[num_workers + 1:])):
+            log_array[0, :] = -np.logaddexp(0.0, -each_logits)
+            log_array[1, :] = -np.logaddexp(0.0, each_logits)
+
+    def _save_state(self):
+        """ Save log_p, log_alpha and log_beta, which are restored when an extrapolation is rejected.
+        """
+        return (self.log_p.copy(), self.log_alpha.copy(), self.log_beta.copy())
+
+    def _restore_state(self, state):
+        self.log_p, self.log_alpha, self.log_beta = state
+
+    def save(self, save_dir, worker_ids=None, include_posteriors=True):
+        """ Save the estimates without the data. See FittedLatentClassModel.
+        """
+        FittedLatentClassModel.from_model(self, worker_ids, include_posteriors).save(save_dir)
+
+    def estimated_labels(self, threshold=0.5):
+        """ Estimate the true labels based on the current estimates on the posterior probabilities of the true labels.
 
         :Variables:
-           eps : float
-              tolerable relative errors on the Q-function.
-           verbose : bool
-              if verbose, print the value of the q-function, else don't print.
+            threshold : float
+            A threshold to round the probability. If mu > threshold, return 1. Otherwise, return -1.
+        :RType: numpy.array
+        :Returns: Estimated labels. The length of returned numpy.array = #(instances)
         """
-        q_new = -np.inf
-        q_old = 0
-        convergent = False
-        while not convergent:
-            q_old = q_new
-            self._e_step()
+        return (self.log_mu[0, :] > np.log(threshold)).astype(int) * 2 - 1
+
+
+class MulticlassLatentClassModel(_EMModel):
+    """ Multiclass latent class model (Dawid and Skene, 1979) with a confusion matrix per worker.
+    The observed labels are kept as a sparse indicator matrix, so that the E-step and the M-step are sparse matrix products
+    taking O(#(observed labels) * `num_classes`) time.
+
+    :IVariables:
+        data : crowd_data.CategoricalData
+        log_mu : numpy.array
+            `num_classes` * `num_instances` numpy.array. mu[k, i] = Pr[true_label_i = k | other variables].
+        log_p : numpy.array
+            numpy.array of length `num_classes`. p[k] = Pr[true_label = k].
+        log_pi : numpy.array
+            `num_workers` * `num_classes` * `num_classes` numpy.array. pi[j, k, l] = Pr[label_by_worker_j = l | true_label = k].
+        smoothing : float
+            a pseudo-count added to each element of the confusion matrices in the M-step, which avoids log(0) on unseen pairs of classes.
+        log_likelihood : float
+            the log-likelihood of the parameters before the last E-step.
+    """
+    def __init__(self, crowd_data, smoothing=0.01):
+        self.data = crowd_data
+        self.smoothing = smoothing
+        num_classes = self.data.num_classes
+        instance_index, worker_index, class_index = self.data.observed_entries()
+        # label_matrix[i, j * num_classes + l] = 1 if worker j gives class l to instance i.
+        self._label_matrix = sp.sparse.csr_matrix((np.ones(len(class_index)), (instance_index, worker_index * num_classes + class_index)),
+                                                  shape=(self.data.num_instances, self.data.num_workers * num_classes))
+        self._label_matrix_t = self._label_matrix.T.tocsr()
+
+        # initialized by the majority votes. instances without labels start from the uniform distribution.
+        mv = self.data.majority_vote("prob")
+        mv[np.isnan(mv)] = 1.0 / num_classes
+        with np.errstate(divide="ignore"):
+            self.log_mu = np.log(mv.T)
+        self.log_p = np.zeros(num_classes)
+        self.log_pi = np.zeros((self.data.num_workers, num_classes, num_classes))
+        self.log_likelihood = -np.inf
+        self._m_step()
+
+    def _log_joint(self):
+        """ Return log p[k] + sum of log pi[j, k, l] over the labels (j, l) of instance i, as a `num_instances` * `num_classes` numpy.array.
+        """
+        # log_pi.transpose(0, 2, 1) is indexed by (j, l, k), whose reshaped row j * num_classes + l matches the column of label_matrix.
+        log_pi_matrix = self.log_pi.transpose(0, 2, 1).reshape(self.data.num_workers * self.data.num_classes, self.data.num_classes)
+        return self._label_matrix.dot(log_pi_matrix) + self.log_p
+
+    def _e_step(self):
+        """ Perform the E-step. I.e., update log_mu.
+        """
+        log_joint = self._log_joint()
+        log_normalizer = _logsumexp_rows(log_joint)
+        self.log_likelihood = log_normalizer.sum()
+        self.log_mu = (log_joint - log_normalizer[:, np.newaxis]).T
+
+    def _m_step(self):
+        """ Perform the M-step. I.e., update log_p and log_pi.
+        """
+        num_workers, num_classes = self.data.num_workers, self.data.num_classes
+        # counts[j * num_classes + l, k] = sum of mu[k, i] over instances i to which worker j gives class l.
+        mu = np.exp(self.log_mu.T)
+        counts = self._label_matrix_t.dot(mu)
+        counts = counts.reshape(num_workers, num_classes, num_classes).transpose(0, 2, 1) + self.smoothing
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.log_pi = np.log(counts) - np.log(counts.sum(axis=2))[:, :, np.newaxis]
+        # workers without labels (with no smoothing) do not affect the estimates. their labels are set to be uniform instead of nan.
+        self.log_pi[np.isnan(self.log_pi)] = -np.log(num_classes)
+        with np.errstate(divide="ignore"):
+            self.log_p = np.log(mu.sum(axis=0)) - np.log(mu.sum())
+
+    def _q_function(self):
+        """ Calculate the value of the Q-function on current estimates.
+        """
+        mu = np.exp(self.log_mu.T)
+        log_joint = self._log_joint()
+        # 0 * log(0) = 0
+        log_joint[mu == 0] = 0.0
+        return (mu * log_joint).sum()
+
+    def _get_parameters(self):
+        """ Return log_p and log_pi as a vector, on which EM steps are extrapolated.
+        """
+        return np.clip(np.concatenate([self.log_p, self.log_pi.ravel()]), -MAX_LOGIT, MAX_LOGIT)
+
+    def _set_parameters(self, parameters):
+        """ Set log_p and log_pi from a vector, normalizing them into distributions.
+        """
+        num_classes = self.data.num_classes
+        self.log_p = parameters[:num_classes] - sp.special.logsumexp(parameters[:num_classes])
+        log_pi = parameters[num_classes:].reshape(self.log_pi.shape)
+        self.log_pi = log_pi - sp.special.logsumexp(log_pi, axis=2)[:, :, np.newaxis]
+
+    def _save_state(self):
+        return (self.log_p, self.log_pi)
+
+    def _restore_state(self, state):
+        self.log_p, self.log_pi = state
+
+    def estimated_labels(self):
+        """ Estimate the true labels by the maximum posterior probabilities.
+
+        :RType: numpy.array
+        :Returns: Estimated labels, which are elements of data.labels. The length of returned numpy.array = #(instances)
+        """
+        return self.data.labels[np.argmax(self.log_mu, axis=0)]
+
+
+class FittedLatentClassModel:
+    """ Estimates of a fitted binary latent class model without its training data, which are saved as a small directory of .npy files
+    with header.json (see utils.save_array_dir) and can be memory-mapped.
+    It can warm-start LatentClassModel, and score new responses of the same workers.
+
+    :IVariables:
+        log_p : numpy.array
+            numpy.array of length 2. log(p) and log(1-p).
+        log_alpha : numpy.array
+            2 * `num_workers` numpy.array. log(alpha) and log(1-alpha).
+        log_beta : numpy.array
+            2 * `num_workers` numpy.array. log(beta) and log(1-beta).
+        log_mu : numpy.array
+            2 * `num_instances` numpy.array of log posteriors of the training instances, or None if not saved.
+        worker_ids : list
+            ids of the workers (columns of log_alpha and log_beta), or None if unknown.
+        em_report : dict
+            the convergence report of EM, or None.
+    """
+    def __init__(self, log_p, log_alpha, log_beta, log_mu=None, worker_ids=None, em_report=None):
+        self.log_p = log_p
+        self.log_alpha = log_alpha
+        self.log_beta = log_beta
+        self.log_mu = log_mu
+        self.worker_ids = worker_ids
+        self.em_report = em_report
+
+    @classmethod
+    def from_model(cls, model, worker_ids=None, include_posteriors=True):
+        """ Take the estimates of a LatentClassModel.
+
+        :Variables:
+            model : LatentClassModel
+            worker_ids : list
+                ids of the workers of model.data, or None.
+            include_posteriors : bool
+                keep log_mu, whose size is proportional to the number of instances.
+        :RType: FittedLatentClassModel
+        """
+        if worker_ids is not None and len(worker_ids) != model.log_alpha.shape[1]:
+            raise ValueError("ERROR: the number of worker ids does not match the number of workers.")
+        return cls(np.array(model.log_p), np.array(model.log_alpha), np.array(model.log_beta),
+                   np.array(model.log_mu) if include_posteriors else None,
+                   None if worker_ids is None else [str(each_id) for each_id in worker_ids], getattr(model, "em_report", None))
+
+    def save(self, save_dir):
+        """ save into a directory as .npy files with header.json, which can be memory-mapped by load.
+        """
+        array_dict = {"log_p": self.log_p, "log_alpha": self.log_alpha, "log_beta": self.log_beta}
+        if self.log_mu is not None:
+            array_dict["log_mu"] = self.log_mu
+        save_array_dir(save_dir,
+                       {"format_version": LC_MODEL_FORMAT_VERSION,
+                        "model": "LatentClassModel",
+                        "num_workers": int(self.log_alpha.shape[1]),
+                        "num_instances": None if self.log_mu is None else int(self.log_mu.shape[1]),
+                        "worker_ids": self.worker_ids,
+                        "em_report": self.em_report},
+                       array_dict)
+
+    @classmethod
+    def load(cls, load_dir, mmap_mode="r"):
+        """ load a FittedLatentClassModel saved by save.
+
+        :Variables:
+            load_dir : str
+            mmap_mode : str
+                mmap_mode passed to numpy.load. None to read the arrays into memory.
+        :RType: FittedLatentClassModel
+        """
+        header, array_dict = load_array_dir(load_dir, mmap_mode)
+        if header["format_version"] != LC_MODEL_FORMAT_VERSION:
+            raise ValueError("ERROR: unsupported format version " + str(header["format_version"]) + ".")
+        return cls(array_dict["log_p"], array_dict["log_alpha"], array_dict["log_beta"], array_dict.get("log_mu"),
+                   header["worker_ids"], header["em_report"])
+
+    def worker_index(self, worker_ids):
+        """ Map workers to the workers of this model by their ids.
+
+        :Variables:
+            worker_ids : list
+        :RType: numpy.array
+        :Returns: numpy.array of length len(worker_ids), the index of each worker in this model, or -1 if unknown.
+        """
+        if self.worker_ids is None:
+            raise ValueError("ERROR: the model does not have worker ids.")
+        worker_dict = dict(zip(self.worker_ids, range(len(self.worker_ids))))
+        return np.array([worker_dict.get(str(each_id), -1) for each_id in worker_ids], dtype=int)
+
+    def score(self, crowd_data, worker_ids=None):
+        """ Compute the posteriors of instances from their labels by the E-step with the fitted estimates.
+        Workers unknown to the model do not affect the posteriors.
+
+        :Variables:
+            crowd_data : crowd_data.BinaryData
+            worker_ids : list
+                ids of the workers of crowd_data, or None if they are in the same order as the model.
+        :RType: numpy.array
+        :Returns: 2 * `num_instances` numpy.array. log(mu) and log(1-mu).
+        """
+        if worker_ids is None:
+            worker_index = np.arange(crowd_data.num_workers)
+            worker_index[worker_index >= self.log_alpha.shape[1]] = -1
+        else:
+            worker_index = self.worker_index(worker_ids)
+        # abilities of unknown workers are 1/2, whose labels do not change the posteriors.
+        log_alpha = np.full((2, crowd_data.num_workers), np.log(0.5))
+        log_beta = np.full((2, crowd_data.num_workers), np.log(0.5))
+        known = (worker_index >= 0)
+        log_alpha[:, known] = self.log_alpha[:, worker_index[known]]
+        log_beta[:, known] = self.log_beta[:, worker_index[known]]
+        model = LatentClassModel(crowd_data)
+        model.warm_start(types.SimpleNamespace(log_p=self.log_p, log_alpha=log_alpha, log_beta=log_beta))
+        return model.log_mu
+
+    def estimated_labels(self, threshold=0.5):
+        """ Estimate the true labels of the training instances from the saved posteriors.
+
+        :RType: numpy.array
+        :Returns: Estimated labels. The length of returned numpy.array = #(instances)
+        """
+        if self.log_mu is None:
+            raise ValueError("ERROR: the posteriors are not saved.")
+        return (self.log_mu[0, :] > np.log(threshold)).astype(int) * 2 - 1
+
+def load_latent_class_model(path, mmap_mode="r"):
+    """ load a fitted latent class model from a directory saved by FittedLatentClassModel.save, or a legacy pickle of LatentClassModel.
+
+    :Variables:
+        path : str
+        mmap_mode : str
+    :RType: FittedLatentClassModel or LatentClassModel
+    """
+    if os.path.isdir(path):
+        return FittedLatentClassModel.load(path, mmap_mode)
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+# data sets shared by the processes of fit_latent_class_models, which are sent once per process.
+_shared_crowd_data_list = None
+
+def _init_fit_process(crowd_data_list):
+    global _shared_crowd_data_list
+    _shared_crowd_data_list = crowd_data_list
+
+def _fit_restart(crowd_data, data_index, restart, seed, noise, eps, run_em_kwargs):
+    """ Fit a latent class model from the majority votes (restart 0) or from a randomized initialization.
+
+    :RType: dict
+    :Returns:
+        the convergence report with the estimates log_p, log_alpha and log_beta,
+        where log_likelihood is replaced by the log-likelihood of these estimates, on which restarts are compared.
+    """
+    model = LatentClassModel(crowd_data)
+    if restart > 0:
+        model.randomize(np.random.RandomState([seed, data_index, restart]), noise)
+    report = model.run_em(eps, **run_em_kwargs)
+    # log_likelihood of run_em may be of the parameters before the last M-step.
+    model._e_step()
+    report["log_likelihood"] = float(model.log_likelihood)
+    report.update({"data_index": data_index, "restart": restart,
+                   "log_p": model.log_p, "log_alpha": model.log_alpha, "log_beta": model.log_beta})
+    return report
+
+def _fit_shared_restart(data_index, restart, seed, noise, eps, run_em_kwargs):
+    return _fit_restart(_shared_crowd_data_list[data_index], data_index, restart, seed, noise, eps, run_em_kwargs)
+
+def fit_latent_class_models(crowd_data_list, num_restarts=1, num_workers=1, seed=0, noise=0.5, eps=10 ** (-10), metrics=None,
+                            **run_em_kwargs):
+    """ Fit latent class models on independent data sets (e.g., of batches or configurations) with multiple restarts,
+    and keep the fit with the highest log-likelihood for each data set.
+    The first restart starts from the majority votes, and the others from randomized initializations (see LatentClassModel.randomize).
+    All the restarts of all the data sets are run in `num_workers` processes.
+
+    :Variables:
+        crowd_data_list : list
+            a list of crowd_data.BinaryData.
+        num_restarts : int
+            the number of EM restarts per data set.
+        num_workers : int
+            the number of processes.
+        seed : int
+            a random seed of the randomized initializations.
+        noise : float
+            the weight of random numbers in the randomized initializations.
+        eps : float
+            tolerable relative errors on the Q-function.
+        metrics : instrumentation.MetricsLogger
+            records the convergence report of each restart.
+        run_em_kwargs : dict
+            keyword arguments of LatentClassModel.run_em, e.g., max_iter, time_budget or accelerate.
+    :RType: list
+    :Returns:
+        a list of (model, reports) for each data set, where model is the best LatentClassModel,
+        and reports is a list of the convergence reports of the restarts.
+    """
+    metrics = MetricsLogger() if metrics is None else metrics
+    tasks = [(data_index, restart) for data_index in range(len(crowd_data_list)) for restart in range(num_restarts)]
+    with metrics.stage("fit_latent_class_models", num_items=len(tasks), unit="restarts", num_data_sets=len(crowd_data_list),
+                       num_restarts=num_restarts, num_workers=num_workers):
+        if num_workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_fit_process, initargs=(crowd_data_list,)) as executor:
+                futures = [executor.submit(_fit_shared_restart, data_index, restart, seed, noise, eps, run_em_kwargs)
+                           for data_index, restart in tasks]
+                fit_list = [future.result() for future in futures]
+        else:
+            fit_list = [_fit_restart(crowd_data_list[data_index], data_index, restart, seed, noise, eps, run_em_kwargs)
+                        for data_index, restart in tasks]
+
+    result_list = []
+    for data_index, crowd_data in enumerate(crowd_data_list):
+        report_list = [fit for fit in fit_list if fit["data_index"] == data_index]
+        best_fit = max(report_list, key=lambda fit: (fit["log_likelihood"], -fit["restart"]))
+        # the best estimates are set to a model on the data in this process, whose posteriors are given by the E-step.
+        model = LatentClassModel(crowd_data)
+        model.warm_start(types.SimpleNamespace(log_p=best_fit["log_p"], log_alpha=best_fit["log_alpha"], log_beta=best_fit["log_beta"]))
+        reports = []
+        for fit in report_list:
+            report = {key: value for key, value in fit.items() if key not in ("log_p", "log_alpha", "log_beta")}
+            report["best"] = fit is best_fit
+            metrics.log("em_restart", **report)
+            reports.append(report)
+            if report["best"]:
+                model.em_report = report
+        result_list.append((model, reports))
+    return result_list
+
+def fit_latent_class_model(crowd_data, num_restarts=1, num_workers=1, seed=0, noise=0.5, eps=10 ** (-10), metrics=None, **run_em_kwargs):
+    """ Fit a latent class model with multiple restarts in parallel processes. See fit_latent_class_models.
+
+    :RType: tuple
+    :Returns: (model, reports)
+    """
+    return fit_latent_class_models([crowd_data], num_restarts, num_workers, seed, noise, eps, metrics, **run_em_kwargs)[0]
+
+
+class OnlineLatentClassModel:
+    """ Binary latent class model updated online as new labels arrive.
+    Sums of mu and 1-mu over the positive and negative labels of each worker are kept as sufficient statistics of the M-step.
+    A batch of new labels updates only the instances labeled in the batch: their contributions to the statistics are removed,
+    their posteriors are re-estimated by the E-step, the contributions are added back, and log_p, log_alpha and log_beta are updated
+    from the statistics. Since posteriors of the other instances are not updated, the model is re-fitted on all the labels
+    by `LatentClassModel` every `refit_every` batches, warm-started from the current estimates.
+
+    :IVariables:
+        num_instances : int
+        num_workers : int
+            the numbers of instances and workers so far. Both axes grow as batches arrive.
+        log_mu : numpy.array
+            2 * `num_instances` numpy.array. mu = Pr[true_label = 1 | other variables]. The 1st row contains log(mu), and the 2nd log(1-mu).
+        log_p : numpy.array
+            numpy.array of length 2. p = Pr[true_label = 1]. The 1st element contains log(p), and the 2nd log(1-p).
+        log_alpha : numpy.array
+            2 * `num_workers` numpy.array. alpha_j = Pr[label_by_worker_j = 1 | true_label = 1]. The 1st row contains log(aloha), and the 2nd log(1-alpha).
+        log_beta : numpy.array
+            2 * `num_workers` numpy.array. beta_j = Pr[label_by_worker_j = 0 | true_label = 0]. The 1st row contains log(beta), and the 2nd log(1-beta).
+        refit_every : int
+            the number of batches between full re-fits, or None not to re-fit automatically.
+        eps : float
+            tolerable relative errors on the Q-function of the full re-fits.
+        max_iter : int
+        time_budget : float
+            the maximum number of EM iterations and the time budget [sec] of the full re-fits, or None for no limit.
+        num_inner_iterations : int
+            the number of E- and M-steps on the instances of each batch.
+        num_batches : int
+            the number of batches absorbed since the last full re-fit.
+    """
+    def __init__(self, refit_every=None, eps=10 ** (-10), max_iter=None, time_budget=None, num_inner_iterations=1):
+        self.num_instances = 0
+        self.num_workers = 0
+        self.log_p = np.log(np.array([0.5, 0.5]))
+        self.log_alpha = np.zeros((2, 0))
+        self.log_beta = np.zeros((2, 0))
+        self.refit_every = refit_every
+        self.eps = eps
+        self.max_iter = max_iter
+        self.time_budget = time_budget
+        self.num_inner_iterations = num_inner_iterations
+        self.num_batches = 0
+        self._log_mu = np.zeros((2, 0))
+        # sums of mu over positive labels, mu over negative labels, 1-mu over positive labels and 1-mu over negative labels of each worker.
+        self._worker_statistics = np.zeros((4, 0))
+        # sums of mu and 1-mu over all the instances.
+        self._sum_mu = np.zeros(2)
+        # labels absorbed so far. a label overwritten by a later label of the same worker on the same instance is set to 0.
+        self._instance_index = np.zeros(0, dtype=np.intp)
+        self._worker_index = np.zeros(0, dtype=np.intp)
+        self._label = np.zeros(0, dtype=np.int8)
+        self._num_entries = 0
+
+    @property
+    def log_mu(self):
+        return self._log_mu[:, :self.num_instances]
+
+    def _grow(self, num_instances, num_workers):
+        """ Extend the instance and worker axes. New instances start from mu = p, and new workers from abilities of 1/2.
+        """
+        if num_instances > self.num_instances:
+            self._log_mu = _reserve(self._log_mu, num_instances)
+            self._log_mu[:, self.num_instances:num_instances] = self.log_p[:, np.newaxis]
+            self._sum_mu += (num_instances - self.num_instances) * np.exp(self.log_p)
+            self.num_instances = num_instances
+        if num_workers > self.num_workers:
+            num_new_workers = num_workers - self.num_workers
+            self.log_alpha = np.hstack([self.log_alpha, np.full((2, num_new_workers), np.log(0.5))])
+            self.log_beta = np.hstack([self.log_beta, np.full((2, num_new_workers), np.log(0.5))])
+            self._worker_statistics = np.hstack([self._worker_statistics, np.zeros((4, num_new_workers))])
+            self.num_workers = num_workers
+
+    def _append_entries(self, instance_index, worker_index, label):
+        """ Append labels, and return their positions.
+        """
+        num_entries = self._num_entries + len(label)
+        self._instance_index = _reserve(self._instance_index, num_entries)
+        self._worker_index = _reserve(self._worker_index, num_entries)
+        self._label = _reserve(self._label, num_entries)
+        self._instance_index[self._num_entries:num_entries] = instance_index
+        self._worker_index[self._num_entries:num_entries] = worker_index
+        self._label[self._num_entries:num_entries] = label
+        positions = np.arange(self._num_entries, num_entries)
+        self._num_entries = num_entries
+        return positions
+
+    def _add_statistics(self, entries, instances, sign):
+        """ Add (sign = 1.0) or remove (sign = -1.0) the contributions of labels and instances to the sufficient statistics.
+
+        :Variables:
+            entries : numpy.array
+                positions of labels.
+            instances : numpy.array
+                indices of instances.
+            sign : float
+        """
+        instance_index = self._instance_index[entries]
+        worker_index = self._worker_index[entries]
+        is_pos = (self._label[entries] == 1)
+        for k, (log_mu, labeled) in enumerate([(0, is_pos), (0, ~is_pos), (1, is_pos), (1, ~is_pos)]):
+            self._worker_statistics[k, :] += sign * np.bincount(worker_index[labeled], weights=np.exp(self._log_mu[log_mu, instance_index[labeled]]),
+                                                                minlength=self.num_workers)
+        self._sum_mu += sign * np.exp(self._log_mu[:, instances]).sum(axis=1)
+
+    def _e_step(self, entries, instances):
+        """ Update log_mu of instances (sorted indices) from their labels.
+        """
+        local_index = np.searchsorted(instances, self._instance_index[entries])
+        is_pos = (self._label[entries] == 1)
+        worker_index = self._worker_index[entries]
+        log_a = np.bincount(local_index, weights=np.where(is_pos, self.log_alpha[0, worker_index], self.log_alpha[1, worker_index]),
+                            minlength=len(instances))
+        log_b = np.bincount(local_index, weights=np.where(is_pos, self.log_beta[1, worker_index], self.log_beta[0, worker_index]),
+                            minlength=len(instances))
+        log_mu = np.array([self.log_p[0] + log_a, self.log_p[1] + log_b])
+        self._log_mu[:, instances] = log_mu - np.logaddexp(log_mu[0, :], log_mu[1, :])
+
+    def _m_step(self):
+        """ Update log_p, log_alpha and log_beta from the sufficient statistics.
+        """
+        # the statistics may become slightly negative by rounding errors.
+        statistics = np.maximum(self._worker_statistics, 0.0)
+        _update_abilities(statistics[0, :], statistics[1, :], statistics[2, :], statistics[3, :], self.log_alpha, self.log_beta)
+        sum_mu = np.maximum(self._sum_mu, 0.0)
+        if sum_mu.sum() > 0:
+            with np.errstate(divide="ignore"):
+                self.log_p = np.log(sum_mu) - np.log(sum_mu.sum())
+
+    def absorb(self, crowd_data, metrics=None):
+        """ Absorb a batch of new labels.
+
+        :Variables:
+            crowd_data : crowd_data.BinaryData
+                new labels, whose instances and workers are indexed in the same way as the previous batches.
+                Its numbers of instances and workers may be larger than those of the model.
+                A new label overwrites the label of the same worker on the same instance.
+            metrics : instrumentation.MetricsLogger
+                records the number of labels of the batch and the full re-fit if any.
+        """
+        metrics = MetricsLogger() if metrics is None else metrics
+        instance_index, worker_index, label = crowd_data.observed_entries()
+        with metrics.stage("absorb", num_items=len(label), unit="labels") as record:
+            self._grow(crowd_data.num_instances, crowd_data.num_workers)
+            instances = np.unique(instance_index)
+            is_affected = np.zeros(self.num_instances, dtype=bool)
+            is_affected[instances] = True
+            old_entries = np.nonzero(is_affected[self._instance_index[:self._num_entries]] & (self._label[:self._num_entries] != 0))[0]
+            has_old_labels = np.zeros(len(instances), dtype=bool)
+            has_old_labels[np.searchsorted(instances, self._instance_index[old_entries])] = True
+            self._add_statistics(old_entries, instances, -1.0)
+
+            # keep the last label of each worker on each instance.
+            entries = np.concatenate([old_entries, self._append_entries(instance_index, worker_index, label)])
+            key = self._instance_index[entries].astype(np.int64) * self.num_workers + self._worker_index[entries]
+            order = np.lexsort((entries, key))
+            is_last = np.append(key[order][1:] != key[order][:-1], True)
+            self._label[entries[order[~is_last]]] = 0
+            entries = np.sort(entries[order[is_last]])
+
+            # instances labeled for the first time start from the majority votes, as in LatentClassModel.
+            new_instances = instances[~has_old_labels]
+            if len(new_instances) > 0:
+                is_new = ~has_old_labels[np.searchsorted(instances, self._instance_index[entries])]
+                local_index = np.searchsorted(new_instances, self._instance_index[entries[is_new]])
+                num_pos = np.bincount(local_index, weights=(self._label[entries[is_new]] == 1), minlength=len(new_instances))
+                num_labels = np.bincount(local_index, minlength=len(new_instances))
+                mv = num_pos / num_labels
+                with np.errstate(divide="ignore"):
+                    self._log_mu[:, new_instances] = np.log(np.array([mv, 1.0 - mv]))
+            self._add_statistics(entries, instances, 1.0)
             self._m_step()
-            q_new = self._q_function()
-            convergent = (np.abs(q_old - q_new) / np.abs(q_new) < eps)
-            if verbose:
-                if q_new - q_old < 0:
-                    sys.stderr.write("WARNING: Q-function decreases. Something might be wrong.\n")
-                    sys.stderr.flush()
-                sys.stdout.write("\r " + "q_func = " + str(q_new) + "\n")
-                sys.stdout.flush()
-
-        sys.stdout.write("\n"+"Converged. Relative_err = " + str(np.abs(q_old - q_new) / np.abs(q_new)) + "\n")
+            for _ in range(self.num_inner_iterations):
+                self._add_statistics(entries, instances, -1.0)
+                self._e_step(entries, instances)
+                self._add_statistics(entries, instances, 1.0)
+                self._m_step()
+            self.num_batches += 1
+            record["num_instances"] = len(instances)
+            record["total_labels"] = self.num_labels()
+        if self.refit_every is not None and self.num_batches >= self.refit_every:
+            self.refit(metrics=metrics)
+
+    def num_labels(self):
+        """ Return the number of labels absorbed so far, except overwritten ones.
+        """
+        return int(np.count_nonzero(self._label[:self._num_entries]))
+
+    def to_binary_data(self):
+        """ Return all the labels absorbed so far as BinaryData with a sparse response array.
+        """
+        kept = np.nonzero(self._label[:self._num_entries])[0]
+        return BinaryData(sp.sparse.csr_matrix((self._label[kept], (self._instance_index[kept], self._worker_index[kept])),
+                                               shape=(self.num_instances, self.num_workers)))
+
+    def refit(self, metrics=None, **run_em_kwargs):
+        """ Re-fit the model on all the labels absorbed so far, starting from the current estimates, and reset the sufficient statistics.
+
+        :Variables:
+            metrics : instrumentation.MetricsLogger
+            run_em_kwargs : dict
+                keyword arguments of LatentClassModel.run_em, which override max_iter and time_budget. EM is accelerated by default.
+        :RType: dict
+        :Returns: the convergence report of LatentClassModel.run_em.
+        """
+        run_em_kwargs.setdefault("accelerate", True)
+        run_em_kwargs.setdefault("max_iter", self.max_iter)
+        run_em_kwargs.setdefault("time_budget", self.time_budget)
+        # drop overwritten labels.
+        kept = np.nonzero(self._label[:self._num_entries])[0]
+        self._instance_index = self._instance_index[kept]
+        self._worker_index = self._worker_index[kept]
+        self._label = self._label[kept]
+        self._num_entries = len(kept)
+        model = LatentClassModel(self.to_binary_data())
+        model.warm_start(self)
+        report = model.run_em(self.eps, metrics=metrics, **run_em_kwargs)
+        self._log_mu[:, :self.num_instances] = model.log_mu
+        self.log_p = model.log_p.copy()
+        self.log_alpha = model.log_alpha.copy()
+        self.log_beta = model.log_beta.copy()
+        self._worker_statistics[:] = 0.0
+        self._sum_mu[:] = 0.0
+        self._add_statistics(np.arange(self._num_entries), np.arange(self.num_instances), 1.0)
+        self.num_batches = 0
+        return report
 
     def estimated_labels(self, threshold=0.5):
         """ Estimate the true labels based on the current estimates on the posterior probabilities of the true labels.
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+""" Bidirectional index between clickable areas in mosaics and those in the original images.
+
+Clickable areas (sub-subinstances) share the index set of subinstance_org_loc_list and mosaic_loc_list:
+the area `area_i` is the (l, m)-th clickable area of the subinstance `area_i // (expand * expand)`,
+where `l, m = divmod(area_i % (expand * expand), expand)`.
+A location in a mosaic is given in the unit of clickable areas, i.e., (mosaic_id, row, col) as in the crowdsourced answers "row_col",
+and a location in an original image is given in pixels, i.e., (img_index, top, left).
+All the lookups are arithmetic, and accept numpy.arrays for batch lookups.
+"""
+
+# metadata variables
+__author__ = "Hiroshi KAJINO <hiroshi.kajino.1989@gmail.com>"
+__date__ = "2014/04/25"
+__version__ = "1.0"
+__copyright__ = "Copyright (c) 2014 Hiroshi Kajino all rights reserved."
+__docformat__ = "restructuredtext en"
+
+import numpy as np
+from utils import load_parameters, as_loc_array
+
+
+class MosaicIndex:
+    """ Bidirectional index between mosaic cells and original locations.
+
+    :IVariables:
+        subinstance_size : int
+        clickable_size : int
+        num_subinstances_to_combine : int
+        expand : int
+            the number of clickable areas on one side of a subinstance.
+        num_rows : numpy.array
+            num_rows[i] is the number of clipping windows along rows of the i-th image.
+        num_cols : numpy.array
+            num_cols[i] is the number of clipping windows along columns of the i-th image.
+        first_subinstance : numpy.array
+            the subinstances of the i-th image are first_subinstance[i], ..., first_subinstance[i + 1] - 1.
+        perm : numpy.array
+            perm[patch_i] is the subinstance on the patch_i-th slot of the mosaics, or -1 if the slot is empty.
+        slot : numpy.array
+            the inverse of perm, i.e., perm[slot[s]] == s.
+    """
+    def __init__(self, num_rows, num_cols, subinstance_size, clickable_size, num_subinstances_to_combine, perm):
+        """ Initialization
+
+        :Variables:
+            num_rows : numpy.array
+            num_cols : numpy.array
+            subinstance_size : int
+            clickable_size : int
+            num_subinstances_to_combine : int
+            perm : numpy.array
+                the permutation used by combine_subinstances. It may contain -1 for empty slots.
+        """
+        self.subinstance_size = subinstance_size
+        self.clickable_size = clickable_size
+        self.num_subinstances_to_combine = num_subinstances_to_combine
+        self.expand = subinstance_size // clickable_size
+        self.step_size = subinstance_size // 2
+        self.num_rows = np.asarray(num_rows, dtype=int)
+        self.num_cols = np.asarray(num_cols, dtype=int)
+        self.first_subinstance = np.concatenate([[0], np.cumsum(self.num_rows * self.num_cols)]).astype(int)
+        num_slots = num_subinstances_to_combine * num_subinstances_to_combine
+        self.num_mosaics = -(-len(perm) // num_slots)
+        self.perm = -np.ones(self.num_mosaics * num_slots, dtype=int)
+        self.perm[:len(perm)] = perm
+        self.slot = -np.ones(self.num_subinstances, dtype=int)
+        filled = (self.perm >= 0).nonzero()[0]
+        self.slot[self.perm[filled]] = filled
+        if (self.slot < 0).any():
+            raise ValueError("ERROR: some subinstances are not placed on mosaics.")
+
+    @property
+    def num_subinstances(self):
+        return int(self.first_subinstance[-1])
+
+    @property
+    def num_areas(self):
+        return self.num_subinstances * self.expand * self.expand
+
+    @classmethod
+    def from_shapes(cls, img_shape_list, subinstance_size, clickable_size, num_subinstances_to_combine, perm):
+        """ Build an index from the shapes of NORMALIZED images and the permutation of combine_subinstances.
+
+        :Variables:
+            img_shape_list : list
+            subinstance_size : int
+            clickable_size : int
+            num_subinstances_to_combine : int
+            perm : numpy.array
+        :RType: MosaicIndex
+        """
+        shape_array = np.array([img_shape[:2] for img_shape in img_shape_list], dtype=float).reshape(-1, 2)
+        grid_array = np.maximum(np.ceil(2.0 * shape_array / float(subinstance_size) - 1.0), 0).astype(int)
+        return cls(grid_array[:, 0], grid_array[:, 1], subinstance_size, clickable_size, num_subinstances_to_combine, perm)
+
+    @classmethod
+    def from_loc_lists(cls, subinstance_org_loc_list, mosaic_loc_list,
+                       subinstance_size, clickable_size, num_subinstances_to_combine):
+        """ Build an index from the location lists saved by instance_clipping_and_mixing.py.
+
+        :Variables:
+            subinstance_org_loc_list : list or numpy.array
+            mosaic_loc_list : list or numpy.array
+            subinstance_size : int
+            clickable_size : int
+            num_subinstances_to_combine : int
+        :RType: MosaicIndex
+        """
+        expand = subinstance_size // clickable_size
+        step_size = subinstance_size // 2
+        # the location of the (0, 0)-th clickable area is that of the subinstance.
+        org_head = np.asarray(as_loc_array(subinstance_org_loc_list))[::expand * expand]
+        mosaic_head = np.asarray(as_loc_array(mosaic_loc_list))[::expand * expand]
+        num_images = int(org_head[:, 0].max()) + 1 if len(org_head) > 0 else 0
+        num_rows = np.zeros(num_images, dtype=int)
+        num_cols = np.zeros(num_images, dtype=int)
+        np.maximum.at(num_rows, org_head[:, 0], org_head[:, 1] // step_size + 1)
+        np.maximum.at(num_cols, org_head[:, 0], org_head[:, 2] // step_size + 1)
+        slot = mosaic_head[:, 0] * num_subinstances_to_combine * num_subinstances_to_combine \
+               + (mosaic_head[:, 1] // subinstance_size) * num_subinstances_to_combine \
+               + mosaic_head[:, 2] // subinstance_size
+        perm = -np.ones(int(slot.max()) + 1 if len(slot) > 0 else 0, dtype=int)
+        perm[slot] = np.arange(len(slot))
+        return cls(num_rows, num_cols, subinstance_size, clickable_size, num_subinstances_to_combine, perm)
+
+    @classmethod
+    def from_parameters(cls, parameters_path):
+        """ Build an index from the parameters saved by instance_clipping_and_mixing.py.
+
+        :Variables:
+            parameters_path : str
+        :RType: MosaicIndex
+        """
+        args_ic, _, subinstance_org_loc_list, mosaic_loc_list = load_parameters(parameters_path)
+        return cls.from_loc_lists(subinstance_org_loc_list, mosaic_loc_list,
+                                  args_ic.subinstance_size, args_ic.clickable_size, args_ic.num_subinstances_to_combine)
+
+    def area_to_original(self, area_i):
+        """ Return the original location of clickable areas.
+
+        :Variables:
+            area_i : int or numpy.array
+        :RType: tuple
+        :Returns:
+            (img_index, top, left)
+        """
+        subinstance_i, area_in_subinstance = np.divmod(np.asarray(area_i), self.expand * self.expand)
+        l, m = np.divmod(area_in_subinstance, self.expand)
+        img_index = np.searchsorted(self.first_subinstance, subinstance_i, side="right") - 1
+        j, k = np.divmod(subinstance_i - self.first_subinstance[img_index], np.maximum(self.num_cols[img_index], 1))
+        return (img_index,
+                self.step_size * j + l * self.clickable_size,
+                self.step_size * k + m * self.clickable_size)
+
+    def area_to_mosaic(self, area_i):
+        """ Return the mosaic cells of clickable areas.
+
+        :Variables:
+            area_i : int or numpy.array
+        :RType: tuple
+        :Returns:
+            (mosaic_id, row, col), where row and col are in the unit of clickable areas.
+        """
+        subinstance_i, area_in_subinstance = np.divmod(np.asarray(area_i), self.expand * self.expand)
+        l, m = np.divmod(area_in_subinstance, self.expand)
+        mosaic_id, cell_i = np.divmod(self.slot[subinstance_i], self.num_subinstances_to_combine * self.num_subinstances_to_combine)
+        i, j = np.divmod(cell_i, self.num_subinstances_to_combine)
+        return (mosaic_id, i * self.expand + l, j * self.expand + m)
+
+    def mosaic_to_area(self, mosaic_id, row, col):
+        """ Return the clickable areas on mosaic cells.
+
+        :Variables:
+            mosaic_id : int or numpy.array
+            row : int or numpy.array
+            col : int or numpy.array
+        :RType: int or numpy.array
+        :Returns:
+            the indices of clickable areas, or -1 if no subinstance is placed on the cell.
+        """
+        mosaic_id, row, col = np.broadcast_arrays(mosaic_id, row, col)
+        i, l = np.divmod(row, self.expand)
+        j, m = np.divmod(col, self.expand)
+        cells_per_side = self.num_subinstances_to_combine
+        valid = (mosaic_id >= 0) & (mosaic_id < self.num_mosaics) \
+                & (row >= 0) & (i < cells_per_side) & (col >= 0) & (j < cells_per_side)
+        slot = np.where(valid, (mosaic_id * cells_per_side + i) * cells_per_side + j, 0)
+        subinstance_i = np.where(valid, self.perm[slot] if len(self.perm) > 0 else -1, -1)
+        area_i = np.where(subinstance_i >= 0, subinstance_i * self.expand * self.expand + l * self.expand + m, -1)
+        return area_i if area_i.ndim > 0 else int(area_i)
+
+    def mosaic_to_original(self, mosaic_id, row, col):
+        """ Return the original locations of mosaic cells.
+
+        :Variables:
+            mosaic_id : int or numpy.array
+            row : int or numpy.array
+            col : int or numpy.array
+        :RType: tuple
+        :Returns:
+            (img_index, top, left), which are -1 if no subinstance is placed on the cell.
+        """
+        area_i = np.asarray(self.mosaic_to_area(mosaic_id, row, col))
+        img_index, top, left = self.area_to_original(np.maximum(area_i, 0))
+        empty = area_i < 0
+        return (np.where(empty, -1, img_index), np.where(empty, -1, top), np.where(empty, -1, left))
+
+    def original_to_areas(self, img_index, top, left):
+        """ Return all the clickable areas whose left-top corner is at (top, left) of an original image.
+        Since clipping windows overlap, one location is shared by up to expand * expand clickable areas.
+
+        :Variables:
+            img_index : int or numpy.array
+            top : int or numpy.array
+            left : int or numpy.array
+        :RType: numpy.array
+        :Returns:
+            an array whose last axis has length expand * expand, containing the indices of clickable areas (or -1).
+        """
+        img_index, top, left = np.broadcast_arrays(img_index, top, left)
+        l, m = np.indices((self.expand, self.expand)).reshape(2, -1)
+        j, j_res = np.divmod(top[..., np.newaxis] - l * self.clickable_size, self.step_size)
+        k, k_res = np.divmod(left[..., np.newaxis] - m * self.clickable_size, self.step_size)
+        img_index = img_index[..., np.newaxis]
+        valid_img = (img_index >= 0) & (img_index < len(self.num_rows))
+        safe_img = np.where(valid_img, img_index, 0)
+        valid = valid_img & (j_res == 0) & (k_res == 0) & (j >= 0) & (k >= 0) \
+                & (j < self.num_rows[safe_img]) & (k < self.num_cols[safe_img])
+        subinstance_i = self.first_subinstance[safe_img] + j * self.num_cols[safe_img] + k
+        return np.where(valid, subinstance_i * self.expand * self.expand + l * self.expand + m, -1)
+
+    def original_to_mosaic(self, img_index, top, left):
+        """ Return all the mosaic cells showing the clickable area whose left-top corner is at (top, left) of an original image.
+
+        :Variables:
+            img_index : int or numpy.array
+            top : int or numpy.array
+            left : int or numpy.array
+        :RType: tuple
+        :Returns:
+            (mosaic_id, row, col), whose last axes have length expand * expand and are -1 where there is no such cell.
+        """
+        area_i = self.original_to_areas(img_index, top, left)
+        mosaic_id, row, col = self.area_to_mosaic(np.maximum(area_i, 0))
+        empty = area_i < 0
+        return (np.where(empty, -1, mosaic_id), np.where(empty, -1, row), np.where(empty, -1, col))
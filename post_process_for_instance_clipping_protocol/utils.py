@@ -8,7 +8,15 @@ __version__ = "1.0"
 __copyright__ = "Copyright (c) 2014 Hiroshi Kajino all rights reserved."
 __docformat__ = "restructuredtext en"
 
+import os
+import json
 import pickle
+import hashlib
+import argparse
+import numpy as np
+import cv2
+
+PARAMETERS_FORMAT_VERSION = 1
 
 
 def load_pickle_files(input_file_path):
@@ -24,3 +32,161 @@ def load_pickle_files(input_file_path):
     with open(input_file_path, "rb") as f:
         tmp = pickle.load(f)
     return tmp
+
+
+def load_converted_result(converted_result_path):
+    """ load converted_result.pkl created by convert_data.py.
+
+    :Variables:
+        converted_result_path : str
+    :RType: tuple
+    :Returns:
+        (org_loc_list_without_repetition, converted_result_array, worker_ids)
+        worker_ids is None if the file was created before worker IDs were saved together.
+    """
+    converted_result = load_pickle_files(converted_result_path)
+    if len(converted_result) == 2:
+        return (converted_result[0], converted_result[1], None)
+    return tuple(converted_result)
+
+
+def load_parameters(parameters_path, load_images=False, mmap_mode="r"):
+    """ load parameters created by instance_clipping_and_mixing.py, reading only the parts that are needed.
+
+    :Variables:
+        parameters_path : str
+            A path to the parameters directory (or its header.json), or to a legacy parameters.pkl.
+        load_images : bool
+            if True, decode and normalize the original images, after checking their sha1 hashes.
+            Otherwise, img_list is None.
+        mmap_mode : str
+            mmap_mode passed to numpy.load for the location tables. None to read them into memory.
+    :RType: tuple
+    :Returns:
+        (args_ic, img_list, subinstance_org_loc_list, mosaic_loc_list)
+    """
+    if os.path.isfile(parameters_path) and not parameters_path.endswith(".json"):
+        args_ic, img_list, subinstance_org_loc_list, mosaic_loc_list = load_pickle_files(parameters_path)
+        return (args_ic, img_list if load_images else None, subinstance_org_loc_list, mosaic_loc_list)
+
+    if parameters_path.endswith(".json"):
+        parameters_path = os.path.dirname(parameters_path)
+    with open(os.path.join(parameters_path, "header.json"), "r") as f:
+        header = json.load(f)
+    if header["format_version"] != PARAMETERS_FORMAT_VERSION:
+        raise ValueError("ERROR: unsupported format version " + str(header["format_version"]) + ".")
+    args_ic = argparse.Namespace(**header["args"])
+    subinstance_org_loc_list = np.load(os.path.join(parameters_path, "subinstance_org_loc.npy"), mmap_mode=mmap_mode)
+    mosaic_loc_list = np.load(os.path.join(parameters_path, "mosaic_loc.npy"), mmap_mode=mmap_mode)
+    img_list = None
+    if load_images:
+        img_list = [_load_normalized_image(each_image, os.path.dirname(os.path.abspath(parameters_path)))
+                    for each_image in header["images"]]
+    return (args_ic, img_list, subinstance_org_loc_list, mosaic_loc_list)
+
+
+def _load_normalized_image(image_entry, output_dir):
+    """ decode an image referenced by a header entry and pad it into its normalized shape.
+    If the normalized image has been cached by an incremental run, it is loaded from the cache instead.
+
+    :Variables:
+        image_entry : dict
+            {"path": path to the image, "sha1": sha1 hash of the image file, "shape": normalized shape (, "cache": path to the cache)}
+        output_dir : str
+            the directory containing the parameters directory.
+    :RType: numpy.array
+    :Returns:
+        the normalized image.
+    """
+    if "cache" in image_entry and os.path.exists(os.path.join(output_dir, image_entry["cache"])):
+        # copy-on-write, since callers may draw on the images.
+        return np.load(os.path.join(output_dir, image_entry["cache"]), mmap_mode="c")
+    with open(image_entry["path"], "rb") as f:
+        contents = f.read()
+    if hashlib.sha1(contents).hexdigest() != image_entry["sha1"]:
+        raise ValueError("ERROR: " + image_entry["path"] + " has been changed after instance clipping.")
+    if image_entry["path"].endswith(".npy"):
+        img = np.load(image_entry["path"])
+        if img.ndim == 2:
+            img = np.repeat(img[:, :, np.newaxis], 3, axis=2)
+    else:
+        img = cv2.imdecode(np.frombuffer(contents, dtype=np.uint8), cv2.IMREAD_COLOR)
+    normalized_img = np.zeros(image_entry["shape"], dtype=img.dtype)
+    normalized_img[0 : img.shape[0], 0 : img.shape[1]] = img
+    return normalized_img
+
+
+def as_loc_list(loc_list):
+    """ convert a location table into a list of (img_index, (top, left, height, width)) tuples.
+
+    :Variables:
+        loc_list : list or numpy.array
+            either a list of tuples (returned as it is) or a #(sub-subinstances) x 5 integer array
+            whose rows are (img_index, top, left, height, width).
+    :RType: list
+    :Returns:
+        a list of (img_index, (top, left, height, width)) tuples.
+    """
+    if isinstance(loc_list, list):
+        return loc_list
+    return [(int(row[0]), (int(row[1]), int(row[2]), int(row[3]), int(row[4]))) for row in loc_list]
+
+
+def as_loc_array(loc_list):
+    """ convert a location list into a #(sub-subinstances) x 5 integer array.
+
+    :Variables:
+        loc_list : list or numpy.array
+            either a list of (img_index, (top, left, height, width)) tuples or an integer array (returned as it is).
+    :RType: numpy.array
+    :Returns:
+        an integer array whose rows are (img_index, top, left, height, width).
+    """
+    if not isinstance(loc_list, list):
+        return loc_list
+    loc_array = np.zeros((len(loc_list), 5), dtype=int)
+    for i in range(len(loc_list)):
+        loc_array[i, 0] = loc_list[i][0]
+        loc_array[i, 1:] = loc_list[i][1]
+    return loc_array
+
+
+def save_array_dir(save_dir, header, array_dict):
+    """ save arrays into a directory as .npy files with a json header, so that they can be memory-mapped.
+
+    :Variables:
+        save_dir : str
+            created if it does not exist.
+        header : dict
+            json-serializable metadata, saved as header.json together with the names of the arrays.
+        array_dict : dict
+            array_dict[name] is saved as name.npy.
+    """
+    if not os.path.exists(save_dir):
+        os.mkdir(save_dir)
+    for name in array_dict:
+        np.save(os.path.join(save_dir, name + ".npy"), array_dict[name])
+    header = dict(header)
+    header["arrays"] = sorted(array_dict.keys())
+    # the header is written at last so that a complete header implies complete arrays.
+    with open(os.path.join(save_dir, "header.json"), "w") as f:
+        json.dump(header, f, indent=1)
+
+
+def load_array_dir(load_dir, mmap_mode="r"):
+    """ load arrays saved by save_array_dir.
+
+    :Variables:
+        load_dir : str
+        mmap_mode : str
+            mmap_mode passed to numpy.load. None to read the arrays into memory.
+    :RType: tuple
+    :Returns:
+        (header, array_dict)
+    """
+    with open(os.path.join(load_dir, "header.json"), "r") as f:
+        header = json.load(f)
+    array_dict = {}
+    for name in header["arrays"]:
+        array_dict[name] = np.load(os.path.join(load_dir, name + ".npy"), mmap_mode=mmap_mode)
+    return header, array_dict